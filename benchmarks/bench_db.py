@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+
+Benchmark of persistent DB backends (shelve vs. SQLite) for the two workloads Ludolph has:
+  - crontab: the whole "crontab" key is rewritten after every at/remind job is added or removed
+  - persistent_attrs: every plugin's persistent attributes are saved during reload/shutdown and loaded on start
+The crontab payload mimics onetime CronTab entries with plain data structures, so the benchmark runs without
+an XMPP library installed.
+
+Usage: python benchmarks/bench_db.py [at jobs] [plugins]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import shutil
+import tempfile
+import timeit
+from datetime import datetime
+
+from ludolph.db import open_db
+
+
+def crontab_payload(jobs):
+    return dict((i, {'name': i, 'fun': ('attention', 'ludolph.plugins.base'), 'onetime': datetime.now(),
+                     'owner': 'user%d@example.com' % i, 'args': ({'body': 'attention user@example.com ping %d' % i},)})
+                for i in range(jobs))
+
+
+def plugin_payload(i):
+    return {'room_users_invited': set('user%d@example.com' % j for j in range(50)),
+            'room_users_last_seen': dict(('user%d@example.com' % j, datetime.now()) for j in range(50)),
+            'room_motd': 'Message of the day for plugin %d' % i}
+
+
+def bench(dbfile, jobs, plugins):
+    db = open_db(dbfile)
+    results = []
+
+    def crontab_write():
+        for i in range(1, jobs + 1):  # "at add" - every new job rewrites the crontab key
+            db['crontab'] = crontab_payload(i)
+            db.sync()
+
+    def attrs_write():
+        with db.transaction():
+            for i in range(plugins):
+                db['ludolph.plugins.plugin%d' % i] = plugin_payload(i)
+
+    def attrs_read():
+        for i in range(plugins):
+            db.get('ludolph.plugins.plugin%d' % i)
+
+    try:
+        for name, fun, ops in (('crontab write', crontab_write, jobs),
+                               ('persistent_attrs write', attrs_write, plugins),
+                               ('persistent_attrs read', attrs_read, plugins)):
+            elapsed = timeit.timeit(fun, number=1)
+            results.append((name, elapsed * 1e6 / ops))
+    finally:
+        db.close()
+
+    return results
+
+
+def main(jobs=200, plugins=50):
+    tmpdir = tempfile.mkdtemp()
+
+    try:
+        print('%d at jobs, %d plugins' % (jobs, plugins))
+
+        for backend, dbfile in (('shelve', os.path.join(tmpdir, 'ludolph.shelf')),
+                                ('sqlite', 'sqlite://' + os.path.join(tmpdir, 'ludolph.db'))):
+            for name, latency in bench(dbfile, jobs, plugins):
+                print('%-7s %-24s %10.1f us per operation' % (backend, name, latency))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+
+Measure import time and peak RSS of Ludolph modules in a fresh interpreter.
+Each module is imported in a new python process, because imports are cached in sys.modules.
+
+Usage: python benchmarks/bench_import.py [module ...] [-n runs]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import subprocess
+
+CODE = '''
+import resource, sys, time
+start = time.time()
+__import__(sys.argv[1])
+print('%f %d %d' % (time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, 'bottle' in sys.modules))
+'''
+
+
+def measure(module, runs=5):
+    env = dict(os.environ, PYTHONPATH=os.getcwd())
+    results = []
+
+    for _ in range(runs):
+        out = subprocess.check_output([sys.executable, '-c', CODE, module], env=env)
+        elapsed, rss, bottle = out.decode().split()
+        results.append((float(elapsed), int(rss), bool(int(bottle))))
+
+    return min(r[0] for r in results), min(r[1] for r in results), results[0][2]
+
+
+def main(modules, runs=5):
+    print('%-24s %12s %12s %8s' % ('module', 'import [ms]', 'RSS [kB]', 'bottle'))
+
+    for module in modules:
+        elapsed, rss, bottle = measure(module, runs=runs)
+        print('%-24s %12.1f %12d %8s' % (module, elapsed * 1000, rss, bottle))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    n = 5
+
+    if '-n' in args:
+        i = args.index('-n')
+        n = int(args[i + 1])
+        del args[i:i + 2]
+
+    main(args or ['ludolph.command', 'ludolph.web', 'ludolph.plugins.base'], runs=n)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+
+Benchmark of sending many messages from a local script: one HTTP POST /message request per message
+(new connection each time, like curl in an alert script) vs. one pipelined connection to the ingestion socket.
+Messages are not sent over XMPP - only the ingestion overhead is measured.
+
+Usage: python benchmarks/bench_ingest.py [messages]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import socket
+import tempfile
+import threading
+
+try:
+    from urllib.request import urlopen
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib2 import urlopen
+    from urllib import urlencode
+
+from ludolph.web import WebServer, request, abort
+from ludolph.ingest import IngestServer, IngestClient
+
+JID = 'user@example.com'
+
+
+class FakeXMPP(object):
+    room = None
+    client_roster = {JID: {}}
+    sent = 0
+
+    def msg_send(self, mto, mbody, **kwargs):
+        self.sent += 1
+
+    def msg_alert(self, mto, mbody, **kwargs):
+        self.sent += 1
+
+    def msg_broadcast(self, mbody, **kwargs):
+        self.sent += 1
+        return 1
+
+
+def send_msg(xmpp):
+    """The same request processing as the /message webhook in ludolph.plugins.base"""
+    def view():
+        jid = request.forms.get('jid', None)
+
+        if not jid:
+            abort(400, 'Missing JID in message request')
+
+        xmpp.msg_send(jid, request.forms.get('msg', ''), mtype='normal')
+
+        return 'Message sent to **%s**' % jid
+
+    return view
+
+
+def start_thread(target):
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+
+
+def bench_http(xmpp, count):
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    webserver = WebServer('127.0.0.1', port)
+    webserver.init_webapp = lambda app: app.route('/message', ('POST',), send_msg(xmpp))
+    start_thread(webserver.start)
+    time.sleep(0.5)
+    url = 'http://127.0.0.1:%d/message' % port
+
+    start = time.time()
+
+    for i in range(count):
+        urlopen(url, urlencode({'jid': JID, 'msg': 'Alert %d' % i}).encode()).read()
+
+    elapsed = time.time() - start
+    webserver.stop()
+
+    return elapsed
+
+
+def bench_ingest(xmpp, count, path):
+    ingest = IngestServer(xmpp, path)
+    start_thread(ingest.start)
+    time.sleep(0.5)
+
+    start = time.time()
+
+    with IngestClient(path) as client:
+        for res in client.send({'type': 'message', 'jid': JID, 'msg': 'Alert %d' % i} for i in range(count)):
+            assert res['ok'], res
+
+    elapsed = time.time() - start
+    ingest.stop()
+
+    return elapsed
+
+
+def main(count=2000):
+    tmpdir = tempfile.mkdtemp()
+
+    try:
+        xmpp = FakeXMPP()
+        http = bench_http(xmpp, count)
+        ingest = bench_ingest(xmpp, count, os.path.join(tmpdir, 'ludolph.sock'))
+        assert xmpp.sent == 2 * count
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print('%d messages' % count)
+    print('%-18s %8.1f ms %8.0f msg/s' % ('HTTP /message', http * 1000, count / http))
+    print('%-18s %8.1f ms %8.0f msg/s' % ('ingestion socket', ingest * 1000, count / ingest))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
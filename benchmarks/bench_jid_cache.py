@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+
+Microbenchmark of per-message JID handling cost (LudolphBot._sleekxmpp_fix_jid) with and without the JIDS cache.
+Every incoming MUC command resolves the sender's JID string (get_jid) and every outgoing message checks the
+recipient's status (get_jid_resource), so each message parses at least two JID strings.
+
+Usage: python benchmarks/bench_jid_cache.py [messages] [distinct users]
+"""
+from __future__ import print_function
+
+import sys
+import timeit
+
+from sleekxmpp.jid import JID
+
+from ludolph.bot import LudolphBot, JIDS
+
+
+def main(messages=100000, users=50):
+    jids = ['user%d@example.com/resource%d' % (i, i) for i in range(users)]
+    stream = [jids[i % users] for i in range(messages)]
+
+    def uncached():
+        for jid in stream:
+            JID(jid).bare
+            JID(jid.split('/')[0]).bare
+
+    def cached():
+        for jid in stream:
+            LudolphBot._sleekxmpp_fix_jid(jid).bare
+            LudolphBot._sleekxmpp_fix_jid(jid.split('/')[0]).bare
+
+    JIDS.clear()
+    print('%d messages from %d distinct users' % (messages, users))
+
+    for name, fun in (('JID parsing', uncached), ('JIDS cache', cached)):
+        elapsed = timeit.timeit(fun, number=1)
+        print('%-12s %8.3f s (%.2f us per message)' % (name, elapsed, elapsed * 1e6 / messages))
+
+    print('JIDS cache statistics: %s' % JIDS.stats())
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
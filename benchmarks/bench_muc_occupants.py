@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+
+Benchmark of MUC room member lookups (LudolphBot._get_room_member) in a big room.
+The original implementation scanned the whole room roster for every lookup, which made the invitation loop in
+_muc_user_online() O(room_users * occupants).
+
+Usage: python benchmarks/bench_muc_occupants.py [occupants]
+"""
+from __future__ import print_function
+
+import sys
+import timeit
+import threading
+
+from ludolph.bot import LudolphBot
+
+
+ROOM = 'room@conference.example.com'
+
+
+class FakeMuc(object):
+    def __init__(self, occupants):
+        self.rooms = {ROOM: {}}
+
+        for i in range(occupants):
+            nick = 'user%d' % i
+            self.rooms[ROOM][nick] = {'room': ROOM, 'nick': nick, 'jid': 'user%d@example.com/res' % i,
+                                      'role': 'participant', 'affiliation': 'member'}
+
+
+def linear_get_room_member(bot, jid):
+    """The original implementation"""
+    for nick in bot.muc.rooms[bot.room]:
+        entry = bot.muc.rooms[bot.room][nick]
+
+        if entry is not None and bot._sleekxmpp_fix_jid(entry['jid']).bare == jid:
+            return entry
+
+    raise KeyError(jid)
+
+
+def main(occupants=2000):
+    bot = LudolphBot.__new__(LudolphBot)
+    bot.room = ROOM
+    bot.muc = FakeMuc(occupants)
+    # Half of the room users are present in the room
+    room_users = ['user%d@example.com' % i for i in range(0, occupants * 2, 2)]
+    bot._room_occupants_lock = threading.Lock()
+    bot._room_occupants_rebuild()
+
+    def invitation_loop(get_room_member):
+        for user in room_users:
+            try:
+                get_room_member(user)
+            except KeyError:
+                pass
+
+    print('Room with %d occupants, %d room users' % (occupants, len(room_users)))
+
+    for name, fun in (('linear scan', lambda jid: linear_get_room_member(bot, jid)),
+                      ('occupant index', bot._get_room_member)):
+        runs = 1 if name == 'linear scan' else 10
+        elapsed = timeit.timeit(lambda: invitation_loop(fun), number=runs) / runs
+        print('%-16s invitation loop: %10.3f ms (%.2f us per lookup)' % (
+            name, elapsed * 1000, elapsed * 1e6 / len(room_users)))
+
+    elapsed = timeit.timeit(bot._room_occupants_rebuild, number=10) / 10
+    print('%-16s index rebuild:   %10.3f ms' % ('occupant index', elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+
+Throughput of the durable alert outbox (ludolph.outbox.Outbox) on the current file system:
+  - sync: every append waits for its fsync (webhook requests) - concurrent writers share one fsync (group commit)
+  - batch: appends wait for one fsync at the end of a batch (pipelined ingestion socket requests)
+Each alert is also marked as sent and acknowledged, like in the bot.
+
+Usage: python benchmarks/bench_outbox.py [alerts] [peak alert rate per second]
+"""
+from __future__ import print_function
+
+import sys
+import time
+import shutil
+import tempfile
+import threading
+
+from ludolph.outbox import Outbox
+
+ALERT = {'to': 'user@example.com', 'type': 'normal', 'trigger': '13522',
+         'body': 'PROBLEM: Free disk space is less than 20% on volume /var (host: db01.example.com, severity: High)'}
+
+
+def run(count, threads, batch=0):
+    tmpdir = tempfile.mkdtemp()
+    outbox = Outbox(tmpdir)
+
+    def writer(n):
+        for i in range(n):
+            seq = outbox.append(ALERT, sync=not batch)
+
+            if batch and i % batch == batch - 1:
+                outbox.sync()
+
+            outbox.sent(seq)
+            outbox.ack((seq,))
+
+        outbox.sync()
+
+    workers = [threading.Thread(target=writer, args=(count // threads,)) for _ in range(threads)]
+    start = time.time()
+
+    for worker in workers:
+        worker.start()
+
+    for worker in workers:
+        worker.join()
+
+    elapsed = time.time() - start
+    outbox.close()
+    shutil.rmtree(tmpdir)
+
+    return count // threads * threads / elapsed
+
+
+def main(count=2000, peak=100):
+    print('%-28s %12s' % ('mode', 'alerts/s'))
+
+    for threads in (1, 4, 16):
+        rate = run(count, threads)
+        print('%-28s %12.0f %s' % ('sync, %d writer(s)' % threads, rate, 'OK' if rate >= peak else 'TOO SLOW'))
+
+    for batch in (16, 256):
+        rate = run(count * 10, 1, batch=batch)
+        print('%-28s %12.0f %s' % ('batch of %d, 1 writer' % batch, rate, 'OK' if rate >= peak else 'TOO SLOW'))
+
+    print('(peak alert rate: %d/s)' % peak)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,324 @@
+"""
+Ludolph: Monitoring Jabber bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the file LICENSE for copying permission.
+
+Processing of alert messages received via webhooks or the ingestion API (LudolphBot.msg_alert).
+"""
+import re
+import time
+import logging
+from threading import Lock
+from collections import deque
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # noinspection PyUnresolvedReferences,PyPackageRequirements
+    from ordereddict import OrderedDict
+
+from ludolph.message import TEXT2HTML
+
+__all__ = ('AlertStorm', 'FlapFilter')
+
+logger = logging.getLogger(__name__)
+
+# Severity keywords highlighted in messages, e.g. (PROBLEM|OFF), ([Dd]isaster)
+SEVERITY_PATTERNS = tuple(re.compile(r'\b%s\b' % pattern.pattern) for pattern, _ in TEXT2HTML
+                          if hasattr(pattern, 'pattern') and pattern.pattern.startswith('('))
+
+TRIGGER_STATE_RE = re.compile(r'\b(PROBLEM|OK)\b')
+PROBLEM = 'PROBLEM'
+OK = 'OK'
+
+
+def get_severities(text):
+    """Return set of severity keywords found in text"""
+    return set(keyword[0].upper() + keyword[1:] for pattern in SEVERITY_PATTERNS for keyword in pattern.findall(text))
+
+
+class _Recipient(object):
+    """Alert storm state of one recipient"""
+    __slots__ = ('times', 'mtype', 'summary', 'count', 'severities', 'lines', 'seqs')
+
+    def __init__(self, maxlen, mtype):
+        self.times = deque(maxlen=maxlen)  # Timestamps of the last threshold + 1 alerts
+        self.mtype = mtype
+        self.summary = False
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.severities = OrderedDict()
+        self.lines = []
+        self.seqs = []  # Outbox sequence numbers of aggregated alerts
+
+
+class AlertStorm(object):
+    """
+    Per-recipient sliding-window rate detector. A recipient receiving more than threshold alerts within window
+    seconds is switched into summary mode - alerts are aggregated and one digest is sent every window seconds
+    (by flush(), which is scheduled by the bot). Summary mode ends when the rate drops below the threshold.
+    """
+    threshold = 0  # Maximum number of alerts per window (0 = disabled)
+    window = 60
+    digest_lines = 10  # Number of alerts included in the digest
+
+    def __init__(self, xmpp):
+        self.xmpp = xmpp
+        self._recipients = {}  # {JID : _Recipient}
+        self._lock = Lock()
+
+    @property
+    def enabled(self):
+        return self.threshold > 0
+
+    def load_config(self, config):
+        """Read settings from the [alerts] config section (dict)"""
+        self.threshold = int(config.get('storm_threshold', AlertStorm.threshold))
+        self.window = int(config.get('storm_window', AlertStorm.window)) or AlertStorm.window
+        self.digest_lines = int(config.get('storm_digest_lines', AlertStorm.digest_lines))
+
+        with self._lock:
+            for rcpt in self._recipients.values():
+                rcpt.times = deque(rcpt.times, maxlen=self.threshold + 1)
+
+    def _trim(self, rcpt, now):
+        """Remove timestamps outside of the sliding window"""
+        times = rcpt.times
+        start = now - self.window
+
+        while times and times[0] <= start:
+            times.popleft()
+
+    def send(self, mto, mbody, mtype='normal', seqs=()):
+        """
+        Send alert or add it into the digest. Return False if the alert was not sent immediately.
+        The seqs are outbox sequence numbers of alerts carried by the message - they are passed to msg_send()
+        together with the message or digest.
+        """
+        if not self.enabled:
+            return self.xmpp.msg_send(mto, mbody, mtype=mtype, outbox_seqs=seqs)
+
+        now = time.time()
+
+        with self._lock:
+            rcpt = self._recipients.get(mto, None)
+
+            if rcpt is None:
+                rcpt = self._recipients[mto] = _Recipient(self.threshold + 1, mtype)
+
+            rcpt.times.append(now)
+
+            if not rcpt.summary:
+                self._trim(rcpt, now)
+
+                if len(rcpt.times) > self.threshold:
+                    logger.warning('Alert storm detected for "%s": more than %d alerts in %d seconds - '
+                                   'switching to summary mode', mto, self.threshold, self.window)
+                    rcpt.summary = True
+
+            if rcpt.summary:
+                rcpt.count += 1
+
+                for severity in get_severities(mbody):
+                    rcpt.severities[severity] = rcpt.severities.get(severity, 0) + 1
+
+                if len(rcpt.lines) < self.digest_lines:
+                    rcpt.lines.append(mbody.strip().split('\n', 1)[0])
+
+                rcpt.seqs.extend(seqs)
+
+                return False
+
+        return self.xmpp.msg_send(mto, mbody, mtype=mtype, outbox_seqs=seqs)
+
+    def _digest(self, rcpt):
+        lines = ['**Alert storm**: %d alerts in the last %d seconds' % (rcpt.count, self.window)]
+
+        if rcpt.severities:
+            lines.append(', '.join('%s: %d' % item for item in rcpt.severities.items()))
+
+        lines.extend(' * %s' % line for line in rcpt.lines)
+
+        if rcpt.count > len(rcpt.lines):
+            lines.append(' ... and %d more' % (rcpt.count - len(rcpt.lines)))
+
+        return '\n'.join(lines)
+
+    def flush(self):
+        """Send digests to recipients in summary mode and end summary mode if the alert rate has dropped"""
+        now = time.time()
+        digests = []
+
+        with self._lock:
+            for mto, rcpt in tuple(self._recipients.items()):
+                self._trim(rcpt, now)
+
+                if rcpt.summary:
+                    if rcpt.count:
+                        digests.append((mto, rcpt.mtype, self._digest(rcpt), rcpt.seqs))
+                        rcpt.reset()
+
+                    if not self.enabled or len(rcpt.times) <= self.threshold:
+                        logger.warning('Alert storm for "%s" has ended - switching to normal mode', mto)
+                        rcpt.summary = False
+
+                if not rcpt.summary and not rcpt.times:
+                    del self._recipients[mto]
+
+        for mto, mtype, digest, seqs in digests:
+            logger.info('Sending alert digest to "%s"', mto)
+            self.xmpp.msg_send(mto, digest, mtype=mtype, outbox_seqs=seqs)
+
+
+def get_trigger_state(text):
+    """Return PROBLEM or OK depending on the first state keyword found in text (or None)"""
+    match = TRIGGER_STATE_RE.search(text)
+
+    if match:
+        return match.group(1)
+
+    return None
+
+
+class _Trigger(object):
+    """State of one trigger"""
+    __slots__ = ('state', 'changed', 'held', 'held_seqs', 'due', 'flaps', 'seqs', 'mtype')
+
+    def __init__(self, mtype):
+        self.mtype = mtype
+        self.state = OK
+        self.changed = 0  # Timestamp of last state change
+        self.held = None  # Delayed OK message
+        self.held_seqs = ()  # Outbox sequence numbers of the delayed OK message
+        self.due = None  # Timestamp when the delayed message or flapping summary should be sent
+        self.flaps = 0  # Number of delayed or suppressed state changes
+        self.seqs = []  # Outbox sequence numbers of suppressed alerts (carried by the flapping summary)
+
+
+class FlapFilter(object):
+    """
+    Trigger state tracking for alerts with a trigger key. A PROBLEM is sent immediately, but an OK arriving within
+    holddown seconds after the PROBLEM is delayed. If the PROBLEM returns during the delay, both messages are
+    suppressed and one flapping summary is sent after the trigger stays in one state for holddown seconds.
+    Delayed messages and summaries are sent by flush(), which is scheduled by the bot.
+    """
+    holddown = 0  # Seconds (0 = disabled)
+    maxsize = 10000  # Maximum number of tracked triggers
+
+    def __init__(self, send):
+        self.send = send  # Function for sending messages - send(mto, mbody, mtype=..., seqs=...)
+        self._triggers = OrderedDict()  # {(JID, trigger) : _Trigger}
+        self._lock = Lock()
+
+    @property
+    def enabled(self):
+        return self.holddown > 0
+
+    def load_config(self, config):
+        """Read settings from the [alerts] config section (dict)"""
+        self.holddown = int(config.get('flap_holddown', FlapFilter.holddown))
+
+    def process(self, mto, mbody, mtype, trigger, seqs=()):
+        """Send, delay or suppress alert. Return False if the alert was not sent immediately"""
+        state = get_trigger_state(mbody)
+
+        if not self.enabled or state is None:
+            return self.send(mto, mbody, mtype=mtype, seqs=seqs)
+
+        key = (mto, trigger)
+        now = time.time()
+        messages = []
+
+        with self._lock:
+            trg = self._triggers.get(key, None)
+
+            if trg is None:
+                trg = self._triggers[key] = _Trigger(mtype)
+
+                while len(self._triggers) > self.maxsize:  # Evicted triggers release their delayed messages
+                    evicted_key, evicted = self._triggers.popitem(last=False)
+                    messages.extend(self._release(evicted_key, evicted, now))
+
+            if state == PROBLEM:
+                if trg.held is not None:  # OK is waiting -> flapping
+                    logger.info('Suppressing flapping trigger "%s" for "%s"', trigger, mto)
+                    trg.seqs.extend(trg.held_seqs)
+                    trg.seqs.extend(seqs)
+                    trg.held, trg.held_seqs = None, ()
+                    trg.flaps += 1
+                    trg.changed = now
+                    trg.due = now + self.holddown
+                    mbody = None
+                elif trg.state != PROBLEM:
+                    trg.state = PROBLEM
+                    trg.changed = now
+            elif trg.state == PROBLEM:
+                if trg.held is not None or now - trg.changed < self.holddown:
+                    logger.info('Delaying OK message for trigger "%s" for "%s"', trigger, mto)
+
+                    if trg.held is None:
+                        trg.flaps += 1
+
+                    trg.seqs.extend(trg.held_seqs)  # Replaced OK message
+                    trg.held, trg.held_seqs = mbody, tuple(seqs)
+                    trg.due = now + self.holddown
+                    mbody = None
+                else:
+                    trg.state = OK
+                    trg.changed = now
+
+        for item in messages:
+            self.send(item[0], item[1], mtype=item[2], seqs=item[3])
+
+        if mbody is None:
+            return False
+
+        return self.send(mto, mbody, mtype=mtype, seqs=seqs)
+
+    @staticmethod
+    def _summary(trigger, trg):
+        return '**Flapping**: trigger __%s__ changed its state %d times, current state: %s' % (
+            trigger, trg.flaps, trg.state)
+
+    def _release(self, key, trg, now):
+        """Return list of (JID, text, mtype, seqs) of delayed OK message and flapping summary (call under lock)"""
+        mto, trigger = key
+        messages = []
+        held, held_seqs, seqs = trg.held, trg.held_seqs, trg.seqs
+        trg.held, trg.held_seqs, trg.seqs, trg.due = None, (), [], None
+
+        if held is not None:
+            trg.state = OK
+            trg.changed = now
+
+        if trg.flaps > (1 if held is not None else 0):  # A single delayed OK is not flapping
+            messages.append((mto, self._summary(trigger, trg), trg.mtype, seqs))
+        elif seqs:  # Replaced OK messages
+            held_seqs = tuple(seqs) + held_seqs
+
+        trg.flaps = 0
+
+        if held is not None:
+            messages.append((mto, held, trg.mtype, held_seqs))
+
+        return messages
+
+    def flush(self, force=False):
+        """Send delayed OK messages and flapping summaries which are due (or all of them if force=True)"""
+        now = time.time()
+        messages = []
+
+        with self._lock:
+            for key, trg in tuple(self._triggers.items()):
+                if trg.due is not None and (force or trg.due <= now):
+                    messages.extend(self._release(key, trg, now))
+
+                if trg.state == OK and trg.due is None:
+                    del self._triggers[key]
+
+        for mto, mbody, mtype, seqs in messages:
+            self.send(mto, mbody, mtype=mtype, seqs=seqs)
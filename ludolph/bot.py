@@ -6,11 +6,16 @@ This file is part of Ludolph.
 See the LICENSE file for copying permission.
 """
 
+import os
 import ssl
+import sys
+import signal
 import time
 import copy
 import logging
+import threading
 from datetime import datetime
+from collections import namedtuple
 from sleekxmpp import ClientXMPP
 from sleekxmpp.xmlstream import ET
 from sleekxmpp.exceptions import IqError
@@ -22,12 +27,22 @@ except ImportError:
     # noinspection PyUnresolvedReferences,PyPackageRequirements
     from ordereddict import OrderedDict
 
-from ludolph.message import IncomingLudolphMessage, OutgoingLudolphMessage
-from ludolph.command import COMMANDS
-from ludolph.db import LudolphDB, LudolphDBMixin
-from ludolph.web import WebServer
-from ludolph.cron import Cron
-from ludolph.utils import catch_exception
+import ludolph.command
+import ludolph.cron
+import ludolph.web
+from ludolph.message import RequestContext, IncomingLudolphMessage, OutgoingLudolphMessage
+from ludolph.command import Commands, COMMANDS, ROLE_USER, ROLE_ADMIN, ROLE_ROOM_USER, ROLE_ROOM_ADMIN
+from ludolph.db import LudolphDBMixin, open_db
+from ludolph.web import WebServer, WEBHOOKS
+from ludolph.cron import Cron, CronTab, CRONJOBS
+from ludolph.ingest import IngestServer
+from ludolph.alerts import AlertStorm, FlapFilter
+from ludolph.deferred import DeferredMessages, OFFLINE, ONLINE
+from ludolph.outbox import Outbox
+from ludolph import metrics
+from ludolph.tracing import TRACER, span
+from ludolph.profiling import PROFILER
+from ludolph.utils import catch_exception, LRUCache, PhaseTimer
 
 logger = logging.getLogger(__name__)
 
@@ -39,8 +54,8 @@ class Plugins(OrderedDict):
     Plugin module names to plugin instance mapping.
     """
     def __init__(self, *args, **kwargs):
-        super(Plugins, self).__init__(*args, **kwargs)
         self.shorthands = {}
+        super(Plugins, self).__init__(*args, **kwargs)
 
     def __setitem__(self, key, value, **kwargs):
         super(Plugins, self).__setitem__(key, value, **kwargs)
@@ -80,6 +95,14 @@ class Plugins(OrderedDict):
 
 
 PLUGINS = Plugins()  # {modname : instance}
+# Everything registered by plugins. A new registry is created during reload and published when complete.
+Registry = namedtuple('Registry', ('plugins', 'commands', 'webhooks', 'crontab'))
+JIDS = LRUCache(maxsize=4096)  # {JID string : parsed JID object}
+
+COMMANDS_RUN = metrics.counter('ludolph_commands_total', 'Number of executed bot commands', ('module', 'command'))
+COMMANDS_NOT_FOUND = metrics.counter('ludolph_commands_not_found_total', 'Number of messages without a valid command')
+COMMAND_SECONDS = metrics.histogram('ludolph_command_seconds', 'Bot command execution time', ('command',))
+metrics.gauge('ludolph_jid_cache_size', 'Number of parsed JIDs in cache', fun=lambda: len(JIDS))
 
 
 def get_xmpp():
@@ -95,6 +118,7 @@ class LudolphBot(LudolphDBMixin):
     _muc_ready = False
     _reloaded = False
     reloading = False
+    restarting = False
     shutting_down = False
     commands = COMMANDS
     plugins = PLUGINS
@@ -113,12 +137,27 @@ class LudolphBot(LudolphDBMixin):
     xmpp = None
     maxhistory = '16'
     webserver = None
+    ingest = None
+    alerts = None
+    flapping = None
+    outbox = None
+    outbox_ack_delay = 10  # Seconds after which a sent alert is considered delivered if the connection was not lost
+    _outbox_ready = False  # Connected - alerts can be sent immediately
     cron = None
     persistent_attrs = ('room_users_invited', 'room_users_last_seen')
     drop_messages_to_dnd_users = False
-
-    def __init__(self, config, plugins=None):
+    deferred = None
+    dbfile = ''
+    db_checkpoint_interval = 300  # Seconds between saving changed persistent attributes of all plugins
+    db_compact_interval = 0  # Seconds between persistent DB compactions (disabled by default)
+    _registry = None  # Published Registry
+    _staged_registry = None  # Registry being built during reload
+    _jid_roles = ({}, 0)  # ({bare JID : role mask}, role mask of other JIDs) - compiled by _load_config()
+
+    def __init__(self, config, plugins=None, startup_timer=None, listen_fd=None):
         super(LudolphBot, self).__init__()
+        self.listen_fd = listen_fd  # Inherited listening socket for the web server
+        self.startup_timer = startup_timer or PhaseTimer(enabled=False)  # --profile-startup
 
         self._event_handlers = {
             'bot_message': [self._run_command],
@@ -134,10 +173,27 @@ class LudolphBot(LudolphDBMixin):
         self.room_admins = set()
         self.room_users_invited = set()
         self.room_users_last_seen = {}
+        self._db_dirty = set()  # {(object name, attribute)} - persistent attributes changed since the last save
+        self._room_occupants = {}  # {bare JID : nick} of current MUC room occupants
+        self._room_occupants_lock = threading.Lock()
+        self._presence = {}  # {bare JID : (resource, options)} of the highest priority resource of roster users
+        self.alerts = AlertStorm(self)
+        self.flapping = FlapFilter(self.alerts.send)
+        self.deferred = DeferredMessages()
+        metrics.gauge('ludolph_deferred_messages', 'Number of messages held for unavailable users',
+                      fun=lambda: len(self.deferred))
+        metrics.gauge('ludolph_outbox_pending', 'Number of unacknowledged alerts in outbox',
+                      fun=lambda: len(self.outbox) if self.outbox is not None else 0)
+
+        with self.startup_timer.phase('bot config'):
+            self._load_config(config, init=True)
 
-        self._load_config(config, init=True)
         logger.info('Initializing jabber bot *%s*', self.nick)
-        self._load_plugins(config, plugins, init=True)
+
+        with self.startup_timer.phase('plugin init'):
+            self._registry = Registry(PLUGINS, COMMANDS, WEBHOOKS, CRONJOBS)
+            self._load_plugins(config, plugins, init=True)
+            self._log_registry()
 
         # Initialize the SleekXMPP client
         self.client = client = ClientXMPP(config.get('xmpp', 'username'), config.get('xmpp', 'password'))
@@ -146,26 +202,35 @@ class LudolphBot(LudolphDBMixin):
         self.boundjid = client.boundjid
 
         # Register XMPP plugins
+        # Other XMPP plugins are registered on first use (client_plugin()) or when required by Ludolph plugins
+        self.startup_timer.start('xmpp plugins')
         client.register_plugin('xep_0030')  # Service Discovery
-        client.register_plugin('xep_0045')  # Multi-User Chat
         client.register_plugin('xep_0071')  # XHTML-IM
         client.register_plugin('xep_0198')  # Stream Management
         client.register_plugin('xep_0199')  # XMPP Ping
         client.register_plugin('xep_0203')  # Delayed Delivery
-        client.register_plugin('xep_0084')  # User Avatar
-        client.register_plugin('xep_0153')  # User Avatar vCard
         client.register_plugin('xep_0224')  # Attention
 
+        if self.room:
+            client.register_plugin('xep_0045')  # Multi-User Chat
+
+        self._register_client_plugins()
+        self.startup_timer.stop('xmpp plugins')
+
         # Auto-authorize is enabled by default. User subscriptions are controlled by self._handle_new_subscription
         client.auto_authorize = True
 
         # Register event handlers
         client.add_event_handler('roster_subscription_request', self._handle_new_subscription)
         client.add_event_handler('session_start', self._session_start)
+        client.add_event_handler('disconnected', self._disconnected)
         client.add_event_handler('message', self._bot_message, threaded=True)
         client.add_event_handler('got_online', self._user_online, threaded=True)
         client.add_event_handler('got_offline', self._user_offline, threaded=True)
         client.add_event_handler('changed_status', self._user_changed_status, threaded=True)
+
+        for presence_type in ('available', 'chat', 'away', 'xa', 'dnd', 'unavailable'):  # After roster update
+            client.add_event_handler('presence_' + presence_type, self._presence_update)
         client.add_event_handler('attention', self._handle_attention, threaded=True)
 
         if self.room:
@@ -177,11 +242,20 @@ class LudolphBot(LudolphDBMixin):
         # Run post initialization methods for all plugins
         self._post_init_plugins()
 
+        # Save changed persistent data periodically
+        self._db_checkpoint_schedule()
+        self._alerts_schedule()
+
         # Start the web server thread for processing HTTP requests
         if self.webserver:
             # noinspection PyProtectedMember
             client._start_thread('webserver', self.webserver.start, track=False)
 
+        # Start the local ingestion API thread
+        if self.ingest:
+            # noinspection PyProtectedMember
+            client._start_thread('ingest', self.ingest.start, track=False)
+
         # Start the scheduler thread for running periodic cron jobs
         if self.cron:
             # noinspection PyProtectedMember
@@ -212,24 +286,62 @@ class LudolphBot(LudolphDBMixin):
             if i in self.persistent_attrs:
                 self.__dict__[i].update(state[i])
 
+    def db_enable(self, db, init=False):
+        """Enable DB support (and forget cached data of previous DB)"""
+        self._db_cache = {}  # {name : decoded object data} - data loaded from DB and not overwritten since then
+        super(LudolphBot, self).db_enable(db, init=init)
+
+    def _db_mark_changed(self, name, attrs):
+        """Mark persistent attributes of an object as changed. Changed objects are also saved at DB checkpoints"""
+        for attr in attrs:
+            self._db_dirty.add((name, attr))
+
+    def _db_changed(self, *attrs):
+        """Mark internal persistent attributes (default: all) as changed"""
+        self._db_mark_changed(__name__, attrs or self.persistent_attrs)
+
     @catch_exception
-    def _db_set_item(self, name, obj):
-        """Save object data into persistent DB"""
+    def _db_set_item(self, name, obj, force=False):
+        """Save object data into DB if forced or if a persistent attribute is marked as changed. Return True if saved"""
         if obj.persistent_attrs:
-            logger.info('Syncing runtime data with persistent DB file for object: %s', name)
-            self.db[name] = obj.__getstate__()
+            # Unmark changed attributes before reading them so that a concurrent change is saved next time
+            changed = sorted(attr for key, attr in tuple(self._db_dirty) if key == name)
+
+            for attr in changed:
+                self._db_dirty.discard((name, attr))
+
+            if changed or force:
+                logger.info('Syncing runtime data with persistent DB file for object: %s (changed attributes: %s)',
+                            name, ', '.join(changed))
+
+                try:
+                    self.db[name] = obj.__getstate__()
+                except Exception:
+                    self._db_mark_changed(name, changed)
+                    raise
+
+                self._db_cache.pop(name, None)
+                return True
+            else:
+                logger.debug('Object %s has no changed persistent attributes', name)
         else:
             logger.debug('Object %s has no persistent attributes', name)
 
+        return False
+
     @catch_exception
     def _db_load_item(self, name, obj):
         """Load saved object data from persistent DB"""
         if obj.persistent_attrs:
             logger.info('Loading runtime data from persistent DB file for object: %s', name)
-            data = self.db.get(name, None)
+
+            try:
+                data = self._db_cache[name]
+            except KeyError:
+                data = self._db_cache[name] = self.db.get(name, None)
 
             if data:
-                obj.__setstate__(data)
+                obj.__setstate__(copy.deepcopy(data))  # The cached data must not be modified by the object
             else:
                 logger.debug('Object %s has no saved data', name)
         else:
@@ -237,16 +349,87 @@ class LudolphBot(LudolphDBMixin):
 
     def _db_set_items(self):
         """Save internal data to persistent DB"""
-        self._db_set_item(__name__, self)
+        self._db_set_item(__name__, self, force=True)  # Loaded data are merged with current data in __setstate__()
 
     def _db_load_items(self):
         """Load saved internal data from persistent DB"""
         self._db_load_item(__name__, self)
 
-    def _db_set_items_all(self):
-        """Save all internal+plugin data to persistent DB for every initialized plugin"""
-        for modname, plugin in self.plugins.items():  # ludolph.bot is part of plugins
-            self._db_set_item(modname, plugin)
+    def _db_set_items_all(self, force=False):
+        """
+        Save all internal+plugin data to persistent DB for every initialized plugin.
+        Without force only objects with persistent attributes marked as changed are saved (DB checkpoint).
+        """
+        saved = [modname for modname, plugin in tuple(self.plugins.items())  # ludolph.bot is part of plugins
+                 if self._db_set_item(modname, plugin, force=force)]
+
+        if saved:
+            self.db.sync()
+
+        return saved
+
+    def _db_checkpoint(self):
+        """Periodically save changed persistent attributes of all plugins"""
+        if self.db is not None:
+            saved = self._db_set_items_all()
+            logger.debug('Persistent DB checkpoint finished (saved objects: %s)', ', '.join(saved))
+
+    @catch_exception
+    def db_compact(self):
+        """Save changed data and compact the persistent DB file. Return DB size before and after compaction"""
+        self._db_set_items_all()
+        size_before, size_after = self.db.compact()
+        logger.info('Persistent DB file %s compacted from %d to %d bytes', self.dbfile, size_before, size_after)
+
+        return size_before, size_after
+
+    def _db_checkpoint_schedule(self):
+        """(Re)schedule periodic persistent DB checkpoints and compactions"""
+        self.client.scheduler.remove('ludolph_db_checkpoint')
+        self.client.scheduler.remove('ludolph_db_compact')
+
+        if self.db is None:
+            return
+
+        if self.db_checkpoint_interval > 0:
+            logger.info('Scheduling persistent DB checkpoints every %s seconds', self.db_checkpoint_interval)
+            self.client.schedule('ludolph_db_checkpoint', self.db_checkpoint_interval, self._db_checkpoint,
+                                 repeat=True)
+
+        if self.db_compact_interval > 0:
+            logger.info('Scheduling persistent DB compaction every %s seconds', self.db_compact_interval)
+            self.client.schedule('ludolph_db_compact', self.db_compact_interval, self.db_compact, repeat=True)
+
+    def _alerts_schedule(self):
+        """(Re)schedule sending of alert storm digests and delayed trigger state changes"""
+        self.client.scheduler.remove('ludolph_outbox_confirm')
+        self.client.scheduler.remove('ludolph_alert_flapping')
+        self.client.scheduler.remove('ludolph_alert_digest')
+
+        if self.outbox is not None:
+            self.client.schedule('ludolph_outbox_confirm', 1, self.outbox.confirm, args=(self.outbox_ack_delay,),
+                                 repeat=True)
+
+        if self.flapping.enabled:
+            self.client.schedule('ludolph_alert_flapping', 1, self.flapping.flush, repeat=True)
+        else:
+            self.flapping.flush(force=True)  # Send delayed messages
+
+        if self.alerts.enabled:
+            self.client.schedule('ludolph_alert_digest', self.alerts.window, self.alerts.flush, repeat=True)
+        else:
+            self.alerts.flush()  # Send pending digests
+
+    def _db_close(self):
+        """Save all data and close persistent DB"""
+        if self.db is not None:
+            self._db_set_items_all(force=True)  # all plugins (including ludolph.bot)
+            self.db.flush()  # wait for pending writes
+            self.db.close()
+            self.db_disable()
+
+            if self.cron:
+                self.cron.db_disable()
 
     def _db_load_items_all(self):
         """Load all internal+plugin data from persistent DB for every initialized plugin"""
@@ -287,11 +470,29 @@ class LudolphBot(LudolphDBMixin):
         logger.info('Configuring jabber bot')
         xmpp_config = dict(config.items('xmpp'))
 
-        # Get DB file
+        # Get DB file (the DB stays open during reload unless the dbfile setting has changed)
         if config.has_option('global', 'dbfile'):
-            dbfile = config.get('global', 'dbfile')
+            dbfile = config.get('global', 'dbfile').strip()
+        else:
+            dbfile = ''
+
+        if dbfile != self.dbfile:
+            self._db_close()
+            self.dbfile = dbfile
+
             if dbfile:
-                self.db_enable(LudolphDB(dbfile), init=True)
+                self.db_enable(open_db(dbfile, writer=True), init=True)
+
+                if self.cron:  # Reload (the cron object is created below during first-time initialization)
+                    self.cron.db_enable(self.db, init=True)
+        elif dbfile:
+            logger.info('Keeping persistent DB file %s open', dbfile)
+
+        for option in ('db_checkpoint_interval', 'db_compact_interval'):
+            if config.has_option('global', option):
+                setattr(self, option, config.getint('global', option))
+            else:
+                setattr(self, option, getattr(LudolphBot, option))
 
         # Get nick name
         nick = xmpp_config.get('nick', '').strip()
@@ -381,9 +582,13 @@ class LudolphBot(LudolphDBMixin):
                 logger.error('Room admin "%s" is not specified in room_users. '
                              'This may lead to unexpected behaviour.', i)
 
+        # Compile users, admins, room_users and room_admins into the role table used for permission checks
+        self._compile_jid_roles()
+
         # Room users vs. room_users_invited
-        if self.room_users_invited:
+        if self.room_users_invited.difference(self.room_users):
             self.room_users_invited.intersection_update(self.room_users)
+            self._db_changed('room_users_invited')
 
         # Drop messages to users with DND status?
         if config.has_option('xmpp', 'drop_messages_to_dnd_users'):
@@ -391,6 +596,17 @@ class LudolphBot(LudolphDBMixin):
         else:
             self.drop_messages_to_dnd_users = LudolphBot.drop_messages_to_dnd_users
 
+        # Hold messages to unavailable users until they become available?
+        if config.has_option('xmpp', 'defer_messages'):
+            self.deferred.set_statuses(i.strip() for i in config.get('xmpp', 'defer_messages').split(',') if i.strip())
+        else:
+            self.deferred.set_statuses(())
+
+        if config.has_option('xmpp', 'defer_messages_limit'):
+            self.deferred.maxsize = config.getint('xmpp', 'defer_messages_limit')
+        else:
+            self.deferred.maxsize = DeferredMessages.maxsize
+
         # Web server (any change in configuration requires restart)
         if init and not self.webserver:
             if config.has_option('webserver', 'host') and config.has_option('webserver', 'port'):
@@ -398,17 +614,69 @@ class LudolphBot(LudolphDBMixin):
                 port = config.getint('webserver', 'port')
 
                 if host and port:  # Enable server (will be started in __init__)
-                    self.webserver = WebServer(host, port)
+                    self.webserver = WebServer(host, port, listen_fd=self.listen_fd)
+
+        # Command API tokens
+        if self.webserver:
+            if config.has_option('webserver', 'api_tokens'):
+                self.webserver.load_api_tokens(config.get('webserver', 'api_tokens'))
+            else:
+                self.webserver.api_tokens = {}
+
+            if config.has_option('webserver', 'idempotency_ttl'):
+                self.webserver.set_idempotency_ttl(config.getint('webserver', 'idempotency_ttl'))
+            else:
+                self.webserver.set_idempotency_ttl(WebServer.idempotency_ttl)
+
+        # Alert messages
+        if config.has_section('alerts'):
+            alerts_config = dict(config.items('alerts'))
+        else:
+            alerts_config = {}
+
+        self.alerts.load_config(alerts_config)
+        self.flapping.load_config(alerts_config)
+
+        # Durable outbox for alerts (any change in configuration requires restart)
+        if init and self.outbox is None:
+            if config.has_option('global', 'outbox'):
+                path = config.get('global', 'outbox').strip()
+
+                if path:
+                    logger.info('Using outbox directory %s', path)
+                    self.outbox = Outbox(path)
+
+        if config.has_option('global', 'outbox_ack_delay'):
+            self.outbox_ack_delay = config.getint('global', 'outbox_ack_delay')
+        else:
+            self.outbox_ack_delay = LudolphBot.outbox_ack_delay
+
+        # Tracing of incoming messages
+        if config.has_option('global', 'trace_file'):
+            trace_file = config.get('global', 'trace_file').strip()
+        else:
+            trace_file = None
+
+        if config.has_option('global', 'trace_sample_rate'):
+            trace_sample_rate = config.getfloat('global', 'trace_sample_rate')
+        else:
+            trace_sample_rate = 1.0
+
+        TRACER.configure(trace_file or None, sample_rate=trace_sample_rate)
+
+        # Local ingestion socket (any change in configuration requires restart)
+        if init and not self.ingest:
+            if config.has_option('global', 'socket'):
+                path = config.get('global', 'socket').strip()
+
+                if path:  # Enable server (will be started in __init__)
+                    self.ingest = IngestServer(self, path)
 
         # Cron (any change in configuration requires restart)
         if init and not self.cron:
             if config.has_option('cron', 'enabled') and config.getboolean('cron', 'enabled'):
                 self.cron = Cron(db=self.db)
 
-        if self._reloaded:
-            if self.cron and self.db is None:  # DB support was disabled during reload
-                self.cron.db_disable()
-
     # noinspection PyMethodMayBeStatic
     @catch_exception
     def _post_init_plugin(self, name, plugin_obj):
@@ -422,37 +690,129 @@ class LudolphBot(LudolphDBMixin):
         plugin_obj.__destroy__()
         del plugin_obj
 
-    def _load_plugins(self, config, plugins, init=False):
+    @staticmethod
+    def _reset_plugin(registry, modname):
+        """
+        Remove registered commands, webhooks and cron jobs of a plugin from registry.
+        """
+        registry.commands.reset(module=modname)
+
+        for name, hook in tuple(registry.webhooks.items()):  # Copy for python 3
+            if hook.module == modname:
+                del registry.webhooks[name]
+
+        for name, job in tuple(registry.crontab.items()):  # Copy for python 3
+            if job.module == modname and not job.onetime:
+                del registry.crontab[name]
+
+    def _stage_registry(self, changed=None):
+        """
+        Create a new registry for reload. It contains items of plugins, which are not going to be reloaded
+        (changed is a collection of plugin module names; default: all plugins are reloaded).
+        The command, webhook and cronjob decorators register into the new registry until it is published.
+        """
+        published = self._registry
+
+        def keep(module):
+            return changed is not None and module not in changed
+
+        commands = Commands((name, cmd) for name, cmd in published.commands.items() if keep(cmd.module))
+        commands.version = published.commands.version + 1
+        webhooks = dict((name, hook) for name, hook in published.webhooks.items() if keep(hook.module))
+        crontab = CronTab((name, job) for name, job in published.crontab.items()
+                          if not job.onetime and keep(job.module))  # Onetime jobs are merged when publishing
+        registry = Registry(Plugins(published.plugins), commands, webhooks, crontab)
+
+        ludolph.command.COMMANDS = commands
+        ludolph.web.WEBHOOKS = webhooks
+        ludolph.cron.CRONJOBS = crontab
+
+        return registry
+
+    def _publish_registry(self, registry):
+        """
+        Replace registries used by command, webhook and cron job dispatching. Each dispatcher uses one reference,
+        which is swapped at once, so it never sees a partially reloaded registry.
+        """
+        global PLUGINS
+        registry.commands.all(reset=True)  # Build the command cache before publishing
+
+        if self.cron:
+            self.cron.publish_crontab(registry.crontab)
+
+        PLUGINS = self.plugins = registry.plugins
+        self.commands = registry.commands
+
+        if self.webserver:
+            self.webserver.publish_webhooks(registry.webhooks)
+
+        self._registry = registry
+
+    def _log_registry(self):
+        """Log registered commands, webhooks and cron jobs"""
+        if self.commands:
+            logger.info('Registered commands:\n%s\n', '\n'.join(self.commands.display()))
+        else:
+            logger.warning('NO commands registered')
+
+        if self.webserver:
+            if self.webserver.webhooks:
+                logger.info('Registered webhooks:\n%s\n', '\n'.join(self.webserver.display_webhooks()))
+            else:
+                logger.warning('NO webhooks registered')
+        else:
+            logger.warning('Web server support disabled - webhooks will not work')
+
+        if self.cron:
+            if self.cron.crontab:
+                logger.info('Registered cron jobs:\n%s\n', '\n'.join(self.cron.display_cronjobs()))
+            else:
+                logger.warning('NO cron jobs registered')
+        else:
+            logger.warning('Cron support disabled - cron jobs will not work')
+
+    def _load_plugins(self, config, plugins, init=False, changed=None, registry=None):
         """
-        Initialize plugins.
+        Initialize plugins into registry (default: the published registry).
+        Return list of initialized plugin module names and list of (module name, instance) of replaced plugins.
         The init parameter indicates whether this is a first-time initialization or a reload.
+        During reload only plugins in changed (collection of module names) are reinitialized (default: all plugins).
         """
-        self.plugins.reset(init=init)
+        registry = registry or self._registry
+        initialized = []
+        replaced = []
+        registry.plugins.reset(init=init)
 
         if init:
             # First-time plugin initialization -> include ourself to plugins dict
             self.xmpp = self
-            self.plugins[__name__] = self
+            registry.plugins[__name__] = self
         else:
             # Bot reload - remove disabled plugins
-            for enabled_plugin in tuple(self.plugins.keys()):  # Copy for python 3
+            enabled_modules = set(plugin.module for plugin in plugins or ())
+
+            for enabled_plugin in tuple(registry.plugins.keys()):  # Copy for python 3
                 if enabled_plugin == __name__:
                     continue  # Skip ourself
 
-                if enabled_plugin not in plugins:
+                if enabled_plugin not in enabled_modules:
                     logger.info('Disabling plugin: %s', enabled_plugin)
-                    self._destroy_plugin(enabled_plugin, self.plugins.pop(enabled_plugin))
+                    replaced.append((enabled_plugin, registry.plugins.pop(enabled_plugin)))
+                    self._reset_plugin(registry, enabled_plugin)
 
         if plugins:
             for plugin in plugins:
                 modname = plugin.module
 
-                if init or modname not in self.plugins:
+                if init or modname not in registry.plugins:
                     logger.info('Initializing plugin: %s', modname)
                     reinit = False
+                elif changed is not None and modname not in changed:
+                    logger.info('Keeping unchanged plugin: %s', modname)
+                    continue
                 else:
                     logger.info('Reloading plugin: %s', modname)
-                    self._destroy_plugin(modname, self.plugins.pop(modname))
+                    replaced.append((modname, registry.plugins.pop(modname)))
                     reinit = True
 
                 try:
@@ -461,48 +821,27 @@ class LudolphBot(LudolphDBMixin):
                 except Exception as ex:
                     logger.critical('Could not load plugin: %s', modname)
                     logger.exception(ex)
-                    # Remove registered commands from Commands dict for this module
-                    self.commands.reset(module=modname)
-
-                    if self.webserver:  # Remove registered webhooks for this module
-                        self.webserver.reset_webhooks(module=modname)
-
-                    if self.cron:  # Remove registered cronjobs for this module
-                        self.cron.reset(module=modname)
+                    # Remove registered commands, webhooks and cron jobs for this module
+                    self._reset_plugin(registry, modname)
                 else:
-                    self.plugins[modname] = obj
+                    registry.plugins[modname] = obj
+                    initialized.append(modname)
 
                     if self.db is not None:
                         self._db_load_item(modname, obj)
 
         # Update commands cache
-        if self.commands.all(reset=True):
-            logger.info('Registered commands:\n%s\n', '\n'.join(self.commands.display()))
-        else:
-            logger.warning('NO commands registered')
+        registry.commands.all(reset=True)
 
-        if self.webserver:
-            if self.webserver.webhooks:
-                logger.info('Registered webhooks:\n%s\n', '\n'.join(self.webserver.display_webhooks()))
-            else:
-                logger.warning('NO webhooks registered')
-        else:
-            logger.warning('Web server support disabled - webhooks will not work')
+        return initialized, replaced
 
-        if self.cron:
-            if self.cron.crontab:
-                logger.info('Registered cron jobs:\n%s\n', '\n'.join(self.cron.display_cronjobs()))
-            else:
-                logger.warning('NO cron jobs registered')
-        else:
-            logger.warning('Cron support disabled - cron jobs will not work')
-
-    def _post_init_plugins(self):
+    def _post_init_plugins(self, modnames=None):
         """
-        Run __post_init__() method for each initialized plugin.
+        Run __post_init__() method for each initialized plugin (or only for plugins in modnames).
         """
-        for modname, plugin in self.plugins.items():  # ludolph.bot is part of plugins
-            self._post_init_plugin(modname, plugin)
+        for modname, plugin in tuple(self.plugins.items()):  # ludolph.bot is part of plugins
+            if modnames is None or modname in modnames:
+                self._post_init_plugin(modname, plugin)
 
     def _destroy_plugins(self):
         """
@@ -516,7 +855,10 @@ class LudolphBot(LudolphDBMixin):
         Run all event handlers when an event happens.
         """
         for event_handler in self._event_handlers[event_name]:
-            event_handler(*(copy.copy(arg) for arg in args))
+            with span('copy'):
+                handler_args = [copy.copy(arg) for arg in args]
+
+            event_handler(*handler_args)
 
     def register_event_handler(self, event_name, fun, clear=False):
         """
@@ -628,20 +970,76 @@ class LudolphBot(LudolphDBMixin):
 
         Looks like the xep_0045.py is using getStanzaValues() in handle_groupchat_presence and get_stanza_values got
         changed in https://github.com/fritzy/SleekXMPP/commit/79f3c1ac8f1aa0b099958e824dc53c17daf9849f
+
+        Parsed JID objects are shared through the JIDS cache, so they must not be modified.
         """
         if isinstance(jid, JID):
             return jid
         else:
-            return JID(jid)
+            return JIDS.get(jid, JID)
+
+    def _room_occupants_rebuild(self):
+        """
+        Rebuild the bare JID -> nick index of MUC room occupants from the MUC plugin's room roster.
+        """
+        occupants = {}
+
+        for nick, entry in tuple(self.muc.rooms.get(self.room, {}).items()):  # Copy for python 3
+            if entry is not None and entry.get('jid'):
+                occupants[self._sleekxmpp_fix_jid(entry['jid']).bare] = nick
+
+        with self._room_occupants_lock:
+            self._room_occupants = occupants
+
+    def _get_room_roster_entry(self, nick, jid):
+        """
+        Return MUC plugin's room roster entry for nick if it belongs to user's bare Jabber ID.
+        """
+        entry = self.muc.rooms.get(self.room, {}).get(nick, None)
+
+        if entry is not None and entry.get('jid') and self._sleekxmpp_fix_jid(entry['jid']).bare == jid:
+            return entry
+
+        return None
+
+    def _room_occupants_update(self, presence):
+        """
+        Update the bare JID -> nick index of MUC room occupants (called from MUC presence handlers).
+        The threaded presence handlers can run out of order (e.g. a quick leave and re-join) so the index is
+        always updated according to the current state of the MUC plugin's room roster.
+        """
+        muc = presence['muc']
+
+        if not muc['jid']:  # Anonymous room
+            return
+
+        jid = self._sleekxmpp_fix_jid(muc['jid']).bare
+        nick = muc['nick']
+
+        with self._room_occupants_lock:
+            if self._get_room_roster_entry(nick, jid) is not None:
+                self._room_occupants[jid] = nick
+            elif self._room_occupants.get(jid) == nick:  # The user could have already re-joined with new nick
+                del self._room_occupants[jid]
 
     def _get_room_member(self, jid):
         """
         Return MUC room member object according to user's bare Jabber ID.
         """
-        for nick in self.muc.rooms[self.room]:
-            entry = self.muc.rooms[self.room][nick]
+        nick = self._room_occupants.get(jid, None)
+
+        if nick is not None:
+            entry = self._get_room_roster_entry(nick, jid)
+
+            if entry is not None:
+                return entry
+
+        # The index is not up-to-date -> search the MUC plugin's room roster
+        for nick, entry in tuple(self.muc.rooms.get(self.room, {}).items()):  # Copy for python 3
+            if entry is not None and entry.get('jid') and self._sleekxmpp_fix_jid(entry['jid']).bare == jid:
+                with self._room_occupants_lock:
+                    self._room_occupants[jid] = nick
 
-            if entry is not None and self._sleekxmpp_fix_jid(entry['jid']).bare == jid:
                 return entry
 
         raise KeyError('User with jabber ID "%s" is not listed on the room member list' % jid)
@@ -681,11 +1079,18 @@ class LudolphBot(LudolphDBMixin):
     def _update_room_users_last_seen(self, jid):
         """Update last seen timestamp of user in chat room"""
         self.room_users_last_seen[jid] = datetime.now()
+        self._db_changed('room_users_last_seen')
 
     def get_jid(self, msg, bare=True):
         """
         Helper method for retrieving Jabber ID from message.
         """
+        if bare:
+            context = getattr(msg, 'context', None)
+
+            if context is not None:  # Already resolved when the message was received
+                return context.jid
+
         if msg['type'] == 'groupchat' and self.room:
             # Room MUC message
             jid = self.muc.getJidProperty(self.room, msg['mucnick'], 'jid')
@@ -700,29 +1105,103 @@ class LudolphBot(LudolphDBMixin):
 
         return jid
 
+    def _compile_jid_roles(self):
+        """
+        Create the JID -> role mask table from users, admins, room_users and room_admins settings.
+        An empty setting means that everybody has the role. The table is replaced at once (reload safe).
+        """
+        roles = {}
+        default = 0
+        settings = ((ROLE_USER, self.users), (ROLE_ADMIN, self.admins),
+                    (ROLE_ROOM_USER, self.room_users), (ROLE_ROOM_ADMIN, self.room_admins))
+
+        for role, jids in settings:
+            if not jids:
+                default |= role
+
+        for role, jids in settings:
+            for jid in jids:
+                roles[jid] = roles.get(jid, default) | role
+
+        self._jid_roles = (roles, default)
+
+    def get_jid_roles(self, jid):
+        """
+        Return role mask (ROLE_* bits) of bare JID (obtained by get_jid()).
+        """
+        roles, default = self._jid_roles
+
+        return roles.get(jid, default)
+
+    def get_request_context(self, msg, jid=None, received=None):
+        """
+        Resolve sender's JID, room nick and roles of an incoming message.
+        """
+        if received is None:
+            received = time.time()
+
+        if jid is None:
+            jid = self.get_jid(msg)
+
+        mtype = msg['type']
+        nick = None
+
+        if self.room:
+            if mtype == 'groupchat':
+                nick = msg['mucnick']
+            elif mtype == 'chat' and msg['from'].bare == self.room:
+                nick = msg['from'].resource
+            elif jid and self.muc:
+                nick = self.get_room_nick(jid)
+
+        return RequestContext(jid, nick, self.get_jid_roles(jid), mtype, received)
+
     def is_jid_user(self, jid):
         """
         Return True if bare JID (obtained by get_jid()) is user or users are not set.
         """
-        return not self.users or jid in self.users
+        return bool(self.get_jid_roles(jid) & ROLE_USER)
 
     def is_jid_admin(self, jid):
         """
         Return True if bare JID (obtained by get_jid()) is admin or admins are not set.
         """
-        return not self.admins or jid in self.admins
+        return bool(self.get_jid_roles(jid) & ROLE_ADMIN)
 
     def is_jid_room_user(self, jid):
         """
         Return True if bare JID (obtained by get_jid()) is user or users are not set.
         """
-        return not self.room_users or jid in self.room_users
+        return bool(self.get_jid_roles(jid) & ROLE_ROOM_USER)
 
     def is_jid_room_admin(self, jid):
         """
         Return True if bare JID (obtained by get_jid()) is admin or admins are not set.
         """
-        return not self.room_admins or jid in self.room_admins
+        return bool(self.get_jid_roles(jid) & ROLE_ROOM_ADMIN)
+
+    def _get_jid_best_resource(self, bare):
+        """Return a (resource, options) tuple of the highest priority resource of a bare JID from roster"""
+        if bare in self.client_roster:
+            resources = self.client_roster[bare].resources
+
+            if resources:
+                return max(tuple(resources.items()), key=lambda x: x[1].get('priority', 0))
+
+        return None, None
+
+    def _presence_update(self, presence):
+        """
+        Update the presence cache entry for a user. Runs in the event thread for every presence stanza right after
+        SleekXMPP has updated the roster, so presence stanzas are processed in order and priority changes are included.
+        """
+        bare = self._sleekxmpp_fix_jid(presence['from']).bare
+        resource = self._get_jid_best_resource(bare)
+
+        if resource[0] is None:
+            self._presence.pop(bare, None)
+        else:
+            self._presence[bare] = resource
 
     def get_jid_resource(self, jid):
         """
@@ -731,16 +1210,18 @@ class LudolphBot(LudolphDBMixin):
         """
         jid = self._sleekxmpp_fix_jid(jid)
 
-        if jid.bare in self.client_roster:
-            buddy = self.client_roster[jid]
-            logger.debug('User "%s has following resources: %s', jid, buddy.resources)
+        if not jid.resource:  # The highest priority resource is cached by the presence event handler
+            try:
+                return self._presence[jid.bare]
+            except KeyError:
+                return self._get_jid_best_resource(jid.bare)
+
+        if jid.bare in self.client_roster:  # A full JID was provided and we already know the resource name
+            resources = self.client_roster[jid].resources
+            logger.debug('User "%s has following resources: %s', jid, resources)
 
-            if buddy.resources:
-                if jid.resource:  # A full JID was provided and we already know the resource name
-                    if jid.resource in buddy.resources:
-                        return jid.resource, buddy.resources[jid.resource]
-                else:
-                    return max(buddy.resources.items(), key=lambda x: x[1].get('priority', 0))
+            if jid.resource in resources:
+                return jid.resource, resources[jid.resource]
 
         return None, None
 
@@ -755,6 +1236,49 @@ class LudolphBot(LudolphDBMixin):
 
         return None
 
+    def get_jid_availability(self, jid):
+        """
+        Return status of a bare JID: offline, online or the show value of the highest priority resource.
+        """
+        resource, options = self.get_jid_resource(jid)
+
+        if resource:
+            return options.get('show') or ONLINE
+
+        return OFFLINE
+
+    def _deferred_flush(self, jid):
+        """Send messages held for a user who became available"""
+        status = self.get_jid_availability(jid)
+
+        if status == OFFLINE or self.deferred.is_deferred(status):
+            return
+
+        mbody, seqs = self.deferred.pop(jid)
+
+        if mbody:
+            logger.info('Sending deferred messages to user "%s"', jid)
+            OutgoingLudolphMessage.create(mbody).send(self, jid)
+            self._outbox_sent(seqs)
+
+    def _msg_defer(self, mto, mbody, outbox_seqs=()):
+        """Hold message for an unavailable roster user. Return True if the message was deferred"""
+        jid = self._sleekxmpp_fix_jid(mto).bare
+
+        if jid not in self.client_roster:  # We would never receive a presence, which flushes the queue
+            return False
+
+        status = self.get_jid_availability(jid)
+
+        if not self.deferred.is_deferred(status):
+            return False
+
+        logger.info('Deferring message for user "%s" because user status=%s', jid, status)
+        self.deferred.add(jid, mbody.mbody if isinstance(mbody, OutgoingLudolphMessage) else str(mbody),
+                          tags=outbox_seqs)
+
+        return True
+
     def has_jid_status(self, jid, status):
         """
         Return True if bare JID is in roster and has a specific status.
@@ -788,17 +1312,85 @@ class LudolphBot(LudolphDBMixin):
             self.client.del_roster_item(user)
 
     # noinspection PyUnusedLocal
+    def client_plugin(self, name):
+        """
+        Return SleekXMPP plugin (e.g. xep_0084). The plugin is registered on first use.
+        """
+        if not self.client.plugin.enabled(name):
+            logger.info('Registering XMPP plugin: %s', name)
+            self.client.register_plugin(name)
+
+        return self.client.plugin[name]
+
+    def _register_client_plugins(self):
+        """Register SleekXMPP plugins required by Ludolph plugins"""
+        for modname, plugin in self.plugins.items():
+            for name in getattr(plugin, 'xmpp_plugins', ()):
+                logger.debug('XMPP plugin %s is required by plugin %s', name, modname)
+                self.client_plugin(name)
+
+    def _startup_finished(self):
+        """Display startup phase timings (--profile-startup)"""
+        timer = self.startup_timer
+
+        if timer.enabled:
+            timer.enabled = False  # Display the report only once
+            report = timer.report()
+            logger.info('Startup profile:\n%s', report)
+            sys.stderr.write('%s\n' % report)
+
     def _session_start(self, event):
         """
         Process the session_start event.
         """
+        self.startup_timer.stop('session start')
+        self._presence.clear()
         self.client.get_roster()
         self._roster_cleanup()
         self.client.send_presence(pnick=self.nick)
 
         if self.room and self.muc:
             logger.info('Initializing multi-user chat room %s', self.room)
+            self.startup_timer.start('muc join')
             self.muc.joinMUC(self.room, self.nick, maxhistory=self.maxhistory)
+        else:
+            self._outbox_replay()
+            self._startup_finished()
+
+    def _disconnected(self, event):
+        """
+        Process the disconnected event.
+        """
+        self._outbox_ready = False
+
+        if self.outbox is not None:
+            self.outbox.unsend()  # Alerts sent recently could be lost together with the connection
+
+    def _outbox_replay(self):
+        """Send alerts waiting in the outbox (called when the session is ready)"""
+        self._outbox_ready = True
+
+        if self.outbox is None:
+            return
+
+        pending = self.outbox.pending()
+
+        if pending:
+            logger.warning('Sending %d alerts from outbox', len(pending))
+
+        for seq, record in pending:
+            self._msg_alert_held(seq, record['to'], record['body'], mtype=record['type'], trigger=record.get('trigger'))
+
+    def _outbox_sent(self, seqs):
+        """Mark alerts carried by a sent message as sent (or return them into the outbox queue if disconnected)"""
+        if self.outbox is None:
+            return
+
+        for seq in seqs:
+            if self._outbox_ready:
+                self.outbox.sent(seq)
+            else:
+                self.outbox.release(seq)
 
     def _roster_cleanup(self):
         """
@@ -845,20 +1437,30 @@ class LudolphBot(LudolphDBMixin):
 
         if cmd:
             start_time = time.time()
-            # Get and run command
-            out = cmd.get_fun(self)(msg)
 
-            if out:
+            try:
+                # Get and run command
+                out = PROFILER.call(cmd.get_fun(self), msg)
+            finally:
                 cmd_time = time.time() - start_time
-                logger.info('Command %s.%s finished in %g seconds', cmd.module, cmd.name, cmd_time)
+                COMMANDS_RUN.labels(cmd.module, cmd.name).inc()
+                COMMAND_SECONDS.labels(cmd.name).observe(cmd_time)
+
+            if out:
+                logger.info('Command %s.%s finished in %g seconds (%g seconds since the message was received)',
+                            cmd.module, cmd.name, cmd_time, msg.context.elapsed)
         else:
+            COMMANDS_NOT_FOUND.inc()
             # Fire the bot_command_not_found event (by default: self._command_not_found())
             self._run_event_handlers('bot_command_not_found', msg, cmd_name)
 
-    def _bot_message(self, msg, types=('chat', 'normal')):
+    def _bot_message(self, msg, types=('chat', 'normal'), jid=None, received=None):
         """
         Incoming message handler.
         """
+        if received is None:
+            received = time.time()
+
         msg_type = msg['type']
 
         if msg_type == 'error':
@@ -874,39 +1476,58 @@ class LudolphBot(LudolphDBMixin):
         if self.is_msg_delayed(msg):
             return  # Ignore delayed messages
 
-        # Wrap around the Message object
-        msg = IncomingLudolphMessage.wrap_msg(msg)
+        TRACER.start('message', started=received, type=msg_type)
+
+        try:
+            # Wrap around the Message object
+            with span('wrap'):
+                msg = IncomingLudolphMessage.wrap_msg(msg)
+
+            with span('context'):
+                msg.context = self.get_request_context(msg, jid=jid, received=received)
+
+            # Fire the bot_message event (by default: self._run_command())
+            self._run_event_handlers('bot_message', msg)
+        finally:
+            TRACER.finish()
 
-        # Fire the bot_message event (by default: self._run_command())
-        self._run_event_handlers('bot_message', msg)
+    def _user_presence_changed(self, jid):
+        """Send messages held for a user whose presence has changed"""
+        jid = self._sleekxmpp_fix_jid(jid).bare
+
+        if jid in self.deferred:
+            self._deferred_flush(jid)
 
     def _user_online(self, presence):
         """
         Process an online presence stanza from a JID.
         """
         logger.info('User "%s" got online (%s)', presence['from'], presence.get_type())
+        self._user_presence_changed(presence['from'])
 
         if presence['from'].bare == self.boundjid.bare:  # Display roster if the bot gets online
             self._roster_cleanup()
 
-    # noinspection PyMethodMayBeStatic
     def _user_offline(self, presence):
         """
         Process an offline presence stanza from a JID.
         """
         logger.info('User "%s" got offline (%s)', presence['from'], presence.get_type())
+        self._user_presence_changed(presence['from'])
 
-    # noinspection PyMethodMayBeStatic
     def _user_changed_status(self, presence):
         """
         Process an status changed presence stanza from a JID.
         """
         logger.info('User "%s" changed status to %s', presence['from'], presence.get_type())
+        self._user_presence_changed(presence['from'])
 
     def _muc_message(self, msg):
         """
         MUC Incoming message handler.
         """
+        received = time.time()
+
         if not self._muc_ready:
             return
 
@@ -920,12 +1541,16 @@ class LudolphBot(LudolphDBMixin):
         # And only if we can get user's JID
         nick = self.nick + ':'
 
-        if msg['body'].startswith(nick) and self.get_jid(msg):
-            msg['body'] = msg['body'][len(nick):].lstrip()
-            self._bot_message(msg, types=('groupchat',))
-        else:
-            # Fire the muc_message event (nothing by default)
-            self._run_event_handlers('muc_message', IncomingLudolphMessage.wrap_msg(msg))
+        if msg['body'].startswith(nick):
+            jid = self.get_jid(msg)
+
+            if jid:
+                msg['body'] = msg['body'][len(nick):].lstrip()
+                self._bot_message(msg, types=('groupchat',), jid=jid, received=received)
+                return
+
+        # Fire the muc_message event (nothing by default)
+        self._run_event_handlers('muc_message', IncomingLudolphMessage.wrap_msg(msg))
 
     def _muc_user_online(self, presence):
         """
@@ -933,6 +1558,8 @@ class LudolphBot(LudolphDBMixin):
         """
         # Configure room and say hello from jabber bot if this is a presence stanza
         if presence['from'] == self.room_jid:
+            self.startup_timer.stop('muc join')
+            self._room_occupants_rebuild()
             self._room_config()
             self.client.send_presence(pto=presence['from'], pnick=self.nick)
             self._muc_ready = True
@@ -960,12 +1587,16 @@ class LudolphBot(LudolphDBMixin):
                             logger.info('Inviting "%s" to MUC room', user)
                             self.muc.invite(self.room, user)
                             self.room_users_invited.add(user)
+                            self._db_changed('room_users_invited')
 
+            self._outbox_replay()
+            self._startup_finished()
         else:
             # Say hello to new user
             muc = presence['muc']
             logger.info('User "%s" with nick "%s", role "%s" and affiliation "%s" is joining MUC room',
                         muc['jid'], muc['nick'], muc['role'], muc['affiliation'])
+            self._room_occupants_update(presence)
             self._update_room_users_last_seen(muc['jid'].bare)
             # Fire the muc_user_online event (nothing by default)
             self._run_event_handlers('muc_user_online', presence)
@@ -978,6 +1609,7 @@ class LudolphBot(LudolphDBMixin):
         muc = presence['muc']
         logger.info('User "%s" with nick "%s", role "%s" and affiliation "%s" is leaving MUC room',
                     muc['jid'], muc['nick'], muc['role'], muc['affiliation'])
+        self._room_occupants_update(presence)
         self._update_room_users_last_seen(muc['jid'].bare)
         # Fire the muc_user_offline event (nothing by default)
         self._run_event_handlers('muc_user_online', presence)
@@ -1005,6 +1637,13 @@ class LudolphBot(LudolphDBMixin):
             logger.exception(e)
             logger.error('Webserver shutdown failed')
 
+        try:
+            if self.ingest:
+                self.ingest.stop()
+        except Exception as e:
+            logger.exception(e)
+            logger.error('Ingestion server shutdown failed')
+
         try:
             if self.cron:
                 self.cron.stop()
@@ -1013,14 +1652,19 @@ class LudolphBot(LudolphDBMixin):
             logger.error('Cron shutdown failed')
 
         try:
-            if self.db is not None:
-                self._db_set_items_all()  # all plugins (including ludolph.bot)
-                self.db.close()
-                self.db_disable()
+            self._db_close()
         except Exception as e:
             logger.exception(e)
             logger.critical('Persistent DB file could not be properly closed')
 
+        try:
+            if self.outbox is not None:
+                self.client.scheduler.remove('ludolph_outbox_confirm')
+                self.outbox.close()
+        except Exception as e:
+            logger.exception(e)
+            logger.critical('Outbox could not be properly closed')
+
         try:
             self._destroy_plugins()
         except Exception as e:
@@ -1035,40 +1679,82 @@ class LudolphBot(LudolphDBMixin):
                 raise SystemExit(99)
             raise
 
-    def prereload(self):
+    def _room_settings(self):
+        """Return MUC room settings, which are applied when joining the room"""
+        return (self.room, self.nick, self.maxhistory, self.room_invites, frozenset(self.room_users),
+                frozenset(self.room_admins), self.room_bot_affiliation, self.room_user_affiliation,
+                self.room_admin_affiliation, self.room_bot_role, self.room_user_role, self.room_admin_role)
+
+    def restart(self):
         """
-        Cleanup during reload phase. Runs before plugin loading in main (called from main.py).
+        Shutdown the bot and start a new Ludolph process (restart is performed in main.py after shutdown).
         """
-        self.commands.reset()
-
-        if self.webserver:
-            self.webserver.reset_webhooks()
-            self.webserver.reset_webapp()
+        logger.warning('Requested restart')
+        self.restarting = True
+        os.kill(os.getpid(), signal.SIGTERM)  # Run the shutdown signal handler in the main thread
 
-        if self.cron:
-            self.cron.reset()
+    def prereload(self, changed=None):
+        """
+        Cleanup during reload phase. Runs before plugin loading in main (called from main.py).
+        The changed parameter is a collection of plugin module names, which are going to be reloaded (default: all).
+        The current commands, webhooks and cron jobs stay in use until reload() publishes the new registry.
+        """
+        self._staged_registry = self._stage_registry(changed=changed)
 
-        if self.db is not None:
-            self._db_set_items_all()  # all plugins (including ludolph.bot)
-            self.db.close()
-            self.db_disable()
+        if self.db is not None:  # The DB file is closed or reopened in reload() only if the dbfile setting changes
+            self._db_set_items_all(force=True)  # all plugins (including ludolph.bot)
+            self.db.flush()  # wait for pending writes
 
-    def reload(self, config, plugins=None):
+    def reload(self, config, plugins=None, changed=None):
         """
-        Reload bot configuration and plugins (called from main.py).
+        Reload bot configuration and plugins (called from main.py). Return list of reinitialized plugins.
+        The changed parameter is a collection of plugin module names, which should be reinitialized (default: all).
         """
         logger.info('Requested reload')
         self._reloaded = True
+        registry, self._staged_registry = self._staged_registry or self._stage_registry(changed=changed), None
+        room_settings = self._room_settings()
         self._load_config(config, init=False)
-        self._load_plugins(config, plugins, init=False)
+        # Initialize new plugins, publish the new registry and then destroy old plugins
+        initialized, replaced = self._load_plugins(config, plugins, init=False, changed=changed, registry=registry)
+        self._publish_registry(registry)
+
+        for modname, plugin in replaced:
+            self._destroy_plugin(modname, plugin)
+
+        self._log_registry()
+        self._register_client_plugins()
+        self._db_checkpoint_schedule()
+        self._alerts_schedule()
 
         if self.room and self.muc:
-            self._muc_ready = False
-            self.muc.leaveMUC(self.room, self.nick)
-            logger.info('Reinitializing multi-user chat room %s', self.room)
-            self.muc.joinMUC(self.room, self.nick, maxhistory=self.maxhistory)
+            if room_settings == self._room_settings():
+                logger.info('Multi-user chat room %s settings have not changed', self.room)
+            else:
+                self._muc_ready = False
+                self.muc.leaveMUC(self.room, self.nick)
+                self._room_occupants_rebuild()
+                logger.info('Reinitializing multi-user chat room %s', self.room)
+                self.muc.joinMUC(self.room, self.nick, maxhistory=self.maxhistory)
+
+        if changed is None:
+            self._post_init_plugins()
+        else:
+            self._post_init_plugins([__name__] + initialized)  # Bot configuration is always reloaded
 
-        self._post_init_plugins()
+        return initialized
+
+    def cancel_reload(self):
+        """
+        Drop the registry created by prereload() after a failed reload (called from main.py).
+        The command, webhook and cronjob decorators register into the published registry again.
+        """
+        logger.error('Reload failed')
+        self._staged_registry = None
+        registry = self._registry
+        ludolph.command.COMMANDS = registry.commands
+        ludolph.web.WEBHOOKS = registry.webhooks
+        ludolph.cron.CRONJOBS = registry.crontab
 
     @staticmethod
     def msg_copy(msg, **kwargs):
@@ -1082,15 +1768,22 @@ class LudolphBot(LudolphDBMixin):
 
         return msg
 
-    def msg_send(self, mto, mbody, mfrom=None, mnick=None, **kwargs):
+    def msg_send(self, mto, mbody, mfrom=None, mnick=None, outbox_seqs=(), **kwargs):
         """
-        Create message and send it.
+        Create message and send it. The outbox_seqs are sequence numbers of outbox alerts carried by the message.
         """
+        if self.deferred.enabled and mto != self.room and self._msg_defer(mto, mbody, outbox_seqs=outbox_seqs):
+            return False
+
         if self.drop_messages_to_dnd_users and mto != self.room and self.has_jid_status(mto, 'dnd'):
             logger.warning('Dropping message for user "%s" because user status=dnd', mto)
+            self._outbox_sent(outbox_seqs)
             return False
 
-        return OutgoingLudolphMessage.create(mbody, **kwargs).send(self, mto, mfrom=mfrom, mnick=mnick)
+        res = OutgoingLudolphMessage.create(mbody, **kwargs).send(self, mto, mfrom=mfrom, mnick=mnick)
+        self._outbox_sent(outbox_seqs)
+
+        return res
 
     def msg_reply(self, msg, mbody, preserve_msg=False, **kwargs):
         """
@@ -1113,6 +1806,41 @@ class LudolphBot(LudolphDBMixin):
 
         return OutgoingLudolphMessage.create(msg['body'], **defaults).send(self, msg['from'], mfrom=msg['to'])
 
+    def msg_alert(self, mto, mbody, mtype='normal', trigger=None, sync=True):
+        """
+        Send alert message received via webhook or ingestion API. Alerts are summarized during alert storms.
+        Alerts with a trigger key (e.g. Zabbix trigger ID) are checked for flapping PROBLEM/OK states.
+        With the outbox enabled, the alert is saved to disk first (sync=False does not wait for the disk write)
+        and sent after reconnect if the bot is disconnected. The alert is marked as sent in the outbox only after
+        a message carrying it (the alert itself, a digest, a flapping summary or deferred messages) is sent.
+        """
+        if self.outbox is None:
+            return self._msg_alert(mto, mbody, mtype=mtype, trigger=trigger)
+
+        seq = self.outbox.append({'to': str(mto), 'body': mbody, 'type': mtype, 'trigger': trigger}, sync=sync)
+
+        if not self._outbox_ready:
+            logger.info('Alert for "%s" was saved to outbox and will be sent after reconnect', mto)
+            return False
+
+        return self._msg_alert_held(seq, mto, mbody, mtype=mtype, trigger=trigger)
+
+    def _msg_alert_held(self, seq, mto, mbody, mtype='normal', trigger=None):
+        """Process outbox alert - it is not replayed while it is held in memory by the alert pipeline"""
+        self.outbox.hold(seq)
+
+        try:
+            return self._msg_alert(mto, mbody, mtype=mtype, trigger=trigger, seqs=(seq,))
+        except Exception:
+            self.outbox.release(seq)
+            raise
+
+    def _msg_alert(self, mto, mbody, mtype='normal', trigger=None, seqs=()):
+        if trigger:
+            return self.flapping.process(mto, mbody, mtype, trigger, seqs=seqs)
+
+        return self.alerts.send(mto, mbody, mtype=mtype, seqs=seqs)
+
     def msg_broadcast(self, mbody, **kwargs):
         """
         Send message to all users in roster.
@@ -1122,7 +1850,9 @@ class LudolphBot(LudolphDBMixin):
 
         for jid in self.client_roster:
             if not (jid == self.boundjid.bare or (self.room and jid == self.room) or jid in self.broadcast_blacklist):
-                if self.drop_messages_to_dnd_users and self.has_jid_status(jid, 'dnd'):
+                if self.deferred.enabled and self._msg_defer(jid, mbody):
+                    i += 1
+                elif self.drop_messages_to_dnd_users and self.has_jid_status(jid, 'dnd'):
                     logger.warning('Dropping broadcast message for user "%s" because user status=dnd', jid)
                 else:
                     msg.send(self, jid)
@@ -7,9 +7,13 @@ See the LICENSE file for copying permission.
 """
 from logging import getLogger
 from functools import wraps
-from collections import namedtuple
+from collections import namedtuple, deque
+from itertools import islice
 import shlex
 import inspect
+import re
+
+from ludolph.tracing import span
 
 __all__ = ('CommandError', 'PermissionDenied', 'MissingParameter', 'command')
 
@@ -37,17 +41,48 @@ class MissingParameter(CommandError):
     error_message = 'Missing parameter'
 
 
-CommandPermissions = namedtuple('CommandPermissions', ('user_required', 'admin_required', 'room_user_required',
-                                                       'room_admin_required'))
+# User roles - bits of the role mask returned by LudolphBot.get_jid_roles()
+ROLE_USER = 1
+ROLE_ADMIN = 2
+ROLE_ROOM_USER = 4
+ROLE_ROOM_ADMIN = 8
+
+
+# noinspection PyClassHasNoInit
+class CommandPermissions(namedtuple('CommandPermissions', ('user_required', 'admin_required', 'room_user_required',
+                                                           'room_admin_required'))):
+    """
+    Roles required to run a command.
+    """
+    __slots__ = ()
+
+    @property
+    def mask(self):
+        """Required roles as bitmask"""
+        mask = 0
+
+        for required, role in ((self.user_required, ROLE_USER), (self.admin_required, ROLE_ADMIN),
+                               (self.room_user_required, ROLE_ROOM_USER), (self.room_admin_required, ROLE_ROOM_ADMIN)):
+            if required:
+                mask |= role
+
+        return mask
+
 
 CommandParameters = namedtuple('CommandParameters', ('args_count', 'kwargs_count', 'star_args'))
 
 
 # noinspection PyClassHasNoInit
-class Command(namedtuple('Command', ('name', 'fun_name', 'module', 'doc', 'perms', 'fun_spec'))):
+class Command(namedtuple('Command', ('name', 'fun_name', 'module', 'doc', 'perms', 'fun_spec', 'perms_mask'))):
     """
-    Ludolph command wrapper.
+    Ludolph command wrapper. The perms_mask field is optional - it is computed from perms by default.
     """
+    def __new__(cls, name, fun_name, module, doc, perms, fun_spec, perms_mask=None):
+        if perms_mask is None:
+            perms_mask = CommandPermissions(*perms).mask
+
+        return super(Command, cls).__new__(cls, name, fun_name, module, doc, perms, fun_spec, perms_mask)
+
     def __str__(self):
         return '%s.%s' % (self.module, self.fun_name)
 
@@ -58,18 +93,14 @@ class Command(namedtuple('Command', ('name', 'fun_name', 'module', 'doc', 'perms
         """Get command bound method from plugin"""
         return getattr(bot.plugins[self.module], self.fun_name)
 
-    def is_jid_permitted_to_run(self, xmpp, jid):
-        """Return True if user is allowed to run the command"""
-        perms = self.perms
+    def is_jid_permitted_to_run(self, xmpp, jid, roles=None):
+        """Return True if user is allowed to run the command. Optional roles is the user's role mask"""
+        mask = self.perms_mask
 
-        for perm, check in ((perms.user_required, xmpp.is_jid_user),
-                            (perms.admin_required, xmpp.is_jid_admin),
-                            (perms.room_user_required, xmpp.is_jid_room_user),
-                            (perms.room_admin_required, xmpp.is_jid_room_admin)):
-            if perm and not check(jid):
-                return False
+        if roles is None:
+            roles = xmpp.get_jid_roles(jid)
 
-        return True
+        return roles & mask == mask
 
     def get_args_from_msg_body(self, body):
         """Parse message body and return a list which can be used as *args parameter for this command"""
@@ -102,12 +133,14 @@ class Commands(dict):
     Command names to (name, module, doc) mapping.
     """
     _cache = None  # Cached sorted list of commands
+    version = 0  # Incremented on every change - can be used for invalidating caches built from commands
 
     def pop(self, key, **kwargs):
         """Properly remove command from dict and cache"""
         cmd = super(Commands, self).pop(key, **kwargs)
 
         if cmd:
+            self.version += 1
             logger.info('Deregistering command "%s" from plugin "%s"', cmd.name, cmd.module)
             if self._cache:
                 try:
@@ -122,6 +155,7 @@ class Commands(dict):
         assert key == cmd.name
         logger.debug('Registering command "%s" from plugin "%s"', cmd.name, cmd.module)
         super(Commands, self).__setitem__(key, cmd)
+        self.version += 1
 
     def __delitem__(self, key):
         """Properly remove command from dict and cache"""
@@ -141,6 +175,7 @@ class Commands(dict):
         else:
             logger.info('Reinitializing commands')
             self.clear()
+            self.version += 1
 
     def all(self, reset=False):
         """List of all available bot commands"""
@@ -177,6 +212,183 @@ class Commands(dict):
 COMMANDS = Commands()  # command : (name, fun_name, module, doc, perms)
 
 
+def _pipe_int_arg(name, args, default=10):
+    """Parse optional line count parameter of head and tail filters"""
+    if not args:
+        return default
+
+    try:
+        num = int(args[0].lstrip('-'))
+    except ValueError:
+        raise CommandError('Invalid parameter for **%s** filter' % name)
+
+    if num < 0:
+        raise CommandError('Invalid parameter for **%s** filter' % name)
+
+    return num
+
+
+def _pipe_grep(args):
+    """grep [-i] [-v] <pattern>"""
+    flags = 0
+    invert = False
+    args = list(args)
+
+    while args and args[0] in ('-i', '-v'):
+        if args.pop(0) == '-i':
+            flags |= re.IGNORECASE
+        else:
+            invert = True
+
+    if not args:
+        raise MissingParameter('Missing pattern for **grep** filter')
+
+    try:
+        rx = re.compile(' '.join(args), flags)
+    except re.error as e:
+        raise CommandError('Invalid pattern for **grep** filter: %s' % e)
+
+    def grep(lines):
+        for line in lines:
+            if bool(rx.search(line)) != invert:
+                yield line
+
+    return grep
+
+
+def _pipe_head(args):
+    """head [lines]"""
+    num = _pipe_int_arg('head', args)
+
+    def head(lines):
+        # islice stops pulling from upstream after num lines -> the upstream generator is closed afterwards
+        return islice(lines, num)
+
+    return head
+
+
+def _pipe_tail(args):
+    """tail [lines]"""
+    num = _pipe_int_arg('tail', args)
+
+    def tail(lines):
+        return iter(deque(lines, maxlen=num))
+
+    return tail
+
+
+def _pipe_count(args):
+    """count"""
+    if args:
+        raise CommandError('The **count** filter does not accept parameters')
+
+    def count(lines):
+        yield str(sum(1 for _ in lines))
+
+    return count
+
+
+def _pipe_sort(args):
+    """sort [-r] [-n]"""
+    reverse = '-r' in args
+    numeric = '-n' in args
+
+    if set(args).difference(('-r', '-n')):
+        raise CommandError('Invalid parameter for **sort** filter')
+
+    def numeric_key(line):
+        try:
+            return 0, float(line.split(None, 1)[0])
+        except (IndexError, ValueError):
+            return 1, line
+
+    def sort(lines):
+        return iter(sorted(lines, key=numeric_key if numeric else None, reverse=reverse))
+
+    return sort
+
+
+PIPE_FILTERS = {  # filter name : filter factory (validates parameters and returns a generator function)
+    'grep': _pipe_grep,
+    'head': _pipe_head,
+    'tail': _pipe_tail,
+    'count': _pipe_count,
+    'sort': _pipe_sort,
+}
+
+
+def _split_pipeline(body):
+    """Split message body by pipe characters, which are not quoted"""
+    parts = []
+    quote = None
+    start = 0
+
+    for i, char in enumerate(body):
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in ('"', "'"):
+            quote = char
+        elif char == '|':
+            parts.append(body[start:i])
+            start = i + 1
+
+    parts.append(body[start:])
+
+    return parts
+
+
+def parse_pipeline(body):
+    """
+    Split command body into the real command and a list of output filters (e.g. "cmd | grep foo | head 5").
+    Only trailing parts starting with a known filter name are treated as filters, so a pipe character in regular
+    command parameters is left alone. Return a (command body, [filter generator functions]) tuple.
+    """
+    if '|' not in body:
+        return body, []
+
+    parts = _split_pipeline(body)
+    filters = []
+
+    while len(parts) > 1:
+        try:
+            args = shlex.split(parts[-1])
+        except ValueError:
+            args = parts[-1].split()
+
+        if not args or args[0].lower() not in PIPE_FILTERS:
+            break
+
+        filters.insert(0, PIPE_FILTERS[args[0].lower()](args[1:]))
+        parts.pop()
+
+    return '|'.join(parts).strip(), filters
+
+
+def run_pipeline(output, filters):
+    """
+    Feed command output (string or generator of lines) through a chain of filter generators and return a list of
+    resulting lines. The command output generator is closed when the filters stop consuming it (e.g. head).
+    """
+    if output is None:
+        lines = iter(())
+    elif isinstance(output, str) or not hasattr(output, '__iter__'):
+        lines = iter(str(output).splitlines())
+    else:
+        lines = iter(output)
+
+    for pipe_filter in filters:
+        lines = pipe_filter(lines)
+
+    try:
+        return list(lines)
+    finally:
+        close = getattr(output, 'close', None)
+
+        if close:
+            close()
+
+
 # noinspection PyShadowingNames
 def command(func=None, stream_output=False, reply_output=True, user_required=True, admin_required=False,
             room_user_required=False, room_admin_required=False, parse_parameters=True):
@@ -228,7 +440,7 @@ def command(func=None, stream_output=False, reply_output=True, user_required=Tru
         # Save module, method name and other command metadata
         perms = CommandPermissions(user_required=user_required, admin_required=admin_required,
                                    room_user_required=room_user_required, room_admin_required=room_admin_required)
-        cmd = Command(name, fun.__name__, fun.__module__, doc, perms, fun_spec)
+        cmd = Command(name, fun.__name__, fun.__module__, doc, perms, fun_spec, perms.mask)
         COMMANDS[name] = cmd
         logger.debug('Registered command "%s" (%s) ::\n perms=%s\n fun_spec=%s', name, cmd, perms, fun_spec)
 
@@ -239,27 +451,53 @@ def command(func=None, stream_output=False, reply_output=True, user_required=Tru
             :type msg: ludolph.message.IncomingLudolphMessage
             """
             xmpp = obj.xmpp
-            user = xmpp.get_jid(msg)
+            context = msg.context
+
+            if context is None:  # Scheduled "at" jobs
+                context = msg.context = xmpp.get_request_context(msg)
+
+            user = context.jid
             body = msg['body'].strip()
             success = False
             reply = msg.get_reply_output(default=reply_output, set_default=True)  # Used for scheduled "at" jobs
             stream = msg.get_stream_output(default=stream_output, set_default=True)  # Used by the commands plugin
+            raw = msg.raw_output  # Used by the HTTP command API - return raw command output and raise errors
 
             try:
-                if cmd.is_jid_permitted_to_run(xmpp, user):
+                with span('permissions'):
+                    permitted = cmd.is_jid_permitted_to_run(xmpp, user, roles=context.roles)
+
+                if permitted:
                     logger.info('User "%s" requested command "%s" (%s) [stream=%s] [reply=%s]',
                                 user, body, cmd, stream, reply)
                 else:
                     logger.warning('Unauthorized command "%s" (%s) from "%s"', body, cmd, user)
                     raise PermissionDenied
 
-                if parse_parameters:  # Parse command parameters
-                    args = cmd.get_args_from_msg_body(body)
+                with span('parse'):
+                    # Strip output filters (cmd | grep ...) from message body
+                    body, pipeline = parse_pipeline(body)
 
-                # Reply with function output
-                response = fun(obj, msg, *args, **kwargs)
+                    if pipeline:
+                        msg['body'] = body
+                        msg.stream_output = True  # Stream-capable commands will yield lines lazily
 
-                if stream:
+                    if parse_parameters:  # Parse command parameters
+                        args = cmd.get_args_from_msg_body(body)
+
+                # Reply with function output
+                with span('command'):
+                    response = fun(obj, msg, *args, **kwargs)
+
+                if raw:
+                    if pipeline:
+                        return run_pipeline(response, pipeline)
+                    return response
+
+                if pipeline:
+                    stream = False  # Only the filtered result is sent
+                    out = '\n'.join(run_pipeline(response, pipeline)) or '(no response)'
+                elif stream:
                     if reply:
                         _out = []
 
@@ -276,9 +514,13 @@ def command(func=None, stream_output=False, reply_output=True, user_required=Tru
                 else:
                     out = response
             except CommandError as e:
+                if raw:
+                    raise
                 out = str(e)
             except Exception as e:
                 logger.exception(e)
+                if raw:
+                    raise
                 out = 'ERROR: Command failed due to internal programming error: %s' % e
             else:
                 success = True
@@ -8,6 +8,7 @@ See the LICENSE file for copying permission.
 """
 import logging
 import time
+import threading
 from datetime import datetime, timedelta
 from functools import wraps
 from collections import namedtuple
@@ -18,6 +19,8 @@ except ImportError:
     # noinspection PyUnresolvedReferences,PyPackageRequirements
     from ordereddict import OrderedDict
 
+from ludolph import metrics
+from ludolph.profiling import PROFILER
 from ludolph.message import IncomingLudolphMessage
 from ludolph.db import LudolphDBMixin
 
@@ -25,6 +28,9 @@ __all__ = ('cronjob',)
 
 logger = logging.getLogger(__name__)
 
+CRON_JOBS = metrics.counter('ludolph_cron_jobs_total', 'Number of executed cron jobs', ('job', 'status'))
+CRON_JOB_SECONDS = metrics.histogram('ludolph_cron_job_seconds', 'Cron job execution time', ('job',))
+
 CronJobFun = namedtuple('CronJobFun', ('name', 'module'))
 
 
@@ -197,6 +203,7 @@ class CronTab(OrderedDict):
     "List" of crontab entries. Each entry is identified by a unique name.
     """
     db = None
+    lock = threading.RLock()  # Shared by all crontabs - onetime jobs are moved into a new crontab during reload
 
     # noinspection PyMethodOverriding
     def __repr__(self):
@@ -239,19 +246,22 @@ class CronTab(OrderedDict):
             raise ValueError('fun must be a callable function')
 
         job = CronJob(name, CronJobFun(fun.__name__, fun.__module__), **kwargs)
-        self[name] = job
 
-        if job.onetime:
-            self.sync()
+        with self.lock:
+            self[name] = job
+
+            if job.onetime:
+                self.sync()
 
         return job
 
     def delete(self, name):
         """Delete named crontab entry"""
-        job = self.pop(name)
+        with self.lock:
+            job = self.pop(name)
 
-        if job.onetime:
-            self.sync()
+            if job.onetime:
+                self.sync()
 
         return job
 
@@ -268,7 +278,8 @@ class CronTab(OrderedDict):
         """Add onetime job into crontab"""
         kwargs['onetime'] = onetime
 
-        return self.add(self.generate_id(), fun, **kwargs)
+        with self.lock:
+            return self.add(self.generate_id(), fun, **kwargs)
 
     def add_at(self, fun, onetime, msg, owner, at_reply_output=True):
         """Add "at" onetime job into crontab"""
@@ -326,15 +337,23 @@ class Cron(LudolphDBMixin):
                         logger.info('Running cron job "%s" (%s) with schedule "%s" as user "%s"',
                                     name, job.fqfn, job.schedule, job.owner)
 
+                        start = time.time()
+
                         try:
-                            res = job.run()
+                            res = PROFILER.call(job.run)
                         except Exception as ex:
                             logger.exception(ex)
                             logger.critical('Error while running cron job "%s" (%s)', name, job.fqfn)
+                            CRON_JOBS.labels(job.fqfn, 'error').inc()
                             continue
                         finally:
+                            CRON_JOB_SECONDS.labels(job.fqfn).observe(time.time() - start)
+
                             if job.onetime:
-                                self.crontab.delete(name)
+                                with CronTab.lock:  # The job could be moved into a new crontab during reload
+                                    self.crontab.delete(name)
+
+                        CRON_JOBS.labels(job.fqfn, 'ok').inc()
 
                         logger.info('Cron job "%s" (%s) output: "%s"', name, job.fqfn, res)
 
@@ -362,13 +381,28 @@ class Cron(LudolphDBMixin):
             logger.info('Deregistering cron jobs from plugin: %s', module)
 
             for name, job in tuple(self.crontab.items()):  # Copy for python 3
-                if job.module == module:
+                if job.module == module and not job.onetime:  # Keep onetime jobs (like clear_cron_jobs)
                     logger.debug('Deregistering cron job "%s" from plugin "%s"', name, job.module)
                     self.crontab.delete(name)
         else:
             logger.info('Reinitializing crontab')
             self.crontab.clear_cron_jobs()
 
+    def publish_crontab(self, crontab):
+        """
+        Replace crontab with a new one (prepared during reload) and move all onetime jobs into it.
+        Onetime jobs are added and deleted under the same lock, so a finished job cannot be moved into the new crontab.
+        """
+        with CronTab.lock:
+            old_crontab = self.crontab
+            crontab.db = old_crontab.db
+
+            for name, job in tuple(old_crontab.items()):  # Copy for python 3
+                if job.onetime:
+                    crontab[name] = job
+
+            self.crontab = crontab
+
     def display_cronjobs(self):
         return self.crontab.display_cron_jobs()
 
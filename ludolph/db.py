@@ -5,23 +5,51 @@ This file is part of Ludolph.
 
 See the file LICENSE for copying permission.
 """
+import os
+import sys
+import time
+import shutil
 import logging
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
 from shelve import Shelf
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
 try:
     import anydbm as dbm
 except ImportError:
     import dbm
 
+try:
+    # noinspection PyCompatibility
+    from collections.abc import MutableMapping
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from collections import MutableMapping
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from ordereddict import OrderedDict
+
 logger = logging.getLogger(__name__)
 
-__all__ = ('LudolphDB', 'LudolphDBMixin')
+__all__ = ('LudolphDB', 'LudolphSQLiteDB', 'LudolphDBWriter', 'LudolphDBMixin', 'open_db')
 
 
 class LudolphDB(Shelf):
     """
     Dictionary-like object used for saving/loading persistent data.
     """
+    dbm_suffixes = ('', '.db', '.dir', '.pag', '.dat', '.bak')  # File names created by various dbm implementations
+
     def __init__(self, filename, flag='c', protocol=None, writeback=False):
         self.filename = filename
         logger.info('Opening persistent DB file %s', filename)
@@ -35,6 +63,24 @@ class LudolphDB(Shelf):
         logger.debug('Removing key "%s" from persistent DB', key)
         Shelf.__delitem__(self, key)
 
+    def set_raw(self, key, data):
+        """Assign already pickled data to persistent DB key"""
+        keyencoding = getattr(self, 'keyencoding', None)  # Python 3 only
+
+        if self.writeback:
+            self.cache.pop(key, None)
+
+        if keyencoding:
+            self.dict[key.encode(keyencoding)] = data
+        else:
+            self.dict[key] = data
+
+    @contextmanager
+    def transaction(self):
+        """Group several writes - the DB file is synced at the end"""
+        yield self
+        self.sync()
+
     def sync(self):
         logger.info('Syncing persistent DB file %s', self.filename)
         Shelf.sync(self)
@@ -43,6 +89,432 @@ class LudolphDB(Shelf):
         logger.info('Closing persistent DB file %s', self.filename)
         Shelf.close(self)
 
+    def _files(self, filename=None):
+        """Return list of existing dbm files"""
+        filename = filename or self.filename
+
+        return [filename + suffix for suffix in self.dbm_suffixes if os.path.isfile(filename + suffix)]
+
+    def size(self):
+        """Return size of DB file(s) in bytes"""
+        return sum(os.path.getsize(f) for f in self._files())
+
+    def compact(self):
+        """
+        Copy all data into a fresh dbm file, which atomically replaces the current DB file.
+        Return DB size before and after compaction.
+        """
+        size_before = self.size()
+        tmpdir = tempfile.mkdtemp(prefix='.ludolph-compact-', dir=os.path.dirname(os.path.abspath(self.filename)))
+        tmpfile = os.path.join(tmpdir, os.path.basename(self.filename))
+        logger.info('Compacting persistent DB file %s', self.filename)
+
+        try:
+            Shelf.sync(self)
+            new_db = dbm.open(tmpfile, 'n', mode=0o600)
+
+            try:
+                for key in self.dict.keys():
+                    new_db[key] = self.dict[key]
+            finally:
+                new_db.close()
+
+            self.dict.close()
+
+            try:
+                for f in self._files(tmpfile):
+                    os.rename(f, self.filename + f[len(tmpfile):])
+            finally:
+                self.dict = dbm.open(self.filename, 'w', mode=0o600)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+        return size_before, self.size()
+
+
+class LudolphSQLiteDB(MutableMapping):
+    """
+    Dictionary-like object used for saving/loading persistent data into a SQLite database (WAL mode).
+    Each key is stored in its own row, so writing one key does not touch other data.
+    """
+    table = 'ludolph'
+
+    def __init__(self, filename, protocol=pickle.HIGHEST_PROTOCOL):
+        self.filename = filename
+        self.protocol = protocol
+        self._lock = threading.RLock()
+        self._transaction = 0
+        logger.info('Opening persistent SQLite DB file %s', filename)
+        # Autocommit mode - transactions are controlled by the transaction() context manager
+        self._conn = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, value BLOB NOT NULL)' % self.table)
+
+    def _execute(self, sql, *params):
+        """Execute statement and return the number of changed rows"""
+        with self._lock:
+            return self._conn.execute(sql % self.table, params).rowcount
+
+    def _fetchone(self, sql, *params):
+        """Execute query and return the first row (the connection is shared by threads - fetch under lock)"""
+        with self._lock:
+            return self._conn.execute(sql % self.table, params).fetchone()
+
+    def _fetchall(self, sql, *params):
+        """Execute query and return all rows"""
+        with self._lock:
+            return self._conn.execute(sql % self.table, params).fetchall()
+
+    def __getitem__(self, key):
+        row = self._fetchone('SELECT value FROM %s WHERE key = ?', key)
+
+        if row is None:
+            raise KeyError(key)
+
+        return pickle.loads(bytes(row[0]))
+
+    def __setitem__(self, key, value):
+        logger.debug('Assigning item %r to persistent DB key "%s"', value, key)
+        data = sqlite3.Binary(pickle.dumps(value, self.protocol))
+        self._execute('INSERT OR REPLACE INTO %s (key, value) VALUES (?, ?)', key, data)
+
+    def set_raw(self, key, data):
+        """Assign already pickled data to persistent DB key"""
+        self._execute('INSERT OR REPLACE INTO %s (key, value) VALUES (?, ?)', key, sqlite3.Binary(data))
+
+    def __delitem__(self, key):
+        logger.debug('Removing key "%s" from persistent DB', key)
+
+        if not self._execute('DELETE FROM %s WHERE key = ?', key):
+            raise KeyError(key)
+
+    def __iter__(self):
+        return iter([row[0] for row in self._fetchall('SELECT key FROM %s')])
+
+    def __len__(self):
+        return self._fetchone('SELECT COUNT(*) FROM %s')[0]
+
+    def __contains__(self, key):
+        return self._fetchone('SELECT 1 FROM %s WHERE key = ?', key) is not None
+
+    @contextmanager
+    def transaction(self):
+        """Group several writes into one atomic transaction (one disk sync)"""
+        with self._lock:
+            outer = not self._transaction
+
+            if outer:
+                self._conn.execute('BEGIN IMMEDIATE')
+
+            self._transaction += 1
+
+            try:
+                yield self
+            except Exception:
+                self._transaction -= 1
+
+                if outer:
+                    self._conn.execute('ROLLBACK')
+                raise
+            else:
+                self._transaction -= 1
+
+                if outer:
+                    self._conn.execute('COMMIT')
+
+    def update(self, *args, **kwargs):
+        """Batched update of several keys in one transaction"""
+        with self.transaction():
+            super(LudolphSQLiteDB, self).update(*args, **kwargs)
+
+    def sync(self):
+        logger.info('Syncing persistent DB file %s', self.filename)
+
+        with self._lock:
+            if not self._transaction:
+                self._conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+    def close(self):
+        logger.info('Closing persistent DB file %s', self.filename)
+
+        with self._lock:
+            self._conn.close()
+
+    def size(self):
+        """Return size of DB file (including the WAL file) in bytes"""
+        return sum(os.path.getsize(f) for f in (self.filename, self.filename + '-wal') if os.path.isfile(f))
+
+    def compact(self):
+        """Rebuild the DB file (VACUUM) and truncate the WAL file. Return DB size before and after compaction"""
+        size_before = self.size()
+        logger.info('Compacting persistent DB file %s', self.filename)
+
+        with self._lock:
+            if self._transaction:
+                raise RuntimeError('Cannot compact persistent DB during a transaction')
+
+            self._conn.execute('VACUUM')
+            self._conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+        return size_before, self.size()
+
+    def import_shelf(self, filename):
+        """Copy all data from an existing shelve DB file (LudolphDB) and return the number of imported keys"""
+        shelf = LudolphDB(filename, flag='r')
+
+        try:
+            with self.transaction():
+                for key in shelf.keys():
+                    self[key] = shelf[key]
+
+                return len(shelf)
+        finally:
+            shelf.close()
+
+
+class LudolphDBWriter(MutableMapping):
+    """
+    Persistent DB wrapper, which performs all writes in one dedicated writer thread.
+    Values are pickled in the caller's thread and repeated writes to the same key within the write delay window are
+    coalesced. Pending writes are written in one transaction followed by one disk sync. Reads see pending writes.
+    A failed batch is queued again (unless newer data are queued for the same key) and retried by the next write,
+    sync() or flush().
+    """
+    delay = 0.5  # Write coalescing window in seconds
+    _deleted = object()
+
+    def __init__(self, db, delay=None):
+        self.db = db
+        self.filename = db.filename
+
+        if delay is not None:
+            self.delay = delay
+
+        self._db_lock = threading.RLock()  # Backend access (dbm is not thread-safe)
+        self._cond = threading.Condition(threading.Lock())
+        self._pending = OrderedDict()  # {key : pickled data or _deleted} - waiting for the writer thread
+        self._writing = {}  # {key : pickled data or _deleted} - being written by the writer thread
+        self._urgent = False
+        self._retry = False  # Failed writes are waiting in _pending for the next write, sync or flush
+        self._running = True
+        self._queued = 0  # Number of queued writes
+        self._written = 0  # Number of queued writes already processed by the writer thread
+        self._thread = threading.Thread(target=self._run, name='LudolphDBWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __repr__(self):
+        return '%s(%r, pending=%d)' % (self.__class__.__name__, self.db, len(self._pending))
+
+    def _queue(self, key, data):
+        with self._cond:
+            if not self._running:
+                raise ValueError('Persistent DB writer is closed')
+
+            wakeup = not self._pending or self._retry
+            self._retry = False
+            self._pending.pop(key, None)  # Coalesce (the key will be written after other pending keys)
+            self._pending[key] = data
+            self._queued += 1
+
+            if wakeup:  # Start the coalescing window - other writes join it without waking up the writer thread
+                self._cond.notify_all()
+
+    def _get_queued(self, key):
+        """Return queued data for key or raise KeyError"""
+        with self._cond:
+            try:
+                return self._pending[key]
+            except KeyError:
+                return self._writing[key]
+
+    def _write(self, batch):
+        """Write a batch of pending items into persistent DB and return True on success (writer thread)"""
+        logger.debug('Writing %d key(s) into persistent DB file %s', len(batch), self.filename)
+
+        try:
+            with self._db_lock:
+                with self.db.transaction():
+                    for key, data in batch.items():
+                        if data is self._deleted:
+                            self.db.pop(key, None)
+                        else:
+                            self.db.set_raw(key, data)
+        except Exception as exc:
+            logger.exception(exc)
+            logger.critical('Could not write %d key(s) into persistent DB file %s', len(batch), self.filename)
+            return False
+
+        return True
+
+    def _requeue(self, batch):
+        """Queue a failed batch again - newer pending data for the same key take precedence (under lock)"""
+        failed = OrderedDict((key, data) for key, data in batch.items() if key not in self._pending)
+
+        if failed:
+            failed.update(self._pending)
+            self._pending = failed
+            self._queued += len(failed)  # Next flush() waits for the retry
+            self._retry = True
+            logger.warning('Will retry writing %d key(s) into persistent DB file %s', len(failed), self.filename)
+
+    def _run(self):
+        """Writer thread"""
+        while True:
+            with self._cond:
+                while self._running and (not self._pending or (self._retry and not self._urgent)):
+                    self._cond.wait()
+
+                if not self._pending:  # Closed and nothing to write
+                    break
+
+                deadline = time.time() + self.delay
+
+                while self._running and not self._urgent:  # Coalescing window (can be ended by sync/flush/close)
+                    timeout = deadline - time.time()
+
+                    if timeout <= 0:
+                        break
+
+                    self._cond.wait(timeout)
+
+                batch, self._pending = self._pending, OrderedDict()
+                self._writing = batch
+                self._urgent = self._retry = False
+                queued = self._queued
+
+            ok = self._write(batch)
+
+            with self._cond:
+                self._writing = {}
+
+                if not ok and self._running:  # Failed writes are dropped when closing
+                    self._requeue(batch)
+
+                self._written = queued
+                self._cond.notify_all()
+
+    def __getitem__(self, key):
+        try:
+            data = self._get_queued(key)
+        except KeyError:
+            with self._db_lock:
+                return self.db[key]
+
+        if data is self._deleted:
+            raise KeyError(key)
+
+        return pickle.loads(data)
+
+    def __setitem__(self, key, value):
+        logger.debug('Queuing item %r for persistent DB key "%s"', value, key)
+        self._queue(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+
+        logger.debug('Queuing removal of key "%s" from persistent DB', key)
+        self._queue(key, self._deleted)
+
+    def __iter__(self):
+        with self._cond:
+            queued = dict(self._writing)
+            queued.update(self._pending)
+
+        with self._db_lock:
+            keys = set(self.db.keys())
+
+        keys.update(key for key, data in queued.items() if data is not self._deleted)
+        keys.difference_update(key for key, data in queued.items() if data is self._deleted)
+
+        return iter(keys)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __contains__(self, key):
+        try:
+            return self._get_queued(key) is not self._deleted
+        except KeyError:
+            with self._db_lock:
+                return key in self.db
+
+    @contextmanager
+    def transaction(self):
+        """Writes are always grouped by the writer thread"""
+        yield self
+
+    def sync(self):
+        """Write pending items now (does not wait for the write to finish)"""
+        with self._cond:
+            self._urgent = True
+            self._cond.notify_all()
+
+    def flush(self):
+        """Write pending items and wait until they are stored in persistent DB (barrier)"""
+        with self._cond:
+            target = self._queued
+
+            while self._written < target and self._thread.is_alive():
+                self._urgent = True
+                self._cond.notify_all()
+                self._cond.wait(1)
+
+        with self._db_lock:
+            self.db.sync()
+
+    def size(self):
+        with self._db_lock:
+            return self.db.size()
+
+    def compact(self):
+        """Write pending items and compact persistent DB"""
+        self.flush()
+
+        with self._db_lock:
+            return self.db.compact()
+
+    def close(self):
+        """Write pending items, stop the writer thread and close persistent DB"""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+        self._thread.join()
+
+        with self._db_lock:
+            self.db.close()
+
+
+DB_BACKENDS = {
+    'shelve': LudolphDB,
+    'sqlite': LudolphSQLiteDB,
+}
+
+
+def open_db(dbfile, writer=False):
+    """
+    Open persistent DB according to the dbfile setting. The DB backend can be selected by an URL scheme, e.g.
+    sqlite:///var/lib/ludolph/ludolph.db. A plain file name is opened by the default shelve backend.
+    The writer parameter wraps the DB backend into a LudolphDBWriter (dedicated writer thread).
+    """
+    if '://' in dbfile:
+        scheme, filename = dbfile.split('://', 1)
+    else:
+        scheme, filename = 'shelve', dbfile
+
+    try:
+        backend = DB_BACKENDS[scheme]
+    except KeyError:
+        raise ValueError('Unsupported persistent DB backend: %s' % scheme)
+
+    if writer:
+        return LudolphDBWriter(backend(filename))
+
+    return backend(filename)
+
 
 class LudolphDBMixin(object):
     """
@@ -76,3 +548,29 @@ class LudolphDBMixin(object):
     def db_disable(self):
         """Disable DB support in your object"""
         self.db = None
+
+
+def main():
+    """
+    Import data from a shelve DB file into another persistent DB.
+    Usage: python -m ludolph.db <shelve file> <dbfile>
+    """
+    if len(sys.argv) != 3:
+        sys.stderr.write('Usage: python -m ludolph.db <shelve file> <dbfile>\n')
+        sys.exit(1)
+
+    db = open_db(sys.argv[2])
+
+    try:
+        if not hasattr(db, 'import_shelf'):
+            sys.stderr.write('The target persistent DB backend does not support imports\n')
+            sys.exit(1)
+
+        count = db.import_shelf(sys.argv[1])
+        sys.stdout.write('Imported %d key(s) from %s into %s\n' % (count, sys.argv[1], sys.argv[2]))
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
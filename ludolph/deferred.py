@@ -0,0 +1,118 @@
+"""
+Ludolph: Monitoring Jabber bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the file LICENSE for copying permission.
+"""
+import time
+import logging
+from threading import Lock
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # noinspection PyUnresolvedReferences,PyPackageRequirements
+    from ordereddict import OrderedDict
+
+__all__ = ('DeferredMessages',)
+
+logger = logging.getLogger(__name__)
+
+OFFLINE = 'offline'
+ONLINE = 'online'
+STATUSES = frozenset([OFFLINE, 'away', 'xa', 'dnd'])  # Statuses for which messages can be deferred
+
+
+class DeferredMessages(object):
+    """
+    Per-user queues of messages held while the user is offline or has a selected status (e.g. dnd).
+    Duplicate messages are coalesced and the oldest messages are dropped when the queue is full.
+    All held messages are delivered as one combined message when the user becomes available.
+    """
+    maxsize = 50  # Maximum number of different messages held per user
+
+    def __init__(self, statuses=()):
+        self.statuses = frozenset(statuses)
+        self._queues = {}  # {bare JID : OrderedDict({text : [first timestamp, count]})}
+        self._dropped = {}  # {bare JID : number of dropped messages}
+        self._tags = {}  # {bare JID : list of tags (outbox sequence numbers) of held messages}
+        self._lock = Lock()
+
+    def __contains__(self, jid):
+        return jid in self._queues
+
+    def __len__(self):
+        """Number of held messages"""
+        return sum(len(queue) for queue in tuple(self._queues.values()))
+
+    @property
+    def enabled(self):
+        return bool(self.statuses)
+
+    def set_statuses(self, statuses):
+        """Set statuses for which messages are deferred (invalid statuses are ignored)"""
+        statuses = frozenset(statuses)
+        invalid = statuses.difference(STATUSES)
+
+        if invalid:
+            logger.error('Ignoring invalid statuses for deferred messages: %s', ', '.join(invalid))
+
+        self.statuses = statuses.intersection(STATUSES)
+
+    def is_deferred(self, status):
+        """Return True if messages to users with status (offline, online or the show value) should be deferred"""
+        return status in self.statuses
+
+    def add(self, jid, text, tags=()):
+        """Hold message for a user. Tags are returned by pop() together with the combined message"""
+        now = time.time()
+
+        with self._lock:
+            if tags:
+                self._tags.setdefault(jid, []).extend(tags)
+
+            queue = self._queues.get(jid, None)
+
+            if queue is None:
+                queue = self._queues[jid] = OrderedDict()
+
+            item = queue.get(text, None)
+
+            if item is None:
+                queue[text] = [now, 1]
+
+                while len(queue) > self.maxsize:
+                    queue.popitem(last=False)
+                    self._dropped[jid] = self._dropped.get(jid, 0) + 1
+            else:
+                item[1] += 1
+
+    def pop(self, jid):
+        """
+        Remove all messages held for a user and return them combined into one message text (or None) together with
+        the list of their tags.
+        """
+        with self._lock:
+            queue = self._queues.pop(jid, None)
+            dropped = self._dropped.pop(jid, 0)
+            tags = self._tags.pop(jid, [])
+
+        if not queue:
+            return None, tags
+
+        count = sum(item[1] for item in queue.values()) + dropped
+        lines = ['**%d %s received while you were away:**' % (count, 'message' if count == 1 else 'messages')]
+
+        for text, (timestamp, repeated) in queue.items():
+            line = '[%s] %s' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)), text)
+
+            if repeated > 1:
+                line += ' __(%dx)__' % repeated
+
+            lines.append(line)
+
+        if dropped:
+            lines.append('__(%d older messages were dropped)__' % dropped)
+
+        return '\n'.join(lines), tags
@@ -0,0 +1,340 @@
+"""
+Ludolph: Monitoring Jabber bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the file LICENSE for copying permission.
+
+Local message ingestion API - a Unix domain socket accepting newline-delimited JSON requests.
+Every request is one JSON object on a single line:
+
+    {"type": "message", "jid": "user@example.com", "msg": "Hello"}
+    {"type": "broadcast", "msg": "Hello everybody"}
+    {"type": "room", "msg": "Hello room"}
+    {"type": "message", "jid": "user@example.com", "msg": "PROBLEM: Disk full", "trigger": "13522"}
+
+An optional "id" is copied into the response. Requests can be pipelined (sent without waiting for a response)
+and responses are sent back in the same order, one JSON object per line:
+
+    {"id": 1, "ok": true, "result": "Message sent to user@example.com"}
+    {"id": 2, "ok": false, "error": "User \"foo@example.com\" not in roster"}
+
+The ludolph-send command line client (main() below) sends many messages over one connection.
+"""
+import os
+import sys
+import json
+import stat
+import socket
+import logging
+import argparse
+from select import select
+
+try:
+    # noinspection PyCompatibility
+    import socketserver
+except ImportError:
+    # noinspection PyCompatibility,PyUnresolvedReferences
+    import SocketServer as socketserver
+
+__all__ = ('IngestServer', 'IngestClient', 'IngestError')
+
+logger = logging.getLogger(__name__)
+
+MAX_LINE = 1048576  # Maximum size of one request in bytes
+
+
+class IngestError(Exception):
+    """Invalid ingestion request"""
+    pass
+
+
+class IngestRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Process requests from one connection. Responses are buffered and flushed when there is no more pending input,
+    so a batch of pipelined requests is answered with a few send() calls.
+    """
+    wbufsize = 65536
+
+    def _input_pending(self):
+        return bool(select([self.connection], [], [], 0)[0])
+
+    def handle(self):
+        ingest = self.server.ingest
+
+        while True:
+            line = self.rfile.readline(MAX_LINE + 1)
+
+            if not line:
+                break
+
+            if len(line) > MAX_LINE and not line.endswith(b'\n'):
+                self.wfile.write(ingest.error_response(None, 'Request too large'))
+                break
+
+            if line.strip():
+                self.wfile.write(ingest.process(line))
+
+            if not self._input_pending():
+                ingest.sync()
+                self.wfile.flush()
+
+
+class _UnixStreamServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    ingest = None
+
+
+class IngestServer(object):
+    """
+    Unix domain socket server for local message submission. Like the WebServer, but without HTTP.
+    """
+    server = None
+
+    def __init__(self, xmpp, path, mode=0o660):
+        self.xmpp = xmpp
+        self.path = path
+        self.mode = mode
+
+    def _remove_stale_socket(self):
+        try:
+            if stat.S_ISSOCK(os.stat(self.path).st_mode):
+                logger.warning('Removing stale ingestion socket %s', self.path)
+                os.unlink(self.path)
+        except OSError:  # Does not exist
+            pass
+
+    def start(self):
+        assert self.server is None, 'Ingestion server is already running?'
+        logger.info('Starting ingestion server on %s', self.path)
+        self._remove_stale_socket()
+        self.server = _UnixStreamServer(self.path, IngestRequestHandler)
+        self.server.ingest = self
+        os.chmod(self.path, self.mode)
+        self.server.serve_forever()
+
+    def stop(self):
+        logger.info('Stopping ingestion server')
+
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _response(res):
+        return (json.dumps(res) + '\n').encode('utf-8')
+
+    def sync(self):
+        """Wait until accepted alerts are saved in the outbox (group commit for a batch of requests)"""
+        outbox = getattr(self.xmpp, 'outbox', None)
+
+        if outbox is not None:
+            outbox.sync()
+
+    def error_response(self, req_id, error):
+        return self._response({'id': req_id, 'ok': False, 'error': str(error)})
+
+    def process(self, line):
+        """Process one request line and return the response line"""
+        req_id = None
+
+        try:
+            try:
+                req = json.loads(line.decode('utf-8'))
+            except ValueError:
+                raise IngestError('Invalid JSON')
+
+            if not isinstance(req, dict):
+                raise IngestError('Request must be a JSON object')
+
+            req_id = req.get('id', None)
+            result = self.dispatch(req)
+        except IngestError as e:
+            logger.warning('Ingestion request failed: %s', e)
+            return self.error_response(req_id, e)
+        except Exception as e:
+            logger.exception(e)
+            return self.error_response(req_id, 'Internal error: %s' % e)
+        else:
+            return self._response({'id': req_id, 'ok': True, 'result': result})
+
+    def dispatch(self, req):
+        """Send the message. Same semantics as the /message, /broadcast and /room webhooks"""
+        xmpp = self.xmpp
+        req_type = req.get('type', 'message')
+        msg = req.get('msg', None)
+
+        if req_type == 'message':
+            jid = req.get('jid', None)
+
+            if not jid:
+                raise IngestError('Missing JID in message request')
+
+            if jid == xmpp.room:
+                mtype = 'groupchat'
+            elif jid in xmpp.client_roster:
+                mtype = 'normal'
+            else:
+                raise IngestError('User "%s" not in roster' % jid)
+
+            logger.debug('Ingestion: Sending message to "%s"', jid)
+            xmpp.msg_alert(jid, msg or '', mtype=mtype, trigger=req.get('trigger', None), sync=False)
+
+            return 'Message sent to %s' % jid
+
+        if not msg:
+            raise IngestError('Missing msg parameter')
+
+        if req_type == 'broadcast':
+            return 'Message sent (%dx)' % xmpp.msg_broadcast(msg)
+
+        if req_type == 'room':
+            if not xmpp.room:
+                raise IngestError('Multi-user chat support is disabled')
+
+            xmpp.msg_alert(xmpp.room, msg, mtype='groupchat', trigger=req.get('trigger', None), sync=False)
+
+            return 'Message sent'
+
+        raise IngestError('Unknown request type "%s"' % req_type)
+
+
+class IngestClient(object):
+    """
+    Client for the ingestion API. Requests are pipelined - at most window requests are waiting for a response.
+    """
+    sock = None
+
+    def __init__(self, path, timeout=30, window=256):
+        self.path = path
+        self.timeout = timeout
+        self.window = window
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+        self._wfile = self.sock.makefile('wb')
+        self._rfile = self.sock.makefile('rb')
+
+    def close(self):
+        if self.sock:
+            self._wfile.close()
+            self._rfile.close()
+            self.sock.close()
+            self.sock = None
+
+    def _read_response(self):
+        line = self._rfile.readline()
+
+        if not line:
+            raise IngestError('Connection closed by Ludolph')
+
+        return json.loads(line.decode('utf-8'))
+
+    def send(self, requests):
+        """Send an iterable of requests (dicts) and yield responses in the same order"""
+        pending = 0
+
+        for req in requests:
+            self._wfile.write((json.dumps(req) + '\n').encode('utf-8'))
+            pending += 1
+
+            if pending >= self.window:
+                self._wfile.flush()
+                yield self._read_response()
+                pending -= 1
+
+        self._wfile.flush()
+
+        while pending:
+            yield self._read_response()
+            pending -= 1
+
+
+def _read_requests(args, stream):
+    """Create requests from command line arguments or from lines of the input stream"""
+    if args.type == 'message' and not args.jid and not args.json:
+        raise IngestError('Missing JID')
+
+    def create(text):
+        req = {'type': args.type, 'msg': text}
+
+        if args.type == 'message':
+            req['jid'] = args.jid
+
+        return req
+
+    if args.msg is not None:
+        yield create(args.msg)
+        return
+
+    for line in stream:
+        line = line.rstrip('\r\n')
+
+        if not line:
+            continue
+
+        if args.json:
+            yield json.loads(line)
+        else:
+            yield create(line.replace('\\n', '\n'))
+
+
+def main(argv=None):
+    """
+    Send messages via the local ingestion socket.
+    Usage: ludolph-send [-s socket] [-b | -r | -j] [jid] [msg]
+    Without msg, every line of the standard input is sent as a separate message over one connection.
+    """
+    parser = argparse.ArgumentParser(prog='ludolph-send', description='Send messages via Ludolph.')
+    parser.add_argument('-s', '--socket', default=os.environ.get('LUDOLPH_SOCKET', '/run/ludolph/ludolph.sock'),
+                        help='path to the ingestion socket ([global] socket option in ludolph.cfg)')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('-b', '--broadcast', dest='type', action='store_const', const='broadcast', default='message',
+                       help='send private message to every user in roster')
+    group.add_argument('-r', '--room', dest='type', action='store_const', const='room',
+                       help='send message to the chat room')
+    group.add_argument('-j', '--json', action='store_true', help='read raw JSON requests from standard input')
+    parser.add_argument('-q', '--quiet', action='store_true', help='print only errors')
+    parser.add_argument('args', nargs='*', metavar='[jid] [msg]')
+    args = parser.parse_args(argv)
+
+    pos = list(args.args)
+    args.jid = pos.pop(0) if args.type == 'message' and not args.json and pos else None
+    args.msg = ' '.join(pos) if pos else None
+    errors = 0
+
+    try:
+        with IngestClient(args.socket) as client:
+            for res in client.send(_read_requests(args, sys.stdin)):
+                if res.get('ok'):
+                    if not args.quiet:
+                        sys.stdout.write('%s\n' % res.get('result'))
+                else:
+                    errors += 1
+                    sys.stderr.write('ERROR: %s\n' % res.get('error'))
+    except (IngestError, ValueError) as e:
+        sys.stderr.write('ERROR: %s\n' % e)
+        return 2
+    except (socket.error, OSError) as e:
+        sys.stderr.write('ERROR: Could not connect to %s: %s\n' % (args.socket, e))
+        return 2
+
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,6 +9,7 @@ See the LICENSE file for copying permission.
 import os
 import re
 import sys
+import time
 import signal
 import logging
 from collections import namedtuple
@@ -27,8 +28,9 @@ except ImportError:
     # noinspection PyUnresolvedReferences
     from imp import reload
 
-from ludolph.utils import parse_loglevel
+from ludolph.utils import parse_loglevel, PhaseTimer
 from ludolph.bot import LudolphBot
+from ludolph.web import LISTEN_FD_ENV, get_inherited_listen_fd
 from ludolph.plugins.plugin import LudolphPlugin
 from ludolph import __version__
 
@@ -39,7 +41,175 @@ logger = logging.getLogger('ludolph.main')
 Plugin = namedtuple('Plugin', ('name', 'module', 'cls'))
 
 
-def daemonize():
+def get_plugin_module(config_section):
+    """
+    Return plugin module name and plugin name for a plugin config section.
+    """
+    parsed_plugin = config_section.split('.')
+
+    if len(parsed_plugin) == 1:
+        return 'ludolph.plugins.' + config_section, config_section
+    else:
+        return config_section, parsed_plugin[-1]
+
+
+def get_module_mtime(module):
+    """
+    Return modification time of module source file or None.
+    """
+    filename = getattr(module, '__file__', None)
+
+    if not filename:
+        return None
+
+    if filename.endswith(('.pyc', '.pyo')):
+        filename = filename[:-1]
+
+    try:
+        return os.path.getmtime(filename)
+    except OSError:
+        return None
+
+
+def get_open_fds():
+    """
+    Return list of open file descriptors or None if the information is not available (no /proc filesystem).
+    """
+    for fd_dir in ('/proc/self/fd', '/dev/fd'):
+        try:
+            return [int(fd) for fd in os.listdir(fd_dir)]
+        except (OSError, ValueError):
+            continue
+
+    return None
+
+
+def close_fds(keep_fds=()):
+    """
+    Close all open file descriptors except keep_fds. Only really open descriptors are closed, because iterating up
+    to the RLIMIT_NOFILE limit is very slow in environments with a huge limit (systemd, containers).
+    """
+    fds = get_open_fds()
+
+    if fds is None:
+        import resource  # Resource usage information
+        maxfd = resource.getrlimit(resource.RLIMIT_NOFILE)[1]
+        if maxfd == resource.RLIM_INFINITY:
+            maxfd = 1024
+
+        low = 0
+
+        for fd in sorted(keep_fds):  # Uses the close_range() syscall on recent Python/Linux
+            os.closerange(low, fd)
+            low = fd + 1
+
+        os.closerange(low, maxfd)
+    else:
+        for fd in fds:
+            if fd in keep_fds:
+                continue
+
+            try:
+                os.close(fd)
+            except OSError:  # ERROR, fd wasn't open (e.g. the descriptor used for listing the fd directory)
+                pass
+
+
+def get_changed_plugins(old_config, new_config, base_sections):
+    """
+    Return set of plugin module names with a changed config section or module source file (used during reload).
+    Return None (all plugins are changed) if some of the base_sections (bot configuration) has changed.
+    """
+    changed = set()
+
+    for config_section in set(old_config.sections()).union(new_config.sections()):
+        config_section = config_section.strip()
+
+        if config_section not in base_sections:
+            continue
+
+        if not (old_config.has_section(config_section) and new_config.has_section(config_section)) or \
+                dict(old_config.items(config_section)) != dict(new_config.items(config_section)):
+            logger.info('Bot configuration section [%s] has changed', config_section)
+            return None
+
+    for config_section in new_config.sections():
+        config_section = config_section.strip()
+
+        if config_section in base_sections:
+            continue
+
+        modname = get_plugin_module(config_section)[0]
+        module = sys.modules.get(modname, None)
+
+        if not old_config.has_section(config_section):
+            logger.info('Plugin %s was enabled', modname)
+        elif dict(old_config.items(config_section)) != dict(new_config.items(config_section)):
+            logger.info('Plugin %s configuration has changed', modname)
+        elif module is None or get_module_mtime(module) != getattr(module, '_mtime_', None):
+            logger.info('Plugin %s source file has changed', modname)
+        else:
+            continue
+
+        changed.add(modname)
+
+    return changed
+
+
+def get_executable(name):
+    """
+    Return absolute path of an executable (searched in PATH if name is not a path) or sys.executable.
+    """
+    if name:
+        if os.path.dirname(name):
+            paths = [name]
+        else:
+            paths = [os.path.join(i, name) for i in os.environ.get('PATH', os.defpath).split(os.pathsep)]
+
+        for path in paths:
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                return os.path.abspath(path)
+
+    return sys.executable
+
+
+def get_restart_env(xmpp):
+    """
+    Return environment for a restarted Ludolph process.
+    """
+    env = os.environ.copy()
+    env.pop(LISTEN_FD_ENV, None)  # Inherited from a previous restart and probably not valid anymore
+
+    if xmpp.webserver:
+        listen_fd = xmpp.webserver.get_listen_fd()
+
+        if listen_fd is not None:
+            env[LISTEN_FD_ENV] = str(listen_fd)
+
+    return env
+
+
+def restart(xmpp, argv):
+    """
+    Replace the current process with a new Ludolph process. The listening socket of the web server is passed to the
+    new process, so incoming webhook requests wait in the socket's backlog instead of being refused.
+    """
+    argv = [get_executable(argv[0])] + list(argv[1:])
+    env = get_restart_env(xmpp)
+    logger.warning('Restarting Ludolph: %s', ' '.join(argv))
+
+    for handler in logging.getLogger().handlers:
+        handler.flush()
+
+    try:
+        os.execve(argv[0], argv, env)
+    except OSError as e:
+        logger.critical('Could not restart Ludolph (%s): %s', argv[0], e)
+        logging.shutdown()
+        sys.exit(1)
+
+
+def daemonize(keep_fds=()):
     """
     http://code.activestate.com/recipes/278731-creating-a-daemon-the-python-way/
     http://www.jejik.com/articles/2007/02/a_simple_unix_linux_daemon_in_python/
@@ -69,17 +239,7 @@ def daemonize():
         sys.exit(1)
 
     # Close all open file descriptors
-    import resource  # Resource usage information
-    maxfd = resource.getrlimit(resource.RLIMIT_NOFILE)[1]
-    if maxfd == resource.RLIM_INFINITY:
-        maxfd = 1024
-
-    # Iterate through and close all file descriptors
-    for fd in range(0, maxfd):
-        try:
-            os.close(fd)
-        except OSError:  # ERROR, fd wasn't open (ignored)
-            pass
+    close_fds(keep_fds=keep_fds)
 
     # Redirect standard file descriptors to /dev/null
     sys.stdout.flush()
@@ -97,12 +257,16 @@ def daemonize():
 def start():
     """
     Start the daemon.
+    Use the --profile-startup command line option to display timings of startup phases.
     """
     ret = 0
+    timer = PhaseTimer(enabled='--profile-startup' in sys.argv[1:])
+    argv = [get_executable(sys.executable), os.path.abspath(sys.argv[0])] + sys.argv[1:]  # Used for restart
+    listen_fd = get_inherited_listen_fd()  # Must be called before daemonizing (systemd checks our PID)
     cfg = 'ludolph.cfg'
     cfg_fp = None
     cfg_lo = ((os.path.expanduser('~'), '.' + cfg), (sys.prefix, 'etc', cfg), ('/etc', cfg))
-    config_base_sections = ('global', 'xmpp', 'webserver', 'cron', 'ludolph.bot')
+    config_base_sections = ('global', 'xmpp', 'webserver', 'cron', 'alerts', 'ludolph.bot')
 
     # Try to read config file from ~/.ludolph.cfg or /etc/ludolph.cfg
     for i in cfg_lo:
@@ -139,7 +303,8 @@ The example file is located in: %s\n\n""" % (
         read_file(fp)
         fp.close()
         return config
-    config = load_config(cfg_fp)
+    with timer.phase('config parse'):
+        config = load_config(cfg_fp)
 
     # Prepare logging configuration
     logconfig = {
@@ -155,7 +320,8 @@ The example file is located in: %s\n\n""" % (
     # Daemonize
     if config.has_option('global', 'daemon'):
         if config.getboolean('global', 'daemon'):
-            ret = daemonize()
+            with timer.phase('daemonize'):
+                ret = daemonize(keep_fds=() if listen_fd is None else (listen_fd,))
 
     # Save pid file
     if config.has_option('global', 'pidfile'):
@@ -187,7 +353,7 @@ The example file is located in: %s\n\n""" % (
 
     # Load plugins
     # noinspection PyShadowingNames
-    def load_plugins(config, reinit=False):
+    def load_plugins(config, reload_modules=()):  # Modules in reload_modules (None = all) are re-imported
         plugins = []
 
         for config_section in config.sections():
@@ -197,15 +363,7 @@ The example file is located in: %s\n\n""" % (
                 continue
 
             # Parse other possible imports
-            parsed_plugin = config_section.split('.')
-
-            if len(parsed_plugin) == 1:
-                modname = 'ludolph.plugins.' + config_section
-                plugin = config_section
-            else:
-                modname = config_section
-                plugin = parsed_plugin[-1]
-
+            modname, plugin = get_plugin_module(config_section)
             logger.info('Loading plugin: %s', modname)
 
             try:
@@ -213,10 +371,11 @@ The example file is located in: %s\n\n""" % (
                 clsname = plugin[0].upper() + re.sub(r'_+([a-zA-Z0-9])', lambda m: m.group(1).upper(), plugin[1:])
                 module = __import__(modname, fromlist=[clsname])
 
-                if reinit and getattr(module, '_loaded_', False):
+                if (reload_modules is None or modname in reload_modules) and getattr(module, '_loaded_', False):
                     reload(module)
 
                 module._loaded_ = True
+                module._mtime_ = get_module_mtime(module)
                 imported_class = getattr(module, clsname)
 
                 if not issubclass(imported_class, LudolphPlugin):
@@ -228,7 +387,11 @@ The example file is located in: %s\n\n""" % (
                 logger.critical('Could not load plugin: %s', modname)
 
         return plugins
-    plugins = load_plugins(config)
+
+    with timer.phase('plugin import'):
+        plugins = load_plugins(config)
+
+    loaded_config = [config]  # Last loaded configuration (mutable container - there is no nonlocal in Python 2)
 
     # XMPP connection settings
     if config.has_option('xmpp', 'host'):
@@ -246,7 +409,8 @@ The example file is located in: %s\n\n""" % (
         use_ssl = config.getboolean('xmpp', 'ssl')
 
     # Here we go
-    xmpp = LudolphBot(config, plugins=plugins)
+    with timer.phase('bot init'):
+        xmpp = LudolphBot(config, plugins=plugins, startup_timer=timer, listen_fd=listen_fd)
 
     signal.signal(signal.SIGINT, xmpp.shutdown)
     signal.signal(signal.SIGTERM, xmpp.shutdown)
@@ -260,19 +424,39 @@ The example file is located in: %s\n\n""" % (
                 xmpp.reloading = True
 
                 try:
+                    reload_start = time.time()
                     config = load_config(cfg_fp, reopen=True)
                     logger.info('Reloaded configuration from %s', cfg_fp.name)
-                    xmpp.prereload()
-                    plugins = load_plugins(config, reinit=True)
-                    xmpp.reload(config, plugins=plugins)
+                    changed = get_changed_plugins(loaded_config[0], config, config_base_sections)
+                    xmpp.prereload(changed=changed)
+
+                    try:
+                        plugins = load_plugins(config, reload_modules=changed)
+                        reloaded = xmpp.reload(config, plugins=plugins, changed=changed)
+                    except Exception:
+                        xmpp.cancel_reload()  # Commands, webhooks and cron jobs register into the published registry
+                        raise
+
+                    loaded_config[0] = config
+                    logger.info('Reload finished in %.1f ms (reinitialized plugins: %s)',
+                                (time.time() - reload_start) * 1000, ', '.join(reloaded) or 'none')
                 finally:
                     xmpp.reloading = False
 
         signal.signal(signal.SIGHUP, sighup)
         # signal.siginterrupt(signal.SIGHUP, false)  # http://stackoverflow.com/a/4302037
 
+    timer.start('connect')
+
     if xmpp.client.connect(tuple(address), use_tls=use_tls, use_ssl=use_ssl):
+        timer.stop('connect')
+        timer.start('session start')  # Finished by the bot
+
         xmpp.client.process(block=True)
+
+        if xmpp.restarting:
+            restart(xmpp, argv)
+
         sys.exit(ret)
     else:
         logger.error('Ludolph is unable to connect to jabber server')
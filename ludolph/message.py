@@ -7,7 +7,9 @@ See the file LICENSE for copying permission.
 """
 import logging
 import re
+import time
 from datetime import datetime, timedelta
+from collections import namedtuple
 from sleekxmpp.xmlstream import ET
 from sleekxmpp.stanza import Message
 try:
@@ -15,10 +17,20 @@ try:
 except ImportError:
     from xml.parsers.expat import ExpatError as ParseError
 
-__all__ = ('red', 'green', 'blue', 'IncomingLudolphMessage', 'OutgoingLudolphMessage')
+from ludolph import metrics
+from ludolph.tracing import span
+
+__all__ = ('red', 'green', 'blue', 'RequestContext', 'IncomingLudolphMessage', 'OutgoingLudolphMessage')
 
 logger = logging.getLogger(__name__)
 r = re.compile
+RegexType = type(r(''))  # re._pattern_type was removed in Python 3.7
+
+MESSAGE_FORMAT_SECONDS = metrics.histogram('ludolph_message_format_seconds',
+                                           'Time spent converting message text into plain text and HTML body')
+MESSAGES_SENT = metrics.counter('ludolph_messages_sent_total', 'Number of sent messages', ('kind',))
+MESSAGE_SEND_SECONDS = metrics.histogram('ludolph_message_send_seconds',
+                                         'Time spent creating and queueing a message stanza', ('kind',))
 
 TEXT2BODY = (
     (r(r'\*\*(.+?)\*\*'), r'*\1*'),
@@ -75,6 +87,21 @@ def blue(s):
     return '%%{color:#0000FF}%s%%' % s
 
 
+# noinspection PyClassHasNoInit
+class RequestContext(namedtuple('RequestContext', ('jid', 'nick', 'roles', 'mtype', 'received'))):
+    """
+    Immutable information about an incoming message resolved once by the bot (see LudolphBot.get_request_context).
+    jid - sender's bare JID; nick - sender's MUC room nick (or None); roles - sender's role mask (ROLE_* bits);
+    mtype - message type; received - time.time() when the message was received.
+    """
+    __slots__ = ()
+
+    @property
+    def elapsed(self):
+        """Seconds since the message was received"""
+        return time.time() - self.received
+
+
 # noinspection PyAttributeOutsideInit
 class IncomingLudolphMessage(Message):
     """
@@ -94,6 +121,16 @@ class IncomingLudolphMessage(Message):
 
         return obj
 
+    def __copy__(self):
+        """Stanza copy, which keeps the request context"""
+        obj = super(IncomingLudolphMessage, self).__copy__()
+        context = self.context
+
+        if context is not None:
+            obj.context = context
+
+        return obj
+
     def dump(self):
         data = {}
 
@@ -153,6 +190,22 @@ class IncomingLudolphMessage(Message):
 
     stream_output = property(get_stream_output, set_stream_output)
 
+    def get_raw_output(self):
+        return self._get_ludolph_attr('_raw_output_', False)
+
+    def set_raw_output(self, value):
+        self._raw_output_ = value
+
+    raw_output = property(get_raw_output, set_raw_output)
+
+    def get_context(self):
+        return self._get_ludolph_attr('_context_', None)
+
+    def set_context(self, value):
+        self._context_ = value
+
+    context = property(get_context, set_context)
+
 
 class OutgoingLudolphMessage(object):
     """
@@ -165,13 +218,14 @@ class OutgoingLudolphMessage(object):
         self.mtype = mtype
         self.msubject = msubject
 
-        if mbody is not None:
-            self.mbody = self._text2body(str(mbody))
+        with MESSAGE_FORMAT_SECONDS.time(), span('format'):
+            if mbody is not None:
+                self.mbody = self._text2body(str(mbody))
 
-        if mhtml is None and mbody is not None:
-            self.mhtml = self._text2html(str(mbody))
-        else:
-            self.mhtml = str(mhtml)
+            if mhtml is None and mbody is not None:
+                self.mhtml = self._text2html(str(mbody))
+            else:
+                self.mhtml = str(mhtml)
 
         if delay:
             timestamp = datetime.utcnow() + timedelta(seconds=delay)
@@ -184,8 +238,7 @@ class OutgoingLudolphMessage(object):
         Helper for replacing text parts according to replist.
         """
         for rx, te in replist:
-            # noinspection PyProtectedMember
-            if isinstance(rx, re._pattern_type):
+            if isinstance(rx, RegexType):
                 try:
                     text = rx.sub(te, text)
                 except re.error as exc:
@@ -231,25 +284,37 @@ class OutgoingLudolphMessage(object):
         """
         Send a new message.
         """
+        start = time.time()
         msg = xmpp.client.make_message(mto, self.mbody, msubject=self.msubject, mtype=self.mtype, mhtml=self.mhtml,
                                        mfrom=mfrom, mnick=mnick)
 
         if self.timestamp:
             msg['delay'].set_stamp(self.timestamp)
 
-        return msg.send()
+        try:
+            with span('send'):
+                return msg.send()
+        finally:
+            MESSAGES_SENT.labels('send').inc()
+            MESSAGE_SEND_SECONDS.labels('send').observe(time.time() - start)
 
     def reply(self, msg, clear=True):
         """
         Send a reply to incoming msg.
         """
+        start = time.time()
         msg.reply(self.mbody, clear=clear)
         msg['html']['body'] = self.mhtml
 
         if self.timestamp:
             msg['delay'].set_stamp(self.timestamp)
 
-        return msg.send()
+        try:
+            with span('send'):
+                return msg.send()
+        finally:
+            MESSAGES_SENT.labels('reply').inc()
+            MESSAGE_SEND_SECONDS.labels('reply').observe(time.time() - start)
 
 
 LudolphMessage = OutgoingLudolphMessage  # Backward compatibility
@@ -0,0 +1,281 @@
+"""
+Ludolph: Monitoring Jabber bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the file LICENSE for copying permission.
+
+Thread-safe counters, gauges and fixed-bucket histograms exported in the Prometheus text format (/metrics webhook)
+and summarized by the stats command.
+"""
+import time
+from bisect import bisect_left
+from threading import Lock
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # noinspection PyUnresolvedReferences,PyPackageRequirements
+    from ordereddict import OrderedDict
+
+__all__ = ('REGISTRY', 'counter', 'gauge', 'histogram')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+INF = float('inf')
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in labels)
+
+
+def _format_value(value):
+    if value == INF:
+        return '+Inf'
+
+    return repr(float(value))
+
+
+class _Timer(object):
+    """Context manager measuring duration of a code block"""
+    __slots__ = ('metric', 'start')
+
+    def __init__(self, metric):
+        self.metric = metric
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.metric.observe(time.time() - self.start)
+
+
+class _CounterValue(object):
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0
+        self.lock = Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+class _HistogramValue(object):
+    __slots__ = ('buckets', 'counts', 'sum', 'lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one is the +Inf bucket
+        self.sum = 0.0
+        self.lock = Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+    def get(self):
+        """Return (cumulative bucket counts, sum)"""
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+
+        cumulative = []
+        running = 0
+
+        for count in counts:
+            running += count
+            cumulative.append(running)
+
+        return cumulative, total
+
+
+class Metric(object):
+    """
+    Base class for metrics with optional labels. Values for one combination of label values are returned by labels().
+    """
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = OrderedDict()  # {label values : value object}
+        self._lock = Lock()
+
+    def _create_value(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """Return value object for label values"""
+        try:
+            return self._values[values]
+        except KeyError:
+            assert len(values) == len(self.labelnames), 'Wrong number of labels for metric %s' % self.name
+
+            with self._lock:
+                return self._values.setdefault(values, self._create_value())
+
+    def items(self):
+        """Return list of (labels, value object)"""
+        return [(tuple(zip(self.labelnames, values)), value) for values, value in tuple(self._values.items())]
+
+    def collect(self):
+        """Return list of samples: (name, labels, value)"""
+        return [(self.name, labels, value.get()) for labels, value in self.items()]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _create_value(self):
+        return _CounterValue()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Counter):
+    """Gauge with a value set explicitly or computed by a function when collected"""
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), fun=None):
+        super(Gauge, self).__init__(name, documentation, labelnames=labelnames)
+        self.fun = fun
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def collect(self):
+        if self.fun:
+            return [(self.name, (), self.fun())]
+
+        return super(Gauge, self).collect()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames=labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _create_value(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return _Timer(self.labels())
+
+    def collect(self):
+        samples = []
+        bounds = self.buckets + (INF,)
+
+        for labels, value in self.items():
+            counts, total = value.get()
+
+            for bound, count in zip(bounds, counts):
+                samples.append((self.name + '_bucket', labels + (('le', _format_value(bound)),), count))
+
+            samples.append((self.name + '_sum', labels, total))
+            samples.append((self.name + '_count', labels, counts[-1]))
+
+        return samples
+
+
+class Registry(object):
+    """
+    Collection of metrics. Metrics are created on first use and shared afterwards (e.g. after a plugin reload).
+    """
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._lock = Lock()
+
+    def __iter__(self):
+        return iter(tuple(self._metrics.values()))
+
+    def get(self, name):
+        return self._metrics.get(name, None)
+
+    def _get_or_create(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name, None)
+
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+
+            assert type(metric) is cls, 'Metric %s is already registered with a different type' % name
+
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get_or_create(Counter, name, documentation, labelnames=labelnames)
+
+    def gauge(self, name, documentation, labelnames=(), fun=None):
+        metric = self._get_or_create(Gauge, name, documentation, labelnames=labelnames)
+
+        if fun is not None:
+            metric.fun = fun
+
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, labelnames=labelnames, buckets=buckets)
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format"""
+        lines = []
+
+        for metric in self:
+            lines.append('# HELP %s %s' % (metric.name, metric.documentation.replace('\n', ' ')))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+
+            for name, labels, value in metric.collect():
+                lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(value)))
+
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Return list of human readable metric values (histograms are displayed as count and average)"""
+        lines = []
+
+        for metric in self:
+            if isinstance(metric, Histogram):
+                for labels, value in metric.items():
+                    counts, total = value.get()
+                    avg = total / counts[-1] if counts[-1] else 0
+                    lines.append('%s%s: %d (avg %.3f s)' % (metric.name, _format_labels(labels), counts[-1], avg))
+            else:
+                for name, labels, value in metric.collect():
+                    lines.append('%s%s: %g' % (name, _format_labels(labels), value))
+
+        return lines
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
@@ -0,0 +1,286 @@
+"""
+Ludolph: Monitoring Jabber bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the file LICENSE for copying permission.
+
+Durable outbox for outgoing alerts. Alerts are appended into segment files (one JSON object per line) before they
+are sent. Writes from concurrent requests are committed by one fsync() call (group commit) in a committer thread.
+Alerts held in memory by the alert pipeline (digests, delayed trigger states, deferred messages) are not replayed
+until they are released. Alerts are marked as sent when a message carrying them is sent and acknowledged later by
+appending an ack record; segments containing only acknowledged alerts are deleted. Unacknowledged alerts are replayed
+after the bot (re)connects or restarts, so delivery is at-least-once.
+"""
+import os
+import json
+import time
+import logging
+from threading import Condition, Thread
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # noinspection PyUnresolvedReferences,PyPackageRequirements
+    from ordereddict import OrderedDict
+
+__all__ = ('Outbox',)
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_PREFIX = 'outbox-'
+SEGMENT_SUFFIX = '.log'
+
+
+class Outbox(object):
+    """
+    Append-only on-disk queue of outgoing alerts.
+    """
+    segment_size = 4194304  # Start new segment file after reaching this size in bytes
+    commit_delay = 0.002  # Seconds to wait for more writes before calling fsync()
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._cond = Condition()
+        self._seq = 0  # Last used sequence number
+        self._synced = 0  # Last sequence number written to disk
+        self._dirty = False
+        self._closing = False
+        self._entries = OrderedDict()  # {seq : record} of unacknowledged alerts
+        self._sent = OrderedDict()  # {seq : timestamp} of sent, but not yet acknowledged alerts
+        self._held = set()  # seqs of alerts being processed (not sent yet, but not pending either)
+        self._segments = OrderedDict()  # {segment number : set of unacknowledged seqs}
+        self._segment_of = {}  # {seq : segment number}
+        self._segment = 0  # Current segment number
+        self._size = 0  # Size of current segment file
+        self._fp = None
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._recover()
+        self._open_segment(self._segment + 1)
+        self._compact()
+        self._committer = Thread(target=self._commit_loop, name='outbox')
+        self._committer.daemon = True
+        self._committer.start()
+
+    def __len__(self):
+        """Number of unacknowledged alerts"""
+        return len(self._entries)
+
+    def _path(self, number):
+        return os.path.join(self.directory, '%s%010d%s' % (SEGMENT_PREFIX, number, SEGMENT_SUFFIX))
+
+    def _list_segments(self):
+        numbers = []
+
+        for name in os.listdir(self.directory):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                try:
+                    numbers.append(int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]))
+                except ValueError:
+                    continue
+
+        return sorted(numbers)
+
+    def _recover(self):
+        """Load unacknowledged alerts from segment files"""
+        for number in self._list_segments():
+            self._segment = number
+            self._segments[number] = seqs = set()
+
+            with open(self._path(number), 'rb') as fp:
+                for line in fp:
+                    try:
+                        record = json.loads(line.decode('utf-8'))
+                    except ValueError:  # Incomplete write during crash
+                        logger.warning('Ignoring corrupted record in outbox segment %s', self._path(number))
+                        break
+
+                    if 'ack' in record:
+                        self._remove(record['ack'])
+                    else:
+                        seq = record['seq']
+                        self._entries[seq] = record
+                        self._segment_of[seq] = number
+                        seqs.add(seq)
+                        self._seq = max(self._seq, seq)
+
+        self._synced = self._seq
+
+        if self._entries:
+            logger.warning('Found %d unsent alerts in outbox %s', len(self._entries), self.directory)
+
+        self._compact()
+
+    def _open_segment(self, number):
+        self._segment = number
+        self._segments[number] = set()
+        self._fp = open(self._path(number), 'ab')
+        self._size = self._fp.tell()
+
+    def _rotate(self):
+        """Close current segment (must be called under lock)"""
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        self._fp.close()
+        self._synced = self._seq
+        self._dirty = False
+        self._cond.notify_all()
+        self._open_segment(self._segment + 1)
+        self._compact()
+
+    def _compact(self):
+        """Delete the oldest segments containing only acknowledged alerts (must be called under lock)"""
+        for number, seqs in tuple(self._segments.items()):
+            if seqs or number == self._segment:
+                break
+
+            del self._segments[number]
+
+            try:
+                os.remove(self._path(number))
+            except OSError as e:
+                logger.error('Could not remove outbox segment %s: %s', self._path(number), e)
+            else:
+                logger.debug('Removed outbox segment %s', self._path(number))
+
+    def _write(self, record):
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        self._fp.write(line)
+        self._size += len(line)
+        self._dirty = True
+        self._cond.notify_all()
+
+        if self._size >= self.segment_size:
+            self._rotate()
+
+    def _remove(self, seq):
+        self._entries.pop(seq, None)
+        self._sent.pop(seq, None)
+        self._held.discard(seq)
+        number = self._segment_of.pop(seq, None)
+
+        if number is not None:
+            self._segments[number].discard(seq)
+
+    def _commit_loop(self):
+        """Committer thread - one fsync() for all writes done since the last fsync()"""
+        while True:
+            with self._cond:
+                while not self._dirty and not self._closing:
+                    self._cond.wait()
+
+                if self._closing:
+                    return
+
+            if self.commit_delay:
+                time.sleep(self.commit_delay)  # Let other writers join this commit
+
+            with self._cond:
+                if self._closing or not self._dirty:
+                    continue
+
+                seq = self._seq
+                self._fp.flush()
+                os.fsync(self._fp.fileno())
+                self._dirty = False
+                self._synced = seq
+                self._cond.notify_all()
+
+    def append(self, record, sync=True):
+        """Save alert (dict) and return its sequence number. Wait until it is written to disk if sync is True"""
+        with self._cond:
+            self._seq += 1
+            seq = self._seq
+            record = dict(record, seq=seq)
+            self._entries[seq] = record
+            self._segment_of[seq] = self._segment
+            self._segments[self._segment].add(seq)
+            self._write(record)  # May start a new segment
+
+        if sync:
+            self.sync(seq)
+
+        return seq
+
+    def sync(self, seq=None):
+        """Wait until the alert with sequence number seq (default: all alerts) is written to disk"""
+        with self._cond:
+            if seq is None:
+                seq = self._seq
+
+            while self._synced < seq and not self._closing:
+                self._cond.wait()
+
+    def pending(self):
+        """Return list of (seq, record) of alerts which have not been sent yet and are not being processed"""
+        with self._cond:
+            return [(seq, record) for seq, record in self._entries.items()
+                    if seq not in self._sent and seq not in self._held]
+
+    def hold(self, seq):
+        """Mark alert as being processed - it will not be returned by pending() until it is sent or released"""
+        with self._cond:
+            if seq in self._entries:
+                self._held.add(seq)
+
+    def release(self, seq):
+        """Return alert which was not sent into the queue"""
+        with self._cond:
+            self._held.discard(seq)
+
+    def sent(self, seq):
+        """Mark alert as sent. Sent alerts are acknowledged by confirm()"""
+        with self._cond:
+            if seq in self._entries:
+                self._held.discard(seq)
+                self._sent[seq] = time.time()
+
+    def unsend(self):
+        """Return sent, but unacknowledged alerts into the queue (e.g. after the connection was lost)"""
+        with self._cond:
+            count = len(self._sent)
+            self._sent.clear()
+
+        if count:
+            logger.warning('%d sent alerts will be sent again', count)
+
+    def ack(self, seqs):
+        """Acknowledge alerts - they will never be sent again"""
+        with self._cond:
+            if self._closing:  # The outbox file is closed - alerts will be acknowledged after restart
+                return
+
+            for seq in seqs:
+                if seq in self._entries:
+                    self._write({'ack': seq})
+                    self._remove(seq)
+
+            self._compact()
+
+    def confirm(self, delay=0):
+        """Acknowledge alerts sent at least delay seconds ago"""
+        limit = time.time() - delay
+
+        with self._cond:
+            seqs = [seq for seq, timestamp in self._sent.items() if timestamp <= limit]
+
+        if seqs:
+            self.ack(seqs)
+
+    def close(self):
+        """Write everything to disk and stop the committer thread"""
+        with self._cond:
+            if self._closing:
+                return
+
+            self._closing = True
+            self._fp.flush()
+            os.fsync(self._fp.fileno())
+            self._fp.close()
+            self._synced = self._seq
+            self._cond.notify_all()
+
+        self._committer.join()
@@ -18,6 +18,8 @@ from ludolph import __doc__ as ABOUT
 from ludolph import __version__
 from ludolph.command import CommandError, MissingParameter, command
 from ludolph.web import webhook, request, abort
+from ludolph import metrics
+from ludolph.profiling import PROFILER, ProfilerError
 from ludolph.utils import pluralize
 from ludolph.plugins.plugin import LudolphPlugin
 
@@ -32,6 +34,7 @@ class Base(LudolphPlugin):
     _avatar_allowed_extensions = frozenset(['.png', '.jpg', '.jpeg', '.gif'])
     _status_show_types = frozenset(['online', 'away', 'chat', 'dnd', 'xa'])  # online is a fake type translated to None
     _help_cache = None
+    _help_cache_version = None  # Version of the commands registry used for generating the help cache
     _cron_required = ('at', 'remind')
     _reminder = 'You have asked me to remind you: '
     _reminder_command = 'attention'
@@ -59,7 +62,7 @@ class Base(LudolphPlugin):
 
     def _help_all(self):
         """Return list of all commands organized by plugins"""
-        if self._help_cache is None:
+        if self._help_cache is None or self._help_cache_version != self.xmpp.commands.version:
             # Create dict with module name as key and list of commands as value
             xmpp = self.xmpp
             cmd_map = {}
@@ -107,7 +110,9 @@ class Base(LudolphPlugin):
                     out.append('  * **%s**%s' % (cmd.name, desc))
 
             out.append('\nUse "help <command>" for more information about the command usage')
+            out.append('Command output can be filtered with: <command> | {grep|head|tail|count|sort} [parameters]')
             self._help_cache = '\n'.join(out)
+            self._help_cache_version = xmpp.commands.version
 
         return self._help_cache
 
@@ -176,8 +181,8 @@ class Base(LudolphPlugin):
 
         return 'up %d days, %d hours, %d minutes, %d seconds' % (d, h, m, s)
 
-    def _message_send(self, jid, msg):
-        """Send new xmpp message. Used by message command and /message webhook"""
+    def _message_send(self, jid, msg, alert=False, trigger=None):
+        """Send new xmpp message. Used by message command and /message webhook (alert=True)"""
         if jid == self.xmpp.room:
             mtype = 'groupchat'
         elif jid in self.xmpp.client_roster:
@@ -187,7 +192,11 @@ class Base(LudolphPlugin):
 
         logger.info('Sending message to "%s"', jid)
         logger.debug('\twith body: "%s"', msg)
-        self.xmpp.msg_send(jid, msg, mtype=mtype)
+
+        if alert:
+            self.xmpp.msg_alert(jid, msg, mtype=mtype, trigger=trigger)
+        else:
+            self.xmpp.msg_send(jid, msg, mtype=mtype)
 
         return 'Message sent to **%s**' % jid
 
@@ -283,6 +292,129 @@ class Base(LudolphPlugin):
 
         return self._roster_list()
 
+    # noinspection PyUnusedLocal
+    @command(admin_required=True)
+    def db_compact(self, msg):
+        """
+        Compact the persistent DB file and display its size before and after compaction (admin only).
+
+        Usage: db-compact
+        """
+        if self.xmpp.db is None:
+            raise CommandError('Persistent DB is not enabled')
+
+        sizes = self.xmpp.db_compact()
+
+        if not sizes:
+            raise CommandError('Persistent DB compaction failed')
+
+        return 'Persistent DB compacted from **%d** to **%d** bytes' % sizes
+
+    # noinspection PyUnusedLocal
+    @command(admin_required=True)
+    def stats(self, msg):
+        """
+        Show Ludolph performance counters and cache statistics (admin only).
+
+        Usage: stats
+        """
+        from ludolph.bot import JIDS
+
+        out = ['**Metrics:**']
+        out.extend(metrics.REGISTRY.summary())
+        out.append('\n**JID cache:** %s' % ', '.join('%s=%s' % item for item in sorted(JIDS.stats().items())))
+
+        return '\n'.join(out)
+
+    # noinspection PyUnusedLocal
+    @command(admin_required=True)
+    def profile(self, msg, *args):
+        """
+        Profile command and cron job execution (admin only).
+
+        Show profiler status.
+        Usage: profile
+
+        Start profiling for a number of seconds (default: 60) and/or a number of commands and cron jobs (0 = no limit).
+        Usage: profile start [seconds] [calls]
+
+        Stop profiling and show functions with the highest cumulative time.
+        Usage: profile stop
+
+        Show top functions by cumulative time (default: 20) and optionally save statistics into a pstats file
+        in the directory set by the profile_dir option.
+        Usage: profile dump [count] [file name]
+        """
+        action = args[0] if args else None
+
+        try:
+            if action == 'start':
+                try:
+                    duration = int(args[1]) if len(args) > 1 else 60
+                    max_calls = int(args[2]) if len(args) > 2 else 0
+                except ValueError:
+                    raise CommandError('Invalid number of seconds or calls')
+
+                PROFILER.start(duration=duration, max_calls=max_calls)
+
+                return PROFILER.status()
+            elif action == 'stop':
+                PROFILER.stop()
+
+                return self._profile_dump()
+            elif action == 'dump':
+                try:
+                    limit = int(args[1]) if len(args) > 1 else 20
+                except ValueError:
+                    raise CommandError('Invalid number of functions')
+
+                return self._profile_dump(limit=limit, filename=args[2] if len(args) > 2 else None)
+            elif action:
+                raise CommandError('Invalid action')
+        except ProfilerError as e:
+            raise CommandError(str(e))
+
+        return PROFILER.status()
+
+    def _profile_dump(self, limit=20, filename=None):
+        """Display profiler status and top functions by cumulative time"""
+        if not PROFILER.calls:
+            return PROFILER.status()
+
+        out = [PROFILER.status(), '', '**cumulative [s]  own [s]  calls  function**']
+        out.extend('%.4f  %.4f  %d  %s' % item for item in PROFILER.top(limit=limit))
+
+        if filename:
+            profile_dir = self.config.get('profile_dir', None)
+
+            if not profile_dir:
+                raise CommandError('Saving of profiler statistics is disabled (profile_dir is not set)')
+
+            if os.path.basename(filename) != filename or filename.startswith('.'):
+                raise CommandError('Invalid file name')
+
+            path = os.path.join(profile_dir, filename)
+
+            try:
+                PROFILER.save(path)
+            except (IOError, OSError) as e:
+                raise CommandError('Could not save profiler statistics: %s' % e)
+
+            out.append('\nProfiler statistics saved into **%s**' % path)
+
+        return '\n'.join(out)
+
+    @command(admin_required=True)
+    def restart(self, msg):
+        """
+        Restart Ludolph process. Webhook requests received during restart are not refused (admin only).
+
+        Usage: restart
+        """
+        self.xmpp.msg_reply(msg, 'Restarting, I will be back in a few seconds...', preserve_msg=True)
+        # Give the reply a chance to leave the send queue before the connection is closed
+        self.xmpp.client.schedule('ludolph_restart', 1, self.xmpp.restart)
+
     def _get_avatar_dirs(self):
         """Get list of directories where avatars are stored."""
         avatar_dir = self.config.get('avatar_dir', None)
@@ -342,7 +474,7 @@ class Base(LudolphPlugin):
 
         self.xmpp.msg_reply(msg, 'I have found the selected avatar, changing it might take few seconds...',
                             preserve_msg=True)
-        xep_0084 = self.xmpp.client.plugin['xep_0084']
+        xep_0084 = self.xmpp.client_plugin('xep_0084')
         avatar_type = 'image/%s' % imghdr.what('', avatar)
         avatar_id = xep_0084.generate_id(avatar)
         avatar_bytes = len(avatar)
@@ -356,7 +488,7 @@ class Base(LudolphPlugin):
 
         try:
             logger.debug('Publishing XEP-0153 avatar vCard data')
-            self.xmpp.client.plugin['xep_0153'].set_avatar(avatar=avatar, mtype=avatar_type)
+            self.xmpp.client_plugin('xep_0153').set_avatar(avatar=avatar, mtype=avatar_type)
         except XMPPError as e:
             logger.error('Could not publish XEP-0153 vCard avatar: %s' % e.text)
             raise CommandError('Could not set vCard avatar')
@@ -581,7 +713,7 @@ class Base(LudolphPlugin):
         msg = request.forms.get('msg', '')
 
         try:
-            return self._message_send(jid, msg)
+            return self._message_send(jid, msg, alert=True, trigger=request.forms.get('trigger', None))
         except CommandError as e:
             abort(400, str(e))
 
@@ -40,10 +40,19 @@ class Process(Popen):
     @property
     def output(self):
         """Stdout generator"""
-        with self.stdout:
-            for line in iter(self.stdout.readline, b''):
-                yield line.decode('utf-8').rstrip('\n')
-        self.wait()
+        finished = False
+
+        try:
+            with self.stdout:
+                for line in iter(self.stdout.readline, b''):
+                    yield line.decode('utf-8').rstrip('\n')
+            finished = True
+        finally:
+            if not finished and self.poll() is None:  # The consumer stopped reading (e.g. "| head")
+                logger.debug('Terminating process %s, because its output is no longer needed', self.pid)
+                self.terminate()
+
+            self.wait()
 
     # noinspection PyUnusedLocal
     def _get_output(self, name):
@@ -57,8 +66,13 @@ class Process(Popen):
 
     def _get_output_stream(self, name):
         """Stream Ludolph command output"""
-        for line in self.output:
-            yield line
+        output = self.output
+
+        try:
+            for line in output:
+                yield line
+        finally:
+            output.close()  # Stops the process if we were closed early
 
         if self.returncode != 0:
             raise CommandError('Command "%s" exited with non-zero status %s' % (name, self.returncode))
@@ -158,12 +158,14 @@ class Muc(LudolphPlugin):
 
             if action == 'del':
                 self.room_motd = None
+                self._db_changed('room_motd')
                 return 'MOTD successfully deleted'
             elif action == 'set':
                 if not text:
                     raise CommandError('Missing text')
                 # Get original version from message body (strip command and sub-command)
                 self.room_motd = msg['body'].lstrip().split(None, 2)[-1]
+                self._db_changed('room_motd')
                 # Announce new motd into room
                 self.xmpp.msg_send(self.xmpp.room, self.room_motd, mtype='groupchat')
                 return 'MOTD successfully updated'
@@ -198,6 +200,6 @@ class Muc(LudolphPlugin):
             logger.warning('Missing msg parameter in room request')
             abort(400, 'Missing msg parameter')
 
-        self.xmpp.msg_send(self.xmpp.room, msg, mtype='groupchat')
+        self.xmpp.msg_alert(self.xmpp.room, msg, mtype='groupchat', trigger=request.forms.get('trigger', None))
 
         return 'Message sent'
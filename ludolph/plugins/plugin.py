@@ -14,6 +14,8 @@ class LudolphPlugin(object):
     __version__ = None
     _boolean_false = frozenset([False, 'false', '0', 'no', 'off', 0, ''])
     persistent_attrs = ()  # Set of object's attributes that will be saved/loaded during bot's shutdown/start events.
+    # Persistent attributes marked by _db_changed() are also saved at periodic DB checkpoints.
+    xmpp_plugins = ()  # Names of SleekXMPP plugins (e.g. xep_0084) required by this plugin.
 
     # noinspection PyUnusedLocal
     def __init__(self, xmpp, config, reinit=False, **kwargs):
@@ -48,11 +50,16 @@ class LudolphPlugin(object):
             if i in self.persistent_attrs:
                 self.__dict__[i] = state[i]
 
+    def _db_changed(self, *attrs):
+        """Mark persistent attributes (default: all) as changed, so they are saved at the next DB checkpoint"""
+        # noinspection PyProtectedMember
+        self.xmpp._db_mark_changed(self.__class__.__module__, attrs or self.persistent_attrs)
+
     def _db_save(self):
         """Save persistent attributes now"""
         if self.xmpp.db is not None:
             # noinspection PyProtectedMember
-            self.xmpp._db_set_item(self.__class__.__module__, self)
+            self.xmpp._db_set_item(self.__class__.__module__, self, force=True)
 
     def _db_load(self):
         """Load persistent attributes from DB"""
@@ -0,0 +1,193 @@
+"""
+Ludolph: Monitoring Jabber bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the file LICENSE for copying permission.
+
+On-demand profiling of command and cron job execution. The profiler is started by the profile command for a limited
+time or number of calls. Profiled calls run one at a time - calls running concurrently with a profiled call are
+executed without profiling. Generators returned by profiled calls (output of stream_output commands) are profiled
+until they are exhausted. Statistics of all profiled calls are merged and can be displayed or saved into a pstats
+file at any time.
+"""
+import time
+import pstats
+import logging
+from threading import Lock
+from types import GeneratorType
+
+try:
+    import cProfile as profile
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    import profile
+
+__all__ = ('PROFILER', 'ProfilerError')
+
+logger = logging.getLogger(__name__)
+
+
+class ProfilerError(Exception):
+    pass
+
+
+class Profiler(object):
+    """
+    Collects profiling statistics of function calls run through call().
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._busy = Lock()  # Only one profiler can be active (at once in Python 3.12+)
+        self._stats = None
+        self.active = False
+        self.started = None
+        self.stopped = None
+        self.deadline = None
+        self.max_calls = 0
+        self.calls = 0
+        self.skipped = 0
+
+    def start(self, duration=60, max_calls=0):
+        """Start profiling for duration seconds or max_calls profiled calls (0 = no limit) and clear statistics"""
+        if not duration and not max_calls:
+            raise ProfilerError('Profiling must be limited by duration or number of calls')
+
+        with self._lock:
+            if self.active:
+                raise ProfilerError('Profiler is already running')
+
+            self._stats = None
+            self.active = True
+            self.started = time.time()
+            self.stopped = None
+            self.deadline = self.started + duration if duration else None
+            self.max_calls = max_calls
+            self.calls = self.skipped = 0
+
+        logger.warning('Profiler started (duration=%s, calls=%s)', duration, max_calls)
+
+    def _stop(self):
+        """Stop profiling (must be called under lock)"""
+        if self.active:
+            self.active = False
+            self.stopped = time.time()
+            logger.warning('Profiler stopped after %d profiled calls', self.calls)
+
+    def stop(self):
+        """Stop profiling. Statistics are kept until the next start()"""
+        with self._lock:
+            if not self.active:
+                raise ProfilerError('Profiler is not running')
+
+            self._stop()
+
+    def call(self, fun, *args, **kwargs):
+        """Run function and profile it if the profiler is active"""
+        if not self.active:
+            return fun(*args, **kwargs)
+
+        with self._lock:
+            if self.deadline and time.time() >= self.deadline:
+                self._stop()
+
+            if not self.active:
+                return fun(*args, **kwargs)
+
+        if not self._busy.acquire(False):
+            with self._lock:
+                self.skipped += 1
+
+            return fun(*args, **kwargs)
+
+        prof = profile.Profile()
+
+        try:
+            res = prof.runcall(fun, *args, **kwargs)
+        except Exception:
+            self._add_stats(prof)
+            raise
+        finally:
+            self._busy.release()
+
+        if isinstance(res, GeneratorType):  # Output of stream_output commands is produced during iteration
+            return self._iter(prof, res)
+
+        self._add_stats(prof)
+
+        return res
+
+    def _iter(self, prof, gen):
+        """Profile iteration of a generator returned by a profiled call; the call is finished when it is exhausted"""
+        try:
+            while True:
+                with self._busy:
+                    try:
+                        item = prof.runcall(next, gen)
+                    except StopIteration:
+                        break
+
+                yield item
+        finally:
+            gen.close()
+            self._add_stats(prof)
+
+    def _add_stats(self, prof):
+        """Merge statistics of a finished profiled call"""
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(prof)
+            else:
+                self._stats.add(prof)
+
+            self.calls += 1
+
+            if self.max_calls and self.calls >= self.max_calls:
+                self._stop()
+
+    def status(self):
+        """Return profiler status as text"""
+        with self._lock:
+            if self.active and self.deadline and time.time() >= self.deadline:
+                self._stop()
+
+            if self.started is None:
+                return 'Profiler was never started'
+
+            if self.active:
+                state = 'running since %s' % time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started))
+
+                if self.deadline:
+                    state += ' (%d seconds left)' % max(0, self.deadline - time.time())
+
+                if self.max_calls:
+                    state += ' (%d calls left)' % (self.max_calls - self.calls)
+            else:
+                state = 'stopped after %d seconds' % (self.stopped - self.started)
+
+            return 'Profiler %s, profiled calls: %d, not profiled concurrent calls: %d' % (
+                state, self.calls, self.skipped)
+
+    def top(self, limit=20):
+        """Return list of (cumulative time, own time, number of calls, function) sorted by cumulative time"""
+        with self._lock:
+            if self._stats is None:
+                raise ProfilerError('No calls were profiled yet')
+
+            stats = self._stats.sort_stats('cumulative')
+            # noinspection PyUnresolvedReferences
+            funcs = stats.fcn_list[:limit]
+
+            return [(stats.stats[func][3], stats.stats[func][2], stats.stats[func][1], pstats.func_std_string(func))
+                    for func in funcs]
+
+    def save(self, path):
+        """Save statistics into a pstats file"""
+        with self._lock:
+            if self._stats is None:
+                raise ProfilerError('No calls were profiled yet')
+
+            self._stats.dump_stats(path)
+
+
+PROFILER = Profiler()
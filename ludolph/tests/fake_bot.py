@@ -6,6 +6,13 @@ This file is part of Ludolph.
 See the LICENSE file for copying permission.
 """
 
+try:
+    # noinspection PyCompatibility,PyUnresolvedReferences
+    from configparser import RawConfigParser
+except ImportError:
+    # noinspection PyCompatibility,PyUnresolvedReferences
+    from ConfigParser import RawConfigParser
+
 
 class FakeLudolphBot(object):
     """
@@ -25,3 +32,48 @@ class FakeLudolphBot(object):
             self.client_roster[jid] = {
                 'subscription': 'both'
             }
+
+
+BOT_CONFIG = {
+    'global': {},
+    'xmpp': {
+        'username': 'ludolph@test.com',
+        'password': 'secret',
+        'users': 'friend1@test.com, friend2@test.com',
+        'admins': 'friend1@test.com',
+    },
+}
+
+
+def create_config(config=None):
+    """
+    Create bot configuration, for testing purposes.
+
+    The config parameter is a dict of {section : {option : value}} items, which update the default BOT_CONFIG.
+    """
+    cfg = RawConfigParser()
+    sections = dict((section, dict(options)) for section, options in BOT_CONFIG.items())
+
+    for section, options in (config or {}).items():
+        sections.setdefault(section, {}).update(options)
+
+    for section, options in sections.items():
+        cfg.add_section(section)
+
+        for option, value in options.items():
+            cfg.set(section, option, value)
+
+    return cfg
+
+
+def create_bot(config=None, plugins=()):
+    """
+    Create LudolphBot (not connected to any jabber server), for testing purposes.
+
+    The config parameter is passed to create_config().
+    The plugins parameter is a list of ludolph.main.Plugin tuples (the plugin section must exist in config).
+    """
+    from ludolph.bot import LudolphBot  # Requires SleekXMPP
+
+    # noinspection PyTypeChecker
+    return LudolphBot(create_config(config), plugins=list(plugins))
@@ -0,0 +1,173 @@
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+"""
+
+import unittest
+from collections import deque
+from ludolph.alerts import AlertStorm, FlapFilter
+
+JID = 'user@example.com'
+
+
+class FakeXMPP(object):
+    def __init__(self):
+        self.sent = []
+        self.outbox_sent = []
+
+    def msg_send(self, mto, mbody, mtype='normal', outbox_seqs=(), **kwargs):
+        self.sent.append((mto, mbody, mtype))
+        self.outbox_sent.extend(outbox_seqs)
+        return True
+
+
+class AlertStormTest(unittest.TestCase):
+
+    xmpp = None
+    storm = None
+
+    def setUp(self):
+        self.xmpp = FakeXMPP()
+        self.storm = AlertStorm(self.xmpp)
+        self.storm.load_config({'storm_threshold': '3', 'storm_window': '60', 'storm_digest_lines': '2'})
+
+    def _age(self, seconds):
+        """Move all alert timestamps into the past"""
+        for rcpt in self.storm._recipients.values():
+            rcpt.times = deque((t - seconds for t in rcpt.times), maxlen=rcpt.times.maxlen)
+
+    def test_summary_mode(self):
+        for i in range(3):
+            self.assertTrue(self.storm.send(JID, 'PROBLEM: disk %d' % i))
+
+        self.assertFalse(self.storm.send(JID, 'PROBLEM: Disaster on host1\nDetails'))  # threshold + 1
+        self.assertFalse(self.storm.send(JID, 'PROBLEM: High load on host2'))
+        self.assertFalse(self.storm.send(JID, 'OK: disk 0', mtype='groupchat'))
+        self.assertEqual(len(self.xmpp.sent), 3)
+
+        self.storm.flush()
+        self.assertEqual(len(self.xmpp.sent), 4)
+        mto, digest, mtype = self.xmpp.sent[3]
+        self.assertEqual((mto, mtype), (JID, 'normal'))
+        lines = digest.split('\n')
+        self.assertEqual(lines[0], '**Alert storm**: 3 alerts in the last 60 seconds')
+        self.assertEqual(sorted(lines[1].split(', ')), ['Disaster: 1', 'High: 1', 'OK: 1', 'PROBLEM: 2'])
+        self.assertEqual(lines[2:], [' * PROBLEM: Disaster on host1', ' * PROBLEM: High load on host2',
+                                     ' ... and 1 more'])
+
+        self.assertFalse(self.storm.send(JID, 'PROBLEM: disk 1'))  # Rate is still high
+        self._age(120)
+        self.storm.flush()  # Sends the last digest and switches back to normal mode
+        self.assertTrue(self.xmpp.sent[4][1].startswith('**Alert storm**: 1 alerts'))
+        self.assertTrue(self.storm.send(JID, 'PROBLEM: disk 2'))
+        self.assertEqual(self.xmpp.sent[5], (JID, 'PROBLEM: disk 2', 'normal'))
+
+    def test_outbox_seqs(self):
+        for seq in range(1, 6):
+            self.storm.send(JID, 'PROBLEM: disk', seqs=(seq,))
+
+        self.assertEqual(self.xmpp.outbox_sent, [1, 2, 3])  # Alerts 4 and 5 are waiting for the digest
+        self.storm.flush()
+        self.assertEqual(self.xmpp.outbox_sent, [1, 2, 3, 4, 5])
+
+    def test_flush_empty(self):
+        self.storm.send(JID, 'PROBLEM: disk')
+        self._age(120)
+        self.storm.flush()
+        self.assertEqual(len(self.xmpp.sent), 1)
+        self.assertEqual(self.storm._recipients, {})
+
+    def test_load_config(self):
+        self.storm.send(JID, 'PROBLEM: disk')
+        self.assertEqual(self.storm._recipients[JID].times.maxlen, 4)
+        self.storm.load_config({'storm_threshold': '10'})
+        self.assertEqual(self.storm._recipients[JID].times.maxlen, 11)
+        self.assertEqual(len(self.storm._recipients[JID].times), 1)
+        self.assertEqual((self.storm.window, self.storm.digest_lines), (AlertStorm.window, AlertStorm.digest_lines))
+        self.storm.load_config({})
+        self.assertFalse(self.storm.enabled)
+        self.assertTrue(self.storm.send(JID, 'PROBLEM: disk'))
+
+
+class FlapFilterTest(unittest.TestCase):
+
+    sent = None
+    outbox_sent = None
+    flapping = None
+
+    def send(self, mto, mbody, mtype='normal', seqs=()):
+        self.sent.append((mto, mbody, mtype))
+        self.outbox_sent.extend(seqs)
+        return True
+
+    def setUp(self):
+        self.sent = []
+        self.outbox_sent = []
+        self.flapping = FlapFilter(self.send)
+        self.flapping.load_config({'flap_holddown': '60'})
+
+    def test_disabled(self):
+        self.flapping.load_config({})
+        self.assertTrue(self.flapping.process(JID, 'PROBLEM: disk', 'normal', '100'))
+        self.assertTrue(self.flapping.process(JID, 'OK: disk', 'normal', '100'))
+        self.assertEqual(len(self.sent), 2)
+
+    def test_problem_ok(self):
+        self.assertTrue(self.flapping.process(JID, 'PROBLEM: disk', 'normal', '100'))
+        self.assertEqual(self.sent, [(JID, 'PROBLEM: disk', 'normal')])
+        self.assertFalse(self.flapping.process(JID, 'OK: disk', 'normal', '100'))  # Within hold-down
+        self.flapping.flush()
+        self.assertEqual(len(self.sent), 1)
+        self.flapping.flush(force=True)
+        self.assertEqual(self.sent[1:], [(JID, 'OK: disk', 'normal')])  # Single delayed OK is not flapping
+        self.flapping.flush(force=True)
+        self.assertEqual(len(self.sent), 2)
+
+    def test_flapping(self):
+        self.flapping.process(JID, 'PROBLEM: disk', 'groupchat', '100')
+        self.assertFalse(self.flapping.process(JID, 'OK: disk', 'groupchat', '100'))
+        self.assertFalse(self.flapping.process(JID, 'PROBLEM: disk', 'groupchat', '100'))
+        self.assertEqual(len(self.sent), 1)
+        self.flapping.flush(force=True)
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(self.sent[1][0], JID)
+        self.assertTrue('changed its state 2 times, current state: PROBLEM' in self.sent[1][1])
+        self.assertEqual(self.sent[1][2], 'groupchat')
+
+    def test_flapping_ok(self):
+        self.flapping.process(JID, 'PROBLEM: disk', 'normal', '100')
+        self.flapping.process(JID, 'OK: disk', 'normal', '100')
+        self.flapping.process(JID, 'PROBLEM: disk', 'normal', '100')
+        self.flapping.process(JID, 'OK: disk', 'normal', '100')
+        self.assertEqual(len(self.sent), 1)
+        self.flapping.flush(force=True)
+        self.assertTrue('changed its state 3 times, current state: OK' in self.sent[1][1])
+        self.assertEqual(self.sent[2], (JID, 'OK: disk', 'normal'))
+
+    def test_outbox_seqs(self):
+        self.flapping.process(JID, 'PROBLEM: disk', 'normal', '100', seqs=(1,))
+        self.flapping.process(JID, 'OK: disk', 'normal', '100', seqs=(2,))
+        self.flapping.process(JID, 'PROBLEM: disk', 'normal', '100', seqs=(3,))
+        self.flapping.process(JID, 'OK: disk', 'normal', '100', seqs=(4,))
+        self.assertEqual(self.outbox_sent, [1])
+        self.flapping.flush(force=True)
+        self.assertEqual(self.outbox_sent, [1, 2, 3, 4])  # Summary carries 2 and 3, the delayed OK carries 4
+
+    def test_eviction(self):
+        self.flapping.maxsize = 2
+
+        for trigger in ('1', '2'):
+            self.flapping.process(JID, 'PROBLEM: trigger %s' % trigger, 'normal', trigger)
+
+        self.flapping.process(JID, 'OK: trigger 1', 'normal', '1')
+        self.assertEqual(len(self.sent), 2)
+        self.flapping.process(JID, 'PROBLEM: trigger 3', 'normal', '3')  # Evicts trigger 1 with its delayed OK
+        self.assertEqual(self.sent[2:], [(JID, 'OK: trigger 1', 'normal'), (JID, 'PROBLEM: trigger 3', 'normal')])
+        self.assertEqual(len(self.flapping._triggers), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from ludolph.db import LudolphDB, LudolphSQLiteDB, LudolphDBWriter, open_db
+
+
+class LudolphSQLiteDBTest(unittest.TestCase):
+
+    tmpdir = None
+    db = None
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = open_db('sqlite://' + os.path.join(self.tmpdir, 'ludolph.db'))
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_open_db(self):
+        self.assertTrue(isinstance(self.db, LudolphSQLiteDB))
+        self.assertRaises(ValueError, open_db, 'foo://bar')
+
+    def test_items(self):
+        self.db['crontab'] = {1: ('at', 'user@example.com')}
+        self.assertEqual(self.db['crontab'], {1: ('at', 'user@example.com')})
+        self.assertTrue('crontab' in self.db)
+        self.assertEqual(self.db.get('missing'), None)
+        self.assertEqual(list(self.db.keys()), ['crontab'])
+        del self.db['crontab']
+        self.assertEqual(len(self.db), 0)
+        self.assertRaises(KeyError, self.db.__delitem__, 'crontab')
+
+    def test_transaction(self):
+        with self.db.transaction():
+            self.db['a'] = 1
+            self.db['b'] = 2
+
+        try:
+            with self.db.transaction():
+                self.db['a'] = 3
+                raise RuntimeError
+        except RuntimeError:
+            pass
+
+        self.assertEqual(dict(self.db.items()), {'a': 1, 'b': 2})
+
+    def test_import_shelf(self):
+        shelf_file = os.path.join(self.tmpdir, 'ludolph.shelf')
+        shelf = LudolphDB(shelf_file)
+        shelf['ludolph.bot'] = {'room_users_invited': set(['user@example.com'])}
+        shelf.close()
+
+        self.assertEqual(self.db.import_shelf(shelf_file), 1)
+        self.assertEqual(self.db['ludolph.bot'], {'room_users_invited': set(['user@example.com'])})
+
+    def test_compact(self):
+        self.db.update(('key%d' % i, 'x' * 1000) for i in range(100))
+        self.db.update(('key%d' % i, 'y') for i in range(100))
+        size_before, size_after = self.db.compact()
+        self.assertTrue(size_after < size_before)
+        self.assertEqual(self.db['key1'], 'y')
+
+
+class LudolphDBWriterTest(unittest.TestCase):
+
+    tmpdir = None
+    db = None
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dbfile = os.path.join(self.tmpdir, 'ludolph.shelf')
+        self.db = open_db(self.dbfile, writer=True)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_open_db(self):
+        self.assertTrue(isinstance(self.db, LudolphDBWriter))
+        self.assertTrue(isinstance(self.db.db, LudolphDB))
+
+    def test_pending_items(self):
+        self.db.delay = 60  # Nothing will be written until flush
+        self.db['crontab'] = {1: 'first'}
+        self.db['crontab'] = {1: 'second'}
+        self.assertEqual(self.db['crontab'], {1: 'second'})
+        self.assertEqual(list(self.db.keys()), ['crontab'])
+        del self.db['crontab']
+        self.assertFalse('crontab' in self.db)
+        self.assertRaises(KeyError, self.db.__delitem__, 'crontab')
+
+    def test_flush(self):
+        self.db['a'] = 1
+        self.db['b'] = [2]
+        self.db.flush()
+        self.assertEqual(self.db.db['a'], 1)
+        self.assertEqual(self.db.db['b'], [2])
+        self.db.close()
+
+        self.db = open_db(self.dbfile)
+        self.assertEqual(dict(self.db.items()), {'a': 1, 'b': [2]})
+
+    def test_coalescing(self):
+        batches = []
+        write = self.db._write
+        self.db._write = lambda batch: batches.append(list(batch)) or write(batch)
+
+        for i in range(20):
+            self.db['a'] = i
+            time.sleep(0.01)
+
+        self.db.flush()
+        self.assertEqual(batches, [['a']])  # 20 writes within the coalescing window -> one backend write
+        self.assertEqual(self.db.db['a'], 19)
+
+    def test_retry(self):
+        backend = self.db.db
+        set_raw = backend.set_raw
+        errors = []
+
+        def failing_set_raw(key, data):
+            if not errors:
+                errors.append(key)
+                raise IOError('Disk full')
+            return set_raw(key, data)
+
+        backend.set_raw = failing_set_raw
+        self.db['a'] = 1
+        self.db['b'] = 2
+        self.db.flush()
+        self.assertEqual(errors, ['a'])
+        self.assertFalse('a' in backend)  # The failed batch was not written
+        self.assertEqual(self.db['a'], 1)  # But it is still queued
+
+        self.db.delay = 60  # Nothing will be written until flush
+        self.db['b'] = 3  # Newer data are kept
+        self.db.flush()
+        self.assertEqual((backend['a'], backend['b']), (1, 3))
+
+    def test_compact(self):
+        for i in range(100):
+            self.db['key%d' % i] = 'x' * 1000
+
+        self.db.flush()
+
+        for i in range(100):
+            del self.db['key%d' % i]
+
+        self.db['a'] = 1
+        size_before, size_after = self.db.compact()
+        self.assertTrue(size_after <= size_before)
+        self.assertEqual(dict(self.db.items()), {'a': 1})
+        self.assertEqual(self.db.db['a'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+"""
+
+import unittest
+from ludolph.deferred import DeferredMessages
+
+
+class DeferredMessagesTest(unittest.TestCase):
+
+    def test_statuses(self):
+        deferred = DeferredMessages()
+        self.assertFalse(deferred.enabled)
+        deferred.set_statuses(['offline', 'dnd', 'foo'])
+        self.assertEqual(deferred.statuses, frozenset(['offline', 'dnd']))
+        self.assertTrue(deferred.is_deferred('dnd'))
+        self.assertFalse(deferred.is_deferred('online'))
+
+    def test_pop(self):
+        deferred = DeferredMessages(statuses=['offline'])
+        deferred.maxsize = 2
+        deferred.add('user@example.com', 'PROBLEM: disk', tags=(1,))
+        deferred.add('user@example.com', 'PROBLEM: cpu')
+        deferred.add('user@example.com', 'PROBLEM: cpu')
+        deferred.add('user@example.com', 'PROBLEM: memory', tags=(2,))
+        self.assertTrue('user@example.com' in deferred)
+        self.assertEqual(len(deferred), 2)
+
+        text, tags = deferred.pop('user@example.com')
+        self.assertEqual(tags, [1, 2])  # Dropped messages are delivered as part of the combined message
+        lines = text.split('\n')
+        self.assertEqual(lines[0], '**4 messages received while you were away:**')
+        self.assertTrue(lines[1].endswith('PROBLEM: cpu __(2x)__'))
+        self.assertTrue(lines[2].endswith('PROBLEM: memory'))
+        self.assertEqual(lines[3], '__(1 older messages were dropped)__')
+        self.assertEqual(deferred.pop('user@example.com'), (None, []))
+        self.assertFalse('user@example.com' in deferred)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import threading
+from ludolph.ingest import IngestServer, IngestClient
+
+
+class FakeXMPP(object):
+    room = 'room@conference.example.com'
+    client_roster = {'user@example.com': {}}
+
+    def __init__(self):
+        self.sent = []
+
+    def msg_alert(self, mto, mbody, mtype=None, trigger=None, sync=True):
+        self.sent.append((mto, mbody, mtype))
+
+    def msg_broadcast(self, mbody, **kwargs):
+        self.sent.append(('*', mbody, None))
+        return 3
+
+
+class IngestServerTest(unittest.TestCase):
+
+    tmpdir = None
+    xmpp = None
+    ingest = None
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.xmpp = FakeXMPP()
+        self.ingest = IngestServer(self.xmpp, os.path.join(self.tmpdir, 'ludolph.sock'))
+        thread = threading.Thread(target=self.ingest.start)
+        thread.daemon = True
+        thread.start()
+
+        for _ in range(50):
+            if os.path.exists(self.ingest.path):
+                break
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.ingest.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_pipelined_requests(self):
+        requests = [
+            {'id': 1, 'jid': 'user@example.com', 'msg': 'hello'},
+            {'id': 2, 'type': 'room', 'msg': 'hello room'},
+            {'id': 3, 'type': 'broadcast', 'msg': 'hello all'},
+            {'id': 4, 'jid': 'stranger@example.com', 'msg': 'hello'},
+            {'id': 5, 'type': 'foo', 'msg': 'bar'},
+        ]
+
+        with IngestClient(self.ingest.path, window=2) as client:
+            responses = list(client.send(requests))
+
+        self.assertEqual([r['id'] for r in responses], [1, 2, 3, 4, 5])
+        self.assertEqual([r['ok'] for r in responses], [True, True, True, False, False])
+        self.assertEqual(responses[2]['result'], 'Message sent (3x)')
+        self.assertEqual(self.xmpp.sent, [
+            ('user@example.com', 'hello', 'normal'),
+            ('room@conference.example.com', 'hello room', 'groupchat'),
+            ('*', 'hello all', None),
+        ])
+
+    def test_sync_empty_outbox(self):
+        synced = []
+
+        class EmptyOutbox(object):
+            def __len__(self):
+                return 0
+
+            def sync(self):
+                synced.append(True)
+
+        self.xmpp.outbox = EmptyOutbox()
+        self.ingest.sync()
+        self.assertEqual(synced, [True])
+
+    def test_invalid_request(self):
+        self.assertFalse(b'"ok": true' in self.ingest.process(b'not json\n'))
+        self.assertFalse(b'"ok": true' in self.ingest.process(b'[1, 2]\n'))
+        self.assertTrue(b'"ok": true' in self.ingest.process(b'{"jid": "user@example.com", "msg": "x"}\n'))
+
+    def test_stop(self):
+        self.ingest.stop()
+        self.assertFalse(os.path.exists(self.ingest.path))
+        self.ingest.server = None  # Already stopped
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+"""
+
+import os
+import sys
+import shutil
+import logging
+import tempfile
+import unittest
+import subprocess
+from collections import namedtuple
+
+from ludolph.main import LISTEN_FD_ENV, get_executable, get_restart_env, restart
+
+FakeBot = namedtuple('FakeBot', ('webserver',))
+
+CLOSE_FDS_SCRIPT = '''
+import os
+import sys
+import ludolph.main
+
+if sys.argv[1] == 'rlimit':
+    ludolph.main.get_open_fds = lambda: None
+
+keep_r, keep_w = os.pipe()
+close_r, close_w = os.pipe()
+ludolph.main.close_fds(keep_fds=(keep_r, keep_w))
+os.write(keep_w, b'ok')
+assert os.read(keep_r, 2) == b'ok'
+
+for fd in (0, 1, 2, close_r, close_w):
+    try:
+        os.fstat(fd)
+    except OSError:
+        continue
+    else:
+        os._exit(3)
+
+os._exit(0)
+'''
+
+
+class FakeWebServer(object):
+    def __init__(self, fd):
+        self.fd = fd
+
+    def get_listen_fd(self):
+        return self.fd
+
+
+class RestartTest(unittest.TestCase):
+
+    def test_get_executable(self):
+        tmpdir = tempfile.mkdtemp()
+        path = os.environ.get('PATH')
+
+        try:
+            executable = os.path.join(tmpdir, 'ludolph-python')
+            open(executable, 'w').close()
+            os.chmod(executable, 0o755)
+            os.environ['PATH'] = tmpdir
+            self.assertEqual(get_executable('ludolph-python'), executable)
+            self.assertEqual(get_executable(executable), executable)
+            self.assertEqual(get_executable('missing-python'), sys.executable)
+            self.assertEqual(get_executable(os.path.join(tmpdir, 'missing-python')), sys.executable)
+            self.assertEqual(get_executable(''), sys.executable)
+            self.assertEqual(get_executable(None), sys.executable)
+        finally:
+            if path is None:
+                del os.environ['PATH']
+            else:
+                os.environ['PATH'] = path
+
+            shutil.rmtree(tmpdir)
+
+    def test_get_restart_env(self):
+        os.environ[LISTEN_FD_ENV] = '99'  # From a previous restart
+
+        try:
+            self.assertEqual(get_restart_env(FakeBot(FakeWebServer(7)))[LISTEN_FD_ENV], '7')
+            self.assertFalse(LISTEN_FD_ENV in get_restart_env(FakeBot(FakeWebServer(None))))
+            self.assertFalse(LISTEN_FD_ENV in get_restart_env(FakeBot(None)))
+            self.assertEqual(get_restart_env(FakeBot(None)).get('PATH'), os.environ.get('PATH'))
+        finally:
+            del os.environ[LISTEN_FD_ENV]
+
+    def test_restart_failure(self):
+        execve, shutdown = os.execve, logging.shutdown
+        calls = []
+
+        def failing_execve(*args):
+            calls.append(args)
+            raise OSError(2, 'No such file or directory')
+
+        os.execve = failing_execve
+        logging.shutdown = lambda: calls.append('logging.shutdown')
+
+        try:
+            with self.assertRaises(SystemExit) as cm:
+                restart(FakeBot(None), ['python', '/usr/bin/ludolph', '-d'])
+        finally:
+            os.execve, logging.shutdown = execve, shutdown
+
+        self.assertEqual(cm.exception.code, 1)
+        self.assertEqual(calls[0][:2], (get_executable('python'), [get_executable('python'), '/usr/bin/ludolph', '-d']))
+        self.assertEqual(calls[1], 'logging.shutdown')
+
+    def _close_fds(self, mode):
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        return subprocess.call([sys.executable, '-c', CLOSE_FDS_SCRIPT, mode], env=env)
+
+    def test_close_fds(self):
+        self.assertEqual(self._close_fds('proc'), 0)
+
+    def test_close_fds_rlimit(self):  # Without /proc filesystem
+        self.assertEqual(self._close_fds('rlimit'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
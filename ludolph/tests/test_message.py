@@ -0,0 +1,100 @@
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+"""
+
+import unittest
+from ludolph.command import PermissionDenied, ROLE_USER, ROLE_ADMIN
+from ludolph.main import Plugin
+from ludolph.message import IncomingLudolphMessage, RequestContext
+from ludolph.plugins.base import Base
+from ludolph.tests.fake_bot import create_bot
+
+
+class RequestContextTest(unittest.TestCase):
+
+    bot = None
+
+    def setUp(self):
+        self.bot = create_bot({'base': {}}, plugins=[Plugin('base', Base.__module__, Base)])
+
+    def tearDown(self):
+        self.assertRaises(SystemExit, self.bot.shutdown, None, None)  # SystemExit because we are not connected
+
+    def _message(self, body, jid='friend1@test.com', **kwargs):
+        msg = IncomingLudolphMessage.load(dict({
+            'type': 'chat',
+            'from': jid + '/resource',
+            'to': self.bot.boundjid.bare,
+            'body': body,
+        }, **kwargs))
+        msg.context = self.bot.get_request_context(msg)
+
+        return msg
+
+    def _no_roles_lookup(self):
+        def get_jid_roles(jid):
+            raise AssertionError('Roles of %s were computed again' % jid)
+
+        self.bot.get_jid_roles = get_jid_roles
+
+    def test_request_context(self):
+        msg = self._message('about')
+        context = msg.context
+        self.assertTrue(isinstance(context, RequestContext))
+        self.assertEqual(context.jid, 'friend1@test.com')
+        self.assertEqual(context.roles, self.bot.get_jid_roles('friend1@test.com'))
+        self.assertTrue(context.roles & ROLE_ADMIN)
+        self.assertEqual(context.mtype, 'chat')
+        self.assertEqual(context.nick, None)
+        self.assertTrue(context.elapsed >= 0)
+
+    def test_msg_copy(self):
+        msg = self._message('about')
+        msg_copy = self.bot.msg_copy(msg, body='uptime')
+        self.assertTrue(msg_copy.context is msg.context)
+        self.assertEqual((msg['body'], msg_copy['body']), ('about', 'uptime'))
+        self.assertEqual(self._message('about').__copy__().context.jid, 'friend1@test.com')
+
+    def test_msg_reply_preserve_msg(self):
+        msg = self._message('about')
+        copies = []
+        msg_copy = self.bot.msg_copy
+
+        def record_copy(*args, **kwargs):
+            copies.append(msg_copy(*args, **kwargs))
+            return copies[-1]
+
+        self.bot.msg_copy = record_copy
+        self.bot.msg_reply(msg, 'line', preserve_msg=True)
+        self.assertEqual(len(copies), 1)
+        self.assertTrue(copies[0].context is msg.context)
+        self.assertEqual(copies[0]['to'], msg['from'])  # The copy was used for the reply
+        self.assertEqual(msg['to'], self.bot.boundjid.bare)  # The original message was preserved
+        self.assertEqual(msg['body'], 'about')
+
+    def test_get_jid(self):
+        msg = self._message('about')
+        msg.context = msg.context._replace(jid='other@test.com')
+        self.assertEqual(self.bot.get_jid(msg), 'other@test.com')  # Resolved when the message was received
+        self.assertEqual(self.bot.get_jid(msg, bare=False), msg['from'])
+
+    def test_command_permissions(self):
+        status = self.bot.commands['status']
+        self.assertTrue(status.perms.admin_required)
+        admin = self._message('status away', reply_output=False)
+        admin.context = admin.context._replace(roles=ROLE_USER)  # friend1 is admin, but the context says otherwise
+        user = self._message('status away', jid='friend2@test.com', reply_output=False)
+        user.context = user.context._replace(roles=ROLE_USER | ROLE_ADMIN)
+        self._no_roles_lookup()
+
+        self.assertEqual(status.get_fun(self.bot)(admin), str(PermissionDenied()))
+        self.assertEqual(status.get_fun(self.bot)(user), 'Status updated')
+        self.assertFalse(status.is_jid_permitted_to_run(self.bot, 'friend1@test.com', roles=admin.context.roles))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+"""
+
+import unittest
+from ludolph.metrics import Registry
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_render(self):
+        registry = Registry()
+        counter = registry.counter('ludolph_test_total', 'Test counter', ('command',))
+        counter.labels('uptime').inc()
+        counter.labels('uptime').inc(2)
+        counter.labels('say "hi"').inc()
+        self.assertTrue(registry.counter('ludolph_test_total', 'Test counter', ('command',)) is counter)
+        registry.gauge('ludolph_test_size', 'Test gauge', fun=lambda: 7)
+        histogram = registry.histogram('ludolph_test_seconds', 'Test histogram', buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.1)
+        histogram.observe(5)
+
+        lines = registry.render().splitlines()
+        self.assertTrue('# TYPE ludolph_test_total counter' in lines)
+        self.assertTrue('ludolph_test_total{command="uptime"} 3.0' in lines)
+        self.assertTrue('ludolph_test_total{command="say \\"hi\\""} 1.0' in lines)
+        self.assertTrue('ludolph_test_size 7.0' in lines)
+        self.assertTrue('ludolph_test_seconds_bucket{le="0.1"} 2.0' in lines)
+        self.assertTrue('ludolph_test_seconds_bucket{le="1.0"} 2.0' in lines)
+        self.assertTrue('ludolph_test_seconds_bucket{le="+Inf"} 3.0' in lines)
+        self.assertTrue('ludolph_test_seconds_count 3.0' in lines)
+        self.assertTrue('ludolph_test_seconds: 3 (avg 1.717 s)' in registry.summary())
+
+    def test_type_conflict(self):
+        registry = Registry()
+        registry.gauge('ludolph_test', 'Test')
+        self.assertRaises(AssertionError, registry.counter, 'ludolph_test', 'Test')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from ludolph.outbox import Outbox
+from ludolph.tests.fake_bot import create_bot
+
+
+class OutboxTest(unittest.TestCase):
+
+    tmpdir = None
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_recover(self):
+        outbox = Outbox(self.tmpdir)
+        seq1 = outbox.append({'to': 'user@example.com', 'body': 'PROBLEM'})
+        seq2 = outbox.append({'to': 'user@example.com', 'body': 'OK'}, sync=False)
+        outbox.sent(seq1)
+        outbox.sent(seq2)
+        self.assertEqual(outbox.pending(), [])
+        outbox.unsend()  # Connection lost
+        self.assertEqual([seq for seq, _ in outbox.pending()], [seq1, seq2])
+        outbox.sent(seq1)
+        outbox.confirm()
+        outbox.close()
+
+        with open(os.path.join(self.tmpdir, os.listdir(self.tmpdir)[0]), 'ab') as fp:
+            fp.write(b'{"seq": 3, "to"')  # Crash during write
+
+        outbox = Outbox(self.tmpdir)
+        self.assertEqual(outbox.pending(), [(seq2, {'seq': seq2, 'to': 'user@example.com', 'body': 'OK'})])
+        self.assertEqual(outbox.append({'body': 'new'}), seq2 + 1)
+        outbox.close()
+
+    def test_hold(self):
+        outbox = Outbox(self.tmpdir)
+        seq1 = outbox.append({'body': 'PROBLEM'})
+        seq2 = outbox.append({'body': 'OK'})
+        outbox.hold(seq1)
+        outbox.hold(seq2)
+        self.assertEqual(outbox.pending(), [])  # Alerts waiting e.g. for a digest are not replayed
+        outbox.release(seq2)
+        self.assertEqual([seq for seq, _ in outbox.pending()], [seq2])
+        outbox.sent(seq1)
+        outbox.unsend()
+        self.assertEqual([seq for seq, _ in outbox.pending()], [seq1, seq2])
+        outbox.close()
+
+    def test_confirm_after_close(self):
+        outbox = Outbox(self.tmpdir)
+        seq = outbox.append({'body': 'PROBLEM'})
+        outbox.sent(seq)
+        outbox.close()
+        outbox.confirm()  # Ignored after close
+
+        outbox = Outbox(self.tmpdir)
+        self.assertEqual([seq for seq, _ in outbox.pending()], [seq])
+        outbox.close()
+
+    def test_bot_shutdown(self):
+        bot = create_bot({'global': {'outbox': self.tmpdir}})
+        seq = bot.outbox.append({'body': 'PROBLEM'})
+        bot.outbox.sent(seq)
+        scheduler_remove = bot.client.scheduler.remove
+        removed = []
+
+        def remove(name):
+            removed.append((name, bot.outbox._closing))
+            scheduler_remove(name)
+
+        bot.client.scheduler.remove = remove
+        self.assertRaises(SystemExit, bot.shutdown, None, None)  # SystemExit because we are not connected
+        self.assertTrue(('ludolph_outbox_confirm', False) in removed)  # Removed before the outbox was closed
+        bot.outbox.confirm()  # A confirm job that was already running when the job was removed
+        self.assertEqual(len(bot.outbox), 1)
+
+    def test_compact(self):
+        outbox = Outbox(self.tmpdir)
+        outbox.segment_size = 100
+        seqs = [outbox.append({'body': 'x' * 50}, sync=False) for _ in range(10)]
+        outbox.sync()
+        self.assertTrue(len(os.listdir(self.tmpdir)) > 5)
+        outbox.ack(seqs[1:])
+        self.assertTrue(len(os.listdir(self.tmpdir)) > 5)  # The first segment is not acknowledged
+        outbox.ack(seqs[:1])
+        self.assertEqual(len(os.listdir(self.tmpdir)), 1)
+        self.assertEqual(len(outbox), 0)
+        outbox.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from ludolph.db import open_db
+from ludolph.main import Plugin
+from ludolph.plugins.plugin import LudolphPlugin
+from ludolph.tests.fake_bot import create_bot
+
+
+class Counter(LudolphPlugin):
+    persistent_attrs = ('counts', 'total')
+
+    def __init__(self, *args, **kwargs):
+        super(Counter, self).__init__(*args, **kwargs)
+        self.counts = {}
+        self.total = 0
+
+    def count(self, name):
+        self.counts[name] = self.counts.get(name, 0) + 1
+        self.total += 1
+        self._db_changed()
+
+
+class PersistentAttrsTest(unittest.TestCase):
+
+    tmpdir = None
+    dbfile = None
+    bot = None
+    plugin = None
+    name = Counter.__module__
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dbfile = 'sqlite://' + os.path.join(self.tmpdir, 'ludolph.db')
+        self.bot = create_bot({'global': {'dbfile': self.dbfile}, self.name: {}},
+                              plugins=[Plugin(self.name, self.name, Counter)])
+        self.plugin = self.bot.plugins[self.name]
+
+    def tearDown(self):
+        self.bot._db_close()
+        shutil.rmtree(self.tmpdir)
+
+    def _saved(self, name):
+        self.bot.db.flush()
+        return self.bot.db.get(name)
+
+    def test_checkpoint(self):
+        self.assertEqual(self.bot._db_set_items_all(), [])  # Nothing has changed
+
+        self.plugin.count('foo')
+        self.assertEqual(self.bot._db_set_items_all(), [self.name])
+        self.assertEqual(self._saved(self.name), {'counts': {'foo': 1}, 'total': 1})
+        self.assertEqual(self.bot._db_set_items_all(), [])  # Saved only once
+
+        self.bot._update_room_users_last_seen('friend1@test.com')
+        self.assertEqual(self.bot._db_set_items_all(), ['ludolph.bot'])
+        self.assertEqual(list(self._saved('ludolph.bot')['room_users_last_seen']), ['friend1@test.com'])
+
+    def test_unmarked_change(self):
+        self.plugin.counts['foo'] = 1  # Not marked as changed
+        self.bot._db_checkpoint()
+        self.assertEqual(self._saved(self.name), None)  # Skipped by the checkpoint
+        self.assertRaises(SystemExit, self.bot.shutdown, None, None)  # SystemExit because we are not connected
+
+        db = open_db(self.dbfile)
+
+        try:
+            self.assertEqual(db.get(self.name), {'counts': {'foo': 1}, 'total': 0})  # Saved during shutdown
+        finally:
+            db.close()
+
+    def test_load_cache(self):
+        self.plugin.count('foo')
+        self.bot._db_set_items_all()
+        self.bot.db.flush()
+        db_get = self.bot.db.get
+        reads = []
+
+        def get(*args, **kwargs):
+            reads.append(args[0])
+            return db_get(*args, **kwargs)
+
+        self.bot.db.get = get
+        plugin = Counter(self.bot, {})
+        plugin._db_load()
+        plugin._db_load()
+        self.assertEqual(reads, [self.name])  # Second load is served from cache
+        self.assertEqual(plugin.counts, {'foo': 1})
+
+        plugin.counts['foo'] = 5  # Loaded data are not shared with the cache
+        plugin._db_load()
+        self.assertEqual(plugin.counts, {'foo': 1})
+
+        self.plugin.count('bar')
+        self.bot._db_set_items_all()  # Saving invalidates cached data
+        self.bot.db.flush()
+        plugin._db_load()
+        self.assertEqual(reads, [self.name, self.name])
+        self.assertEqual(plugin.counts, {'foo': 1, 'bar': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
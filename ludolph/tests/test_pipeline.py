@@ -0,0 +1,60 @@
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+"""
+
+import unittest
+from ludolph.command import CommandError, parse_pipeline, run_pipeline
+
+
+class LudolphPipelineTest(unittest.TestCase):
+
+    lines = ('alpha 3', 'beta 1', 'gamma 2', 'Alpha 10')
+
+    def _run(self, body, output=None):
+        cmd_body, filters = parse_pipeline(body)
+        return run_pipeline(self.lines if output is None else output, filters)
+
+    def test_parse_pipeline(self):
+        self.assertEqual(parse_pipeline('uptime')[0], 'uptime')
+        self.assertEqual(parse_pipeline('uptime | head 2')[0], 'uptime')
+        self.assertEqual(len(parse_pipeline('cmd | grep x | head')[1]), 2)
+        # Unknown filters and quoted pipes are part of the command
+        self.assertEqual(parse_pipeline('message a@b.c x | y'), ('message a@b.c x | y', []))
+        self.assertEqual(parse_pipeline('cmd "a | head" | count')[0], 'cmd "a | head"')
+
+    def test_filters(self):
+        self.assertEqual(self._run('x | grep alpha'), ['alpha 3'])
+        self.assertEqual(self._run('x | grep -i alpha'), ['alpha 3', 'Alpha 10'])
+        self.assertEqual(self._run('x | grep -v a'), [])
+        self.assertEqual(self._run('x | head 1'), ['alpha 3'])
+        self.assertEqual(self._run('x | tail 1'), ['Alpha 10'])
+        self.assertEqual(self._run('x | count'), ['4'])
+        self.assertEqual(self._run('x | sort'), ['Alpha 10', 'alpha 3', 'beta 1', 'gamma 2'])
+        self.assertEqual(self._run('x | sort -r | head 1'), ['gamma 2'])
+        self.assertEqual(self._run('x | grep a | count', output='a\nb\na'), ['2'])
+
+    def test_invalid_filters(self):
+        self.assertRaises(CommandError, parse_pipeline, 'x | grep')
+        self.assertRaises(CommandError, parse_pipeline, 'x | head foo')
+        self.assertRaises(CommandError, parse_pipeline, 'x | count 1')
+
+    def test_head_closes_output(self):
+        consumed = []
+
+        def output():
+            for i in range(100):
+                consumed.append(i)
+                yield str(i)
+
+        gen = output()
+        self.assertEqual(run_pipeline(gen, parse_pipeline('x | head 2')[1]), ['0', '1'])
+        self.assertEqual(len(consumed), 2)
+        self.assertRaises(StopIteration, next, gen)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+"""
+
+import unittest
+from ludolph.deferred import OFFLINE, ONLINE
+from ludolph.tests.fake_bot import create_bot
+
+JID = 'friend1@test.com'
+
+
+class PresenceTest(unittest.TestCase):
+
+    bot = None
+
+    def setUp(self):
+        self.bot = create_bot()
+
+    def tearDown(self):
+        self.assertRaises(SystemExit, self.bot.shutdown, None, None)  # SystemExit because we are not connected
+
+    def _presence(self, resource, show=None, priority=0, ptype=None):
+        """Process presence stanza like SleekXMPP does (the roster is updated first)"""
+        client = self.bot.client
+        pres = client.make_presence(pshow=show, ppriority=priority, ptype=ptype, pto=client.boundjid,
+                                    pfrom='%s/%s' % (JID, resource))
+        client.event('presence_%s' % pres['type'], pres, direct=True)
+
+    def test_resource_selection(self):
+        self.assertEqual(self.bot.get_jid_resource(JID), (None, None))
+        self.assertEqual(self.bot.get_jid_availability(JID), OFFLINE)
+
+        self._presence('phone', show='away', priority=1)
+        self._presence('desktop', priority=5)
+        self.assertEqual(self.bot.get_jid_resource(JID)[0], 'desktop')
+        self.assertEqual(self.bot.get_jid_availability(JID), ONLINE)
+        self.assertEqual(self.bot.get_jid_resource(JID + '/phone')[0], 'phone')
+        self.assertEqual(self.bot.get_jid_status(JID + '/phone'), 'away')
+
+    def test_priority_change(self):
+        self._presence('phone', show='dnd', priority=1)
+        self._presence('desktop', priority=5)
+        self.assertFalse(self.bot.has_jid_status(JID, 'dnd'))
+
+        self._presence('phone', show='dnd', priority=10)  # Only the priority has changed (no changed_status event)
+        self.assertEqual(self.bot.get_jid_resource(JID)[0], 'phone')
+        self.assertTrue(self.bot.has_jid_status(JID, 'dnd'))
+
+    def test_offline(self):
+        self._presence('phone', show='away', priority=1)
+        self._presence('desktop', priority=5)
+        self._presence('desktop', ptype='unavailable')
+        self.assertEqual(self.bot.get_jid_resource(JID)[0], 'phone')
+        self.assertEqual(self.bot.get_jid_availability(JID), 'away')
+
+        self._presence('phone', ptype='unavailable')
+        self.assertEqual(self.bot.get_jid_resource(JID), (None, None))
+        self.assertEqual(self.bot.get_jid_availability(JID), OFFLINE)
+
+    def test_cache_miss(self):
+        self._presence('desktop', show='xa')
+        self.bot._presence.clear()  # E.g. on session start
+        self.assertEqual(self.bot.get_jid_resource(JID)[0], 'desktop')
+        self.assertEqual(self.bot.get_jid_status(JID), 'xa')
+
+
+if __name__ == '__main__':
+    unittest.main()
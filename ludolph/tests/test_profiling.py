@@ -0,0 +1,75 @@
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+"""
+
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+from ludolph.profiling import Profiler, ProfilerError
+
+
+def work(n):
+    return sum(i * i for i in range(n))
+
+
+def stream(n):
+    for i in range(n):
+        yield work(i)
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def test_inactive(self):
+        profiler = Profiler()
+        self.assertEqual(profiler.call(work, 10), 285)
+        self.assertEqual(profiler.calls, 0)
+        self.assertRaises(ProfilerError, profiler.top)
+        self.assertRaises(ProfilerError, profiler.stop)
+
+    def test_max_calls(self):
+        profiler = Profiler()
+        profiler.start(duration=0, max_calls=2)
+        self.assertRaises(ProfilerError, profiler.start)
+
+        for _ in range(3):
+            self.assertEqual(profiler.call(work, 1000), 332833500)
+
+        self.assertFalse(profiler.active)
+        self.assertEqual(profiler.calls, 2)
+        top = profiler.top(limit=5)
+        self.assertTrue(top)
+        self.assertTrue(any('work' in func for _, _, _, func in top))
+
+        tmpdir = tempfile.mkdtemp()
+
+        try:
+            path = os.path.join(tmpdir, 'ludolph.pstats')
+            profiler.save(path)
+            self.assertTrue(pstats.Stats(path).total_calls > 0)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_generator(self):
+        profiler = Profiler()
+        profiler.start(duration=0, max_calls=1)
+        output = profiler.call(stream, 100)
+        self.assertEqual(profiler.calls, 0)  # Not finished until the output is consumed
+        self.assertTrue(profiler.active)
+
+        self.assertEqual(list(output), [work(i) for i in range(100)])
+        self.assertEqual(profiler.calls, 1)
+        self.assertFalse(profiler.active)
+        self.assertTrue(any('work' in func for _, _, _, func in profiler.top()))  # Called only during iteration
+
+    def test_limit_required(self):
+        self.assertRaises(ProfilerError, Profiler().start, duration=0, max_calls=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,209 @@
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+from datetime import datetime
+
+try:
+    # noinspection PyCompatibility
+    from importlib import reload
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from imp import reload
+
+import ludolph.command
+import ludolph.cron
+import ludolph.web
+from ludolph.cron import Cron, CronTab
+from ludolph.main import Plugin, get_changed_plugins, get_module_mtime
+from ludolph.tests.fake_bot import create_config, create_bot
+
+PACKAGE = 'ludolph_reload_test'
+BASE_SECTIONS = ('global', 'xmpp', 'webserver', 'cron', 'alerts', 'ludolph.bot')
+
+PLUGIN_SOURCE = '''
+from ludolph.command import command
+from ludolph.cron import cronjob
+from ludolph.web import webhook
+from ludolph.plugins.plugin import LudolphPlugin
+
+
+class %(cls)s(LudolphPlugin):
+    @command
+    def %(name)s_cmd(self, msg):
+        return '%(name)s'
+
+    @webhook('/%(name)s')
+    def %(name)s_hook(self):
+        return '%(name)s'
+
+    @cronjob(minute='0')
+    def %(name)s_job(self):
+        return '%(name)s'
+'''
+
+
+def job_fun():
+    pass
+
+
+class CronPublishTest(unittest.TestCase):
+
+    cron = None
+
+    def setUp(self):
+        self.cron = Cron()
+        self.cron.crontab = CronTab()
+        self.cron.crontab.add('job', job_fun, minute='0')
+
+    def test_publish_crontab(self):
+        at = self.cron.crontab.add_onetime(job_fun, datetime.now())
+        done = self.cron.crontab.add_onetime(job_fun, datetime.now())
+        self.cron.crontab.delete(done.name)
+        crontab = CronTab()
+        self.cron.publish_crontab(crontab)
+        self.assertTrue(self.cron.crontab is crontab)
+        self.assertEqual(list(crontab.keys()), [at.name])  # Onetime jobs only
+
+    def test_publish_crontab_waits_for_onetime_job(self):
+        at = self.cron.crontab.add_onetime(job_fun, datetime.now())
+        crontab = CronTab()
+
+        with CronTab.lock:  # Like the cron thread finishing a onetime job
+            thread = threading.Thread(target=self.cron.publish_crontab, args=(crontab,))
+            thread.start()
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+            self.cron.crontab.delete(at.name)
+
+        thread.join()
+        self.assertTrue(self.cron.crontab is crontab)
+        self.assertEqual(len(crontab), 0)  # The finished job was not moved into the new crontab
+
+
+class PartialReloadTest(unittest.TestCase):
+
+    tmpdir = None
+    config = None
+    bot = None
+    registries = None
+    modules = (PACKAGE + '.alpha', PACKAGE + '.beta')
+
+    def _write_plugin(self, name, cls):
+        with open(os.path.join(self.tmpdir, PACKAGE, name + '.py'), 'w') as fp:
+            fp.write(PLUGIN_SOURCE % {'name': name, 'cls': cls})
+
+    def _plugins(self):
+        return [Plugin(modname, modname, getattr(sys.modules[modname], modname.split('.')[-1].capitalize()))
+                for modname in self.modules]
+
+    def setUp(self):
+        self.registries = (ludolph.command.COMMANDS, ludolph.web.WEBHOOKS, ludolph.cron.CRONJOBS)
+        self.tmpdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmpdir, PACKAGE))
+        open(os.path.join(self.tmpdir, PACKAGE, '__init__.py'), 'w').close()
+        self._write_plugin('alpha', 'Alpha')
+        self._write_plugin('beta', 'Beta')
+        sys.path.insert(0, self.tmpdir)
+
+        for modname in self.modules:
+            __import__(modname)
+
+        self.config = dict((modname, {}) for modname in self.modules)
+        self.config['cron'] = {'enabled': 'true'}
+        self.bot = create_bot(self.config, plugins=self._plugins())
+
+    def tearDown(self):
+        self.assertRaises(SystemExit, self.bot.shutdown, None, None)  # SystemExit because we are not connected
+        sys.path.remove(self.tmpdir)
+        shutil.rmtree(self.tmpdir)
+        ludolph.command.COMMANDS, ludolph.web.WEBHOOKS, ludolph.cron.CRONJOBS = self.registries
+
+        for modname in self.modules:
+            del sys.modules[modname]
+            ludolph.command.COMMANDS.reset(module=modname)
+
+            for registry in (ludolph.web.WEBHOOKS, ludolph.cron.CRONJOBS):
+                for name, item in tuple(registry.items()):
+                    if item.module == modname:
+                        del registry[name]
+
+        del sys.modules[PACKAGE]
+
+    def test_reload_changed_plugin(self):
+        bot = self.bot
+        alpha, beta = bot.plugins[self.modules[0]], bot.plugins[self.modules[1]]
+        beta_items = (bot.commands['beta-cmd'], bot._registry.webhooks['beta_hook'], bot.cron.crontab['beta_job'])
+        alpha_fun = bot._registry.webhooks['alpha_hook'].fun
+        at = bot.cron.crontab.add_onetime(job_fun, datetime.now())
+        changed = set(self.modules[:1])
+
+        bot.prereload(changed=changed)
+        self.assertTrue(bot.commands.get('alpha-cmd'))  # Published registry is still in use
+        reload(sys.modules[self.modules[0]])
+        reloaded = bot.reload(create_config(self.config), plugins=self._plugins(), changed=changed)
+
+        self.assertEqual(reloaded, [self.modules[0]])
+        self.assertFalse(bot.plugins[self.modules[0]] is alpha)
+        self.assertTrue(bot.plugins[self.modules[1]] is beta)
+        self.assertEqual((bot.commands['beta-cmd'], bot._registry.webhooks['beta_hook'], bot.cron.crontab['beta_job']),
+                         beta_items)
+        self.assertTrue(bot.commands.get('alpha-cmd'))
+        self.assertTrue(bot.cron.crontab.get('alpha_job'))
+        self.assertFalse(bot._registry.webhooks['alpha_hook'].fun is alpha_fun)  # Registered by reloaded module
+        self.assertTrue(bot.cron.crontab[at.name] is at)  # Onetime jobs are moved into the new crontab
+        self.assertTrue(ludolph.command.COMMANDS is bot.commands)
+
+    def test_reload_post_init(self):
+        post_init = []
+        self.bot.__post_init__ = lambda: post_init.append('ludolph.bot')
+        self.bot.prereload(changed=set())
+        self.assertEqual(self.bot.reload(create_config(self.config), plugins=self._plugins(), changed=set()), [])
+        self.assertEqual(post_init, ['ludolph.bot'])  # Bot configuration is reloaded even if no plugin has changed
+
+    def test_cancel_reload(self):
+        bot = self.bot
+        commands = bot.commands
+        bot.prereload(changed=set(self.modules))
+        self.assertFalse(ludolph.command.COMMANDS is commands)
+        bot.cancel_reload()
+        self.assertTrue(bot.commands is commands)
+        self.assertEqual((ludolph.command.COMMANDS, ludolph.web.WEBHOOKS, ludolph.cron.CRONJOBS),
+                         (commands, bot._registry.webhooks, bot.cron.crontab))
+        self.assertTrue(bot.commands.get('alpha-cmd'))
+
+    def test_get_changed_plugins(self):
+        alpha, beta = self.modules
+
+        for modname in self.modules:
+            sys.modules[modname]._mtime_ = get_module_mtime(sys.modules[modname])
+
+        old_config = create_config(self.config)
+        self.assertEqual(get_changed_plugins(old_config, create_config(self.config), BASE_SECTIONS), set())
+        self.assertEqual(get_changed_plugins(old_config, create_config(dict(self.config, **{alpha: {'x': '1'}})),
+                                             BASE_SECTIONS), set([alpha]))
+        beta_disabled = create_config(self.config)
+        beta_disabled.remove_section(beta)
+        self.assertEqual(get_changed_plugins(beta_disabled, old_config, BASE_SECTIONS), set([beta]))  # Enabled
+        self.assertEqual(get_changed_plugins(old_config, create_config({'xmpp': {'nick': 'Bot'}}), BASE_SECTIONS),
+                         None)  # Bot configuration has changed -> reload all plugins
+        self.assertEqual(get_changed_plugins(old_config, create_config(dict(self.config, alerts={})), BASE_SECTIONS),
+                         None)
+
+        mtime = sys.modules[beta]._mtime_
+        os.utime(sys.modules[beta].__file__, (mtime + 10, mtime + 10))
+        self.assertEqual(get_changed_plugins(old_config, create_config(self.config), BASE_SECTIONS), set([beta]))
+
+
+if __name__ == '__main__':
+    unittest.main()
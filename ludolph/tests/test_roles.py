@@ -0,0 +1,86 @@
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+"""
+
+import unittest
+from itertools import product
+from ludolph.command import (Command, CommandParameters, CommandPermissions, ROLE_USER, ROLE_ADMIN, ROLE_ROOM_USER,
+                             ROLE_ROOM_ADMIN)
+from ludolph.tests.fake_bot import create_bot
+
+JIDS = ('friend1@test.com', 'friend2@test.com', 'other@test.com', 'stranger@test.com')
+ROOM = 'room@conference.test.com'
+
+
+def is_permitted(xmpp, jid, perms):
+    """Permission check used before the role table was introduced"""
+    for perm, setting in ((perms.user_required, xmpp.users), (perms.admin_required, xmpp.admins),
+                          (perms.room_user_required, xmpp.room_users),
+                          (perms.room_admin_required, xmpp.room_admins)):
+        if perm and setting and jid not in setting:
+            return False
+
+    return True
+
+
+class JidRolesTest(unittest.TestCase):
+
+    configs = (
+        {},
+        {'users': '', 'admins': ''},
+        {'users': '', 'admins': 'other@test.com'},
+        {'room': ROOM, 'room_users': '@users', 'room_admins': '@admins'},
+        {'room': ROOM, 'room_users': '', 'room_admins': 'other@test.com'},
+        {'room': ROOM, 'users': '', 'room_users': 'friend2@test.com, @admins', 'room_admins': '@room_users'},
+    )
+
+    def _check_bot(self, bot):
+        for jid in JIDS:
+            for role, setting in ((ROLE_USER, bot.users), (ROLE_ADMIN, bot.admins),
+                                  (ROLE_ROOM_USER, bot.room_users), (ROLE_ROOM_ADMIN, bot.room_admins)):
+                expected = not setting or jid in setting  # An empty setting means everybody has the role
+                self.assertEqual(bool(bot.get_jid_roles(jid) & role), expected, (jid, role, setting))
+
+            for required in product((False, True), repeat=4):
+                perms = CommandPermissions(*required)
+                cmd = Command('test', 'test', __name__, '', perms, CommandParameters(0, 0, False))
+                self.assertEqual(cmd.is_jid_permitted_to_run(bot, jid), is_permitted(bot, jid, perms), (jid, perms))
+
+        self.assertTrue(bot.is_jid_user(JIDS[0]) is (not bot.users or JIDS[0] in bot.users))
+        self.assertTrue(bot.is_jid_admin(JIDS[2]) is (not bot.admins or JIDS[2] in bot.admins))
+
+    def test_roles(self):
+        for config in self.configs:
+            bot = create_bot({'xmpp': config})
+
+            try:
+                self._check_bot(bot)
+            finally:
+                self.assertRaises(SystemExit, bot.shutdown, None, None)  # SystemExit because we are not connected
+
+    def test_keyword_expansion(self):
+        bot = create_bot({'xmpp': self.configs[3]})
+
+        try:
+            self.assertEqual(bot.room_users, set(['friend1@test.com', 'friend2@test.com']))
+            self.assertEqual(bot.room_admins, set(['friend1@test.com']))
+            self.assertEqual(bot.get_jid_roles('friend1@test.com'), ROLE_USER | ROLE_ADMIN | ROLE_ROOM_USER |
+                             ROLE_ROOM_ADMIN)
+            self.assertEqual(bot.get_jid_roles('friend2@test.com'), ROLE_USER | ROLE_ROOM_USER)
+            self.assertEqual(bot.get_jid_roles('stranger@test.com'), 0)
+        finally:
+            self.assertRaises(SystemExit, bot.shutdown, None, None)
+
+    def test_command_perms_mask(self):
+        perms = CommandPermissions(True, False, True, False)
+        cmd = Command('test', 'test', __name__, '', perms, CommandParameters(0, 0, False))  # Without perms_mask
+        self.assertEqual(cmd.perms_mask, ROLE_USER | ROLE_ROOM_USER)
+        self.assertEqual(cmd._replace(doc='doc').perms_mask, cmd.perms_mask)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+"""
+
+import unittest
+from ludolph.tests.fake_bot import create_bot
+
+ROOM = 'room@conference.test.com'
+JID = 'friend1@test.com'
+
+
+class RoomOccupantsTest(unittest.TestCase):
+
+    bot = None
+
+    def setUp(self):
+        self.bot = create_bot({'xmpp': {'room': ROOM}})
+        self.bot.muc.rooms[ROOM] = {}  # Like joinMUC()
+        self.bot.muc.ourNicks[ROOM] = self.bot.nick
+
+    def tearDown(self):
+        self.assertRaises(SystemExit, self.bot.shutdown, None, None)  # SystemExit because we are not connected
+
+    def _presence(self, nick, jid=JID, ptype=None):
+        """Update the MUC plugin's room roster like SleekXMPP does and return the presence for our handlers"""
+        client = self.bot.client
+        pres = client.make_presence(ptype=ptype, pto=client.boundjid, pfrom='%s/%s' % (ROOM, nick))
+        pres['muc']['jid'] = jid + '/resource'
+        self.bot.muc.handle_groupchat_presence(pres)
+        return pres
+
+    def test_join(self):
+        self.bot._room_occupants_update(self._presence('friend'))
+        self.assertEqual(self.bot.get_room_nick(JID), 'friend')
+        self.assertEqual(self.bot.get_room_jid(JID), ROOM + '/friend')
+        self.assertTrue(self.bot.is_jid_in_room(JID))
+        self.assertFalse(self.bot.is_jid_in_room('friend2@test.com'))
+
+    def test_leave(self):
+        self.bot._room_occupants_update(self._presence('friend'))
+        self.bot._room_occupants_update(self._presence('friend', ptype='unavailable'))
+        self.assertEqual(self.bot._room_occupants, {})
+        self.assertEqual(self.bot.get_room_nick(JID), None)
+
+    def test_rejoin_out_of_order(self):
+        self.bot._room_occupants_update(self._presence('friend'))
+        offline = self._presence('friend', ptype='unavailable')
+        online = self._presence('friend')
+        self.bot._room_occupants_update(online)  # Threaded handlers processed the presences out of order
+        self.bot._room_occupants_update(offline)
+        self.assertEqual(self.bot._room_occupants, {JID: 'friend'})
+        self.assertEqual(self.bot.get_room_nick(JID), 'friend')
+
+    def test_nick_change(self):
+        self.bot._room_occupants_update(self._presence('friend'))
+        offline = self._presence('friend', ptype='unavailable')
+        online = self._presence('buddy')
+        self.bot._room_occupants_update(online)
+        self.bot._room_occupants_update(offline)
+        self.assertEqual(self.bot.get_room_nick(JID), 'buddy')
+
+        self.bot._room_occupants_update(self._presence('buddy', ptype='unavailable'))
+        self.bot._room_occupants_update(self._presence('friend'))
+        self.assertEqual(self.bot.get_room_nick(JID), 'friend')
+
+    def test_rebuild(self):
+        self._presence('friend')
+        self._presence('other', jid='friend2@test.com')
+        self.bot._room_occupants_rebuild()
+        self.assertEqual(self.bot._room_occupants, {JID: 'friend', 'friend2@test.com': 'other'})
+
+    def test_index_miss(self):
+        self._presence('friend')  # Our presence handler did not run yet
+        self.assertEqual(self.bot.get_room_nick(JID), 'friend')
+        self.assertEqual(self.bot._room_occupants, {JID: 'friend'})  # Index was repaired
+
+
+if __name__ == '__main__':
+    unittest.main()
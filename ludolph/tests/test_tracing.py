@@ -0,0 +1,71 @@
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from ludolph.tracing import Tracer, NOOP_SPAN, analyze, percentile
+
+
+class TracingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'trace.log')
+        self.tracer = Tracer()
+
+    def tearDown(self):
+        self.tracer.configure(None)
+        shutil.rmtree(self.tmpdir)
+
+    def test_disabled(self):
+        self.assertTrue(self.tracer.start('message') is None)
+        self.assertTrue(self.tracer.span('wrap') is NOOP_SPAN)
+        self.tracer.finish()
+
+    def test_trace(self):
+        self.tracer.configure(self.path)
+        self.tracer.start('message', type='chat')
+
+        with self.tracer.span('context'):
+            with self.tracer.span('jid'):
+                pass
+
+        self.tracer.finish()
+        self.assertTrue(self.tracer.span('send') is NOOP_SPAN)  # Trace is finished
+
+        with open(self.path) as fp:
+            lines = fp.readlines()
+
+        self.assertEqual(len(lines), 1)
+        trace = json.loads(lines[0])
+        self.assertEqual(trace['name'], 'message')
+        self.assertEqual(trace['attrs'], {'type': 'chat'})
+        self.assertEqual([name for name, _, _ in trace['spans']], ['jid', 'context'])
+
+        stages = analyze(lines)
+        self.assertEqual(list(stages.keys()), ['total', 'jid', 'context'])
+        self.assertEqual(len(stages['total']), 1)
+
+    def test_sampling(self):
+        self.tracer.configure(self.path, sample_rate=0)
+        self.assertTrue(self.tracer.start('message') is None)
+        self.assertTrue(self.tracer.span('wrap') is NOOP_SPAN)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile([], 50), 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
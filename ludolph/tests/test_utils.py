@@ -0,0 +1,82 @@
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+"""
+
+import unittest
+from ludolph.utils import LRUCache, TTLCache, PhaseTimer
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_get(self):
+        cache = LRUCache(maxsize=2)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('a', factory=str.upper), 'A')
+        self.assertEqual(cache.get('a', factory=str.lower), 'A')
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 2)
+        self.assertEqual(cache.stats()['hit_rate'], 1 / 3.0)
+
+    def test_maxsize(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')  # "b" is now the least recently used item
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+
+
+class TTLCacheTest(unittest.TestCase):
+
+    def test_ttl(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        cache.ttl = -1  # Following items expire immediately
+        cache.set('b', 2)
+        self.assertEqual(cache.get('b'), None)
+        self.assertFalse('b' in cache)
+        self.assertTrue('a' in cache)
+
+    def test_maxsize(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')  # A hit does not change the order
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertFalse('a' in cache)
+
+
+class PhaseTimerTest(unittest.TestCase):
+
+    def test_report(self):
+        timer = PhaseTimer()
+
+        with timer.phase('config parse'):
+            pass
+
+        timer.start('session start')
+        report = timer.report().splitlines()
+        self.assertEqual(len(report), 4)
+        self.assertTrue(report[1].startswith('config parse'))
+        self.assertTrue(report[2].endswith('unfinished'))
+        self.assertTrue(report[3].startswith('total'))
+
+    def test_disabled(self):
+        timer = PhaseTimer(enabled=False)
+
+        with timer.phase('config parse'):
+            pass
+
+        self.assertEqual(len(timer.report().splitlines()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
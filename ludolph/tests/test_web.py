@@ -0,0 +1,127 @@
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+"""
+
+import io
+import time
+import unittest
+import threading
+from wsgiref.util import setup_testing_defaults
+try:
+    from urllib.request import urlopen
+except ImportError:
+    # noinspection PyUnresolvedReferences,PyCompatibility
+    from urllib2 import urlopen
+
+from ludolph.web import WebServer
+
+
+class IdempotencyTest(unittest.TestCase):
+
+    def setUp(self):
+        from bottle import Bottle
+
+        self.calls = 0
+        self.webserver = WebServer()
+        self.app = Bottle()
+
+        def send_msg():
+            self.calls += 1
+            return 'Message sent (%d)' % self.calls
+
+        self.app.route('/message', ('POST',), self.webserver._idempotent_view(send_msg))
+
+    def post(self, body=b'msg=hello', **headers):
+        environ = {'REQUEST_METHOD': 'POST', 'PATH_INFO': '/message', 'wsgi.input': io.BytesIO(body),
+                   'CONTENT_LENGTH': str(len(body)), 'CONTENT_TYPE': 'application/x-www-form-urlencoded'}
+        environ.update(('HTTP_' + key.upper(), value) for key, value in headers.items())
+        setup_testing_defaults(environ)
+        status = []
+
+        output = b''.join(self.app(environ, lambda s, h, *args: status.append((s, dict(h)))))
+
+        return status[0][0], status[0][1], output.decode('utf-8')
+
+    def test_duplicates(self):
+        status, headers, body = self.post(idempotency_key='alert-1')
+        self.assertEqual(body, 'Message sent (1)')
+        status, headers, body = self.post(idempotency_key='alert-1')
+        self.assertEqual(body, 'Message sent (1)')
+        self.assertEqual(headers.get('Idempotent-Replayed'), 'true')
+        status, headers, body = self.post(body=b'msg=hello&idempotency_key=alert-1')
+        self.assertEqual(body, 'Message sent (1)')
+        status, headers, body = self.post(idempotency_key='alert-2')
+        self.assertEqual(body, 'Message sent (2)')
+        self.assertEqual(self.calls, 2)
+
+    def test_without_key(self):
+        self.post()
+        self.post()
+        self.assertEqual(self.calls, 2)
+
+    def test_disabled(self):
+        self.webserver.set_idempotency_ttl(0)
+        self.post(idempotency_key='alert-1')
+        self.post(idempotency_key='alert-1')
+        self.assertEqual(self.calls, 2)
+
+
+class WebServerTest(unittest.TestCase):
+
+    def test_api_tokens(self):
+        import bottle
+
+        webserver = WebServer()
+        webserver.load_api_tokens('admin@example.com:secret1, user@example.com: secret2, invalid:secret3')
+
+        for auth, user in (('Bearer secret1', 'admin@example.com'), ('Bearer secret2', 'user@example.com'),
+                           ('Bearer secret', None), ('Bearer secret3', None), ('Bearer ', None), ('', None)):
+            environ = {'HTTP_AUTHORIZATION': auth}
+            setup_testing_defaults(environ)
+            bottle.request.bind(environ)
+            self.assertEqual(webserver.get_api_user(), user)
+
+    def test_concurrent_requests(self):
+        from bottle import Bottle
+
+        app = Bottle()
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_view():
+            started.set()
+            release.wait(10)
+            return 'slow'
+
+        app.route('/slow', ('GET',), slow_view)
+        app.route('/fast', ('GET',), lambda: 'fast')
+        webserver = WebServer(port=0)
+        server_thread = threading.Thread(target=webserver.run, args=(app,))
+        server_thread.daemon = True
+        server_thread.start()
+
+        while webserver.server is None:
+            time.sleep(0.01)
+
+        url = 'http://127.0.0.1:%d' % webserver.server.server_port
+        slow = []
+        slow_thread = threading.Thread(target=lambda: slow.append(urlopen(url + '/slow', timeout=10).read()))
+        slow_thread.start()
+        started.wait(5)
+
+        try:
+            self.assertEqual(urlopen(url + '/fast', timeout=5).read(), b'fast')  # Not blocked by the slow request
+        finally:
+            release.set()
+            slow_thread.join()
+            webserver.stop()
+
+        self.assertEqual(slow, [b'slow'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,221 @@
+"""
+Ludolph: Monitoring Jabber bot
+Copyright (C) 2012-2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the file LICENSE for copying permission.
+
+Optional tracing of incoming message processing. A sampled message gets a trace, which collects timings of
+processing stages (spans) in the current thread. Finished traces are written as JSON lines into a file:
+
+    {"id": "...", "name": "message", "ts": 1500000000.0, "duration": 0.0123, "attrs": {...},
+     "spans": [["queue", 0.0, 0.0001], ["context", 0.0001, 0.0002], ...]}
+
+Each span is a [name, offset from trace start, duration] triple (in seconds). Spans can be nested.
+Per-stage percentiles can be displayed by: python -m ludolph.tracing <trace file> [...]
+"""
+from __future__ import print_function
+
+import sys
+import math
+import json
+import time
+import random
+import logging
+from threading import local, Lock
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # noinspection PyUnresolvedReferences,PyPackageRequirements
+    from ordereddict import OrderedDict
+
+__all__ = ('TRACER', 'span')
+
+logger = logging.getLogger(__name__)
+
+
+class _NoopSpan(object):
+    """Span used when the current thread is not traced"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class _Span(object):
+    __slots__ = ('trace', 'name', 'start')
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        end = time.time()
+        self.trace.spans.append((self.name, round(self.start - self.trace.start, 7), round(end - self.start, 7)))
+
+
+class Trace(object):
+    __slots__ = ('id', 'name', 'start', 'attrs', 'spans')
+
+    def __init__(self, name, start, attrs):
+        self.id = '%x-%x' % (int(start * 1000000), random.getrandbits(32))
+        self.name = name
+        self.start = start
+        self.attrs = attrs
+        self.spans = []
+
+    def to_json(self, end):
+        return json.dumps({'id': self.id, 'name': self.name, 'ts': self.start, 'duration': round(end - self.start, 7),
+                           'attrs': self.attrs, 'spans': self.spans})
+
+
+class Tracer(object):
+    """
+    Creates traces for a sample of messages and writes finished traces into a file. Disabled by default.
+    """
+    path = None
+    sample_rate = 1.0
+
+    def __init__(self):
+        self._local = local()
+        self._lock = Lock()
+        self._fp = None
+
+    @property
+    def enabled(self):
+        return self._fp is not None
+
+    def configure(self, path=None, sample_rate=1.0):
+        """Enable tracing into file (or disable tracing if path is empty)"""
+        with self._lock:
+            if path != self.path and self._fp:
+                self._fp.close()
+                self._fp = None
+
+            if path and not self._fp:
+                try:
+                    self._fp = open(path, 'a')
+                except IOError as e:
+                    logger.error('Could not open trace file %s: %s', path, e)
+                    path = None
+                else:
+                    logger.info('Tracing %g%% of messages into %s', sample_rate * 100, path)
+
+            self.path = path
+            self.sample_rate = sample_rate
+
+    def start(self, name, started=None, **attrs):
+        """Start a trace in the current thread if the tracer is enabled and the sample is selected"""
+        if self._fp is None or random.random() >= self.sample_rate:
+            self._local.trace = None
+            return None
+
+        now = time.time()
+
+        if started is None:
+            started = now
+
+        trace = self._local.trace = Trace(name, started, attrs)
+
+        if now > started:
+            trace.spans.append(('queue', 0.0, round(now - started, 7)))  # Waiting for a free thread
+
+        return trace
+
+    def finish(self):
+        """Finish trace in the current thread and write it into the trace file"""
+        trace = getattr(self._local, 'trace', None)
+
+        if trace is None:
+            return
+
+        self._local.trace = None
+        line = trace.to_json(time.time())
+
+        with self._lock:
+            if self._fp:
+                self._fp.write(line + '\n')
+                self._fp.flush()
+
+    def span(self, name):
+        """Return context manager measuring one stage of the current trace"""
+        trace = getattr(self._local, 'trace', None)
+
+        if trace is None:
+            return NOOP_SPAN
+
+        return _Span(trace, name)
+
+
+TRACER = Tracer()
+span = TRACER.span
+
+
+def percentile(values, pct):
+    """Return percentile of sorted values (nearest rank)"""
+    if not values:
+        return 0.0
+
+    return values[max(0, int(math.ceil(pct / 100.0 * len(values))) - 1)]
+
+
+def analyze(lines):
+    """Return {stage : sorted list of durations} from trace file lines. The whole trace is the "total" stage"""
+    stages = OrderedDict([('total', [])])
+
+    for line in lines:
+        try:
+            trace = json.loads(line)
+        except ValueError:
+            continue
+
+        stages['total'].append(trace['duration'])
+        durations = {}
+
+        for name, _, duration in trace['spans']:  # Repeated spans (e.g. streamed replies) are summed
+            durations[name] = durations.get(name, 0) + duration
+
+        for name, duration in durations.items():
+            stages.setdefault(name, []).append(duration)
+
+    for durations in stages.values():
+        durations.sort()
+
+    return stages
+
+
+def main(paths):
+    """Print per-stage percentiles (in milliseconds) of traces in trace files"""
+    lines = []
+
+    for path in paths:
+        with open(path) as fp:
+            lines.extend(fp)
+
+    stages = analyze(lines)
+    print('%-24s %8s %10s %10s %10s %10s' % ('stage', 'count', 'p50 [ms]', 'p90 [ms]', 'p99 [ms]', 'max [ms]'))
+
+    for name, durations in stages.items():
+        print('%-24s %8d %10.3f %10.3f %10.3f %10.3f' % (
+            name, len(durations), percentile(durations, 50) * 1000, percentile(durations, 90) * 1000,
+            percentile(durations, 99) * 1000, (durations[-1] if durations else 0) * 1000))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.stderr.write('Usage: python -m ludolph.tracing <trace file> [trace file ...]\n')
+        sys.exit(1)
+
+    main(sys.argv[1:])
@@ -5,8 +5,17 @@ This file is part of Ludolph.
 
 See the LICENSE file for copying permission.
 """
+import time
 import logging
+from threading import Lock
 from functools import wraps
+from contextlib import contextmanager
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # noinspection PyUnresolvedReferences,PyPackageRequirements
+    from ordereddict import OrderedDict
 
 LOG_LEVELS = frozenset(['DEBUG', 'INFO', 'WARN', 'WARNING', 'ERROR', 'FATAL', 'CRITICAL'])
 
@@ -42,3 +51,171 @@ def catch_exception(fun):
             logger.exception(e)
             logger.error('Got exception when running %s(%s, %s): %s.', fun.__name__, args, kwargs, e)
     return wrap
+
+
+class LRUCache(object):
+    """
+    Bounded thread-safe mapping which discards least recently used items. Keeps hit/miss statistics.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, factory=None):
+        """Return cached value for key. On cache miss create the value by calling factory(key) (if set)"""
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data[key] = value  # Move to the end
+                return value
+
+        if factory is None:
+            return None
+
+        value = factory(key)  # Not under lock - the factory may be slow or raise an exception
+        self.set(key, value)
+
+        return value
+
+    def set(self, key, value):
+        """Save value into cache and discard the least recently used items"""
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """Return cache statistics as dict"""
+        lookups = self.hits + self.misses
+
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+        }
+
+
+class TTLCache(LRUCache):
+    """
+    Bounded thread-safe mapping with items expiring ttl seconds after they were saved.
+    Items are kept in insertion order (a hit does not extend the lifetime), so the oldest items are discarded first.
+    """
+    def __init__(self, maxsize=1024, ttl=3600):
+        super(TTLCache, self).__init__(maxsize=maxsize)
+        self.ttl = ttl
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def _expire(self, now):
+        """Remove expired items from the beginning of the mapping (must be called under lock)"""
+        while self._data:
+            key = next(iter(self._data))
+
+            if self._data[key][0] > now:
+                break
+
+            del self._data[key]
+
+    def get(self, key, factory=None):
+        """Return cached value for key if it has not expired. On cache miss call factory(key) (if set)"""
+        with self._lock:
+            item = self._data.get(key, None)
+
+            if item is not None and item[0] > time.time():
+                self.hits += 1
+                return item[1]
+
+            self.misses += 1
+
+        if factory is None:
+            return None
+
+        value = factory(key)
+        self.set(key, value)
+
+        return value
+
+    def set(self, key, value):
+        """Save value into cache and discard expired and the oldest items"""
+        now = time.time()
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (now + self.ttl, value)
+            self._expire(now)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+class PhaseTimer(object):
+    """
+    Wall-clock timer for named phases (used for profiling Ludolph startup). A disabled timer does nothing.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.started = time.time()
+        self._phases = OrderedDict()  # {name : [start time, end time]}
+
+    def start(self, name):
+        """Start measuring a phase"""
+        if self.enabled:
+            self._phases[name] = [time.time(), None]
+
+    def stop(self, name):
+        """Stop measuring a phase (ignored if the phase was not started or has already finished)"""
+        phase = self._phases.get(name, None)
+
+        if phase and phase[1] is None:
+            phase[1] = time.time()
+
+    @contextmanager
+    def phase(self, name):
+        """Measure a block of code"""
+        self.start(name)
+
+        try:
+            yield
+        finally:
+            self.stop(name)
+
+    def report(self):
+        """Return phase timings as multi-line text"""
+        lines = ['%-24s %12s %12s' % ('phase', 'offset [ms]', 'time [ms]')]
+        end = self.started
+
+        for name, (started, stopped) in self._phases.items():
+            offset = (started - self.started) * 1000
+
+            if stopped is None:
+                lines.append('%-24s %12.1f %12s' % (name, offset, 'unfinished'))
+            else:
+                lines.append('%-24s %12.1f %12.1f' % (name, offset, (stopped - started) * 1000))
+                end = max(end, stopped)
+
+        lines.append('%-24s %12s %12.1f' % ('total', '', (end - self.started) * 1000))
+
+        return '\n'.join(lines)
@@ -5,45 +5,268 @@ This file is part of Ludolph.
 
 See the LICENSE file for copying permission.
 """
+import os
+import time
 import logging
 import socket
+from hmac import compare_digest
+from threading import Event, Lock
 from functools import wraps
 from collections import namedtuple
-# noinspection PyUnresolvedReferences
-from bottle import Bottle, ServerAdapter, abort, request
+
+from ludolph import metrics
+from ludolph.command import CommandError, PermissionDenied
+from ludolph.profiling import PROFILER
+from ludolph.utils import TTLCache
 
 __all__ = ('webhook', 'request', 'abort')
 
 logger = logging.getLogger(__name__)
 
+WEBHOOK_REQUESTS = metrics.counter('ludolph_webhook_requests_total', 'Number of webhook requests',
+                                   ('webhook', 'status'))
+WEBHOOK_SECONDS = metrics.histogram('ludolph_webhook_seconds', 'Webhook request processing time', ('webhook',))
+
+
+class BottleProxy(object):
+    """
+    Lazy reference to a bottle object (e.g. the thread-local request).
+    The bottle module is imported on first use, i.e. only when the web server is enabled.
+    """
+    def __init__(self, name):
+        object.__setattr__(self, '_name', name)
+
+    def _get_object(self):
+        import bottle
+        return getattr(bottle, self._name)
+
+    def __getattr__(self, attr):
+        return getattr(self._get_object(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._get_object(), attr, value)
+
+    def __repr__(self):
+        return '<%s: bottle.%s>' % (self.__class__.__name__, self._name)
+
+
+request = BottleProxy('request')
+response = BottleProxy('response')
+
 
-class LudolphBottle(Bottle):
+def abort(code=500, text='Unknown Error.'):
+    """Abort execution and cause a HTTP error (bottle.abort)"""
+    import bottle
+    bottle.abort(code, text)
+
+
+def _default_error_handler(res):
+    return 'ERROR %s: %s\n' % (res.status_code, res.body)
+
+
+LISTEN_FD_ENV = 'LUDOLPH_LISTEN_FD'  # Listening socket file descriptor passed to a restarted Ludolph process
+SD_LISTEN_FDS_START = 3  # First file descriptor passed by systemd socket activation
+
+
+def get_inherited_listen_fd():
     """
-    Bottle web server - used for webhooks.
+    Return file descriptor of a listening socket inherited from the previous Ludolph process (restart)
+    or from systemd (socket activation). Return None if there is no such socket.
+    Must be called before daemonizing, because systemd passes the socket to a specific PID.
     """
-    # noinspection PyMethodMayBeStatic
-    def default_error_handler(self, res):
-        return 'ERROR %s: %s\n' % (res.status_code, res.body)
+    fd = os.environ.pop(LISTEN_FD_ENV, None)
+
+    if fd:
+        try:
+            return int(fd)
+        except ValueError:
+            logger.error('Invalid %s environment variable: %s', LISTEN_FD_ENV, fd)
+            return None
+
+    if os.environ.get('LISTEN_PID') == str(os.getpid()):
+        try:
+            count = int(os.environ.get('LISTEN_FDS', 0))
+        except ValueError:
+            count = 0
+
+        for var in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):  # Do not pass the sockets to child processes
+            os.environ.pop(var, None)
 
+        if count > 1:
+            logger.warning('Received %d sockets from systemd, but only the first one will be used', count)
 
-WEBAPP = LudolphBottle()
-WEBHOOKS = {}  # {webhook : (name, module, path)}
-Webhook = namedtuple('Webhook', ('name', 'module', 'path'))
+        if count > 0:
+            return SD_LISTEN_FDS_START
 
+    return None
 
-class WebServer(ServerAdapter):
+
+def set_inheritable(fd):
+    """Allow file descriptor to be inherited by a new program started by exec"""
+    try:
+        os.set_inheritable(fd, True)
+    except AttributeError:  # Python < 3.4
+        import fcntl
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) & ~fcntl.FD_CLOEXEC)
+
+
+def _socket_from_fd(fd, family=socket.AF_INET):
+    """Create socket object from an inherited file descriptor"""
+    try:
+        return socket.socket(fileno=fd)  # The socket family is detected automatically on Python 3.7+
+    except TypeError:  # Python 2
+        sock = socket.fromfd(fd, family, socket.SOCK_STREAM)
+        os.close(fd)  # fromfd() duplicates the file descriptor
+
+        return sock
+
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+IDEMPOTENCY_FIELD = 'idempotency_key'
+IDEMPOTENCY_KEY_MAXLEN = 255
+TEXT_TYPES = (bytes, type(u''))
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+
+    return value.encode('utf-8')
+
+
+def get_idempotency_key():
+    """Return idempotency key from current request header or form field (or None)"""
+    key = request.get_header(IDEMPOTENCY_HEADER, '') or request.forms.get(IDEMPOTENCY_FIELD, '')
+    key = key.strip()
+
+    if len(key) > IDEMPOTENCY_KEY_MAXLEN:
+        abort(400, 'Idempotency key is too long')
+
+    return key or None
+
+
+WEBHOOKS = {}  # {webhook : (name, module, path, methods, fun)}
+Webhook = namedtuple('Webhook', ('name', 'module', 'path', 'methods', 'fun'))
+
+
+class WebServer(object):
     """
-    Like bottle.WSGIRefServer, but with stop() method.
+    Like bottle.WSGIRefServer (server adapter), but with stop() method.
+    The bottle application with all registered webhooks is created when the server starts.
+    The server can use an inherited listening socket (listen_fd), so no incoming connections are refused while
+    Ludolph is restarting - they wait in the socket's backlog.
     """
     server = None
+    app = None
     quiet = True
     webhooks = WEBHOOKS
+    api_tokens = None  # {token : JID} used by the command API
+    request_queue_size = 128  # Listen backlog (connections waiting during restart)
+    idempotency_ttl = 3600  # Seconds for remembering results of POST requests with an idempotency key (0 = disabled)
+    idempotency_maxsize = 4096
+    idempotency_wait = 30  # Seconds to wait for a duplicate request which is still being processed
+
+    def __init__(self, host='127.0.0.1', port=8080, listen_fd=None, **options):
+        self.host = host
+        self.port = int(port)
+        self.listen_fd = listen_fd
+        self.options = options
+        self.api_tokens = {}
+        self.idempotency_cache = TTLCache(maxsize=self.idempotency_maxsize, ttl=self.idempotency_ttl)
+        self._idempotency_pending = {}  # {key : Event} - requests being processed
+        self._idempotency_lock = Lock()
+
+    def set_idempotency_ttl(self, ttl):
+        """Change the deduplication time window (0 disables deduplication)"""
+        self.idempotency_ttl = self.idempotency_cache.ttl = ttl
+
+        if not ttl:
+            self.idempotency_cache.clear()
+
+    def load_api_tokens(self, value):
+        """Parse comma-separated list of JID:token pairs used for authenticating command API requests"""
+        api_tokens = {}
+
+        for item in value.split(','):
+            item = item.strip()
+
+            if not item:
+                continue
+
+            jid, _, token = item.partition(':')
+            jid, token = jid.strip(), token.strip()
+
+            if '@' in jid and token:
+                api_tokens[token] = jid
+            else:
+                logger.warning('Skipping invalid command API token for "%s"', jid)
+
+        self.api_tokens = api_tokens
+        logger.info('Command API enabled for users: %s', ', '.join(set(api_tokens.values())))
+
+    def get_api_user(self):
+        """Return JID authenticated by the token in current request or None"""
+        auth = request.get_header('Authorization', '')
+
+        if auth.startswith('Bearer '):
+            token = auth[7:].strip()
+        else:
+            token = request.forms.get('token', '')
+
+        user = None
+
+        if token:
+            token = _to_bytes(token)
+
+            for api_token, jid in self.api_tokens.items():  # Check all tokens in constant time
+                if compare_digest(_to_bytes(api_token), token):
+                    user = jid
+
+        return user
+
+    @staticmethod
+    def init_webapp(app):
+        """Register built-in routes"""
+        app.route('/command', ('POST',), command_api, name='command_api')
+        app.route('/metrics', ('GET',), metrics_view, name='metrics')
+
+    def create_webapp(self):
+        """Create bottle application with built-in routes and all registered webhooks"""
+        from bottle import Bottle
+
+        app = Bottle()
+        app.default_error_handler = _default_error_handler
+        self.init_webapp(app)
+
+        webhooks = self.webhooks
+
+        for hook in webhooks.values():
+            view = _webview(hook.fun, webhooks)
+
+            if set(hook.methods).difference(('GET', 'HEAD')):
+                view = self._idempotent_view(view)
+
+            app.route(hook.path, hook.methods, view, name=hook.name)
+
+        return app
 
     def run(self, handler):
         logger.info('Starting web server on http://%s:%s', self.host, self.port)
         from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
         from wsgiref.simple_server import make_server
 
+        try:
+            from socketserver import ThreadingMixIn
+        except ImportError:
+            # noinspection PyUnresolvedReferences,PyPep8Naming
+            from SocketServer import ThreadingMixIn
+
+        # Each request is handled in a separate thread, so long running requests (e.g. streamed command API output)
+        # do not block alert webhooks
+        # noinspection PyClassHasNoInit
+        class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+            daemon_threads = True
+
         # noinspection PyClassHasNoInit
         class CustomHandler(WSGIRequestHandler):
             def address_string(self):  # Prevent reverse DNS lookups
@@ -58,7 +281,7 @@ class WebServer(ServerAdapter):
                 logger.log(level, '%s - - %s', self.client_address[0], str(fmt % args).rstrip('\n'))
 
         handler_cls = self.options.get('handler_class', CustomHandler)
-        server_cls = self.options.get('server_class', WSGIServer)
+        server_cls = self.options.get('server_class', ThreadingWSGIServer)
 
         if ':' in self.host:  # Fix wsgiref for IPv6 addresses
             if getattr(server_cls, 'address_family') == socket.AF_INET:
@@ -66,7 +289,23 @@ class WebServer(ServerAdapter):
                 class server_cls(server_cls):
                     address_family = socket.AF_INET6
 
-        self.server = make_server(self.host, self.port, handler, server_cls, handler_cls)
+        # noinspection PyPep8Naming
+        class server_cls(server_cls):
+            request_queue_size = self.request_queue_size
+
+        if self.listen_fd is None:
+            self.server = make_server(self.host, self.port, handler, server_cls, handler_cls)
+        else:
+            server = server_cls((self.host, self.port), handler_cls, bind_and_activate=False)
+            server.socket.close()
+            server.socket = _socket_from_fd(self.listen_fd, family=server_cls.address_family)
+            server.server_address = server.socket.getsockname()
+            server.server_name, server.server_port = self.host, self.port
+            server.setup_environ()
+            server.set_app(handler)
+            self.server = server
+            logger.info('Using inherited listening socket %s (fd %s)', server.server_address, self.listen_fd)
+
         self.server.serve_forever()
 
     def stop(self):
@@ -78,13 +317,12 @@ class WebServer(ServerAdapter):
 
     def start(self):
         assert self.server is None, 'Web server is already running?'
-        global WEBAPP
-        WEBAPP.run(server=self)
+        self.app = self.create_webapp()
+        self.run(self.app)
 
     def reset_webhooks(self, module=None):
         if module:
             logger.info('Deregistering webhooks from plugin: %s', module)
-            global WEBAPP
 
             for name, hook in tuple(self.webhooks.items()):  # Copy for python 3
                 if hook.module == module:
@@ -95,42 +333,214 @@ class WebServer(ServerAdapter):
             logger.info('Reinitializing webhooks')
             self.webhooks.clear()
 
+    def get_listen_fd(self):
+        """Return inheritable file descriptor of the listening socket (used for restart) or None"""
+        if self.server:
+            fd = self.server.socket.fileno()
+            set_inheritable(fd)
+
+            return fd
+
+        return None
+
+    def _idempotent_view(self, view):
+        """
+        Wrapper for webhooks changing state (e.g. sending messages). Retried requests with the same idempotency key
+        are not processed again - the result of the original request is returned instead.
+        Only successful (text) results are remembered, so a failed request can be retried.
+        """
+        @wraps(view)
+        def wrap(*args, **kwargs):
+            if not self.idempotency_ttl or request.method in ('GET', 'HEAD'):
+                return view(*args, **kwargs)
+
+            key = get_idempotency_key()
+
+            if not key:
+                return view(*args, **kwargs)
+
+            key = (view.__name__, key)
+            cache = self.idempotency_cache
+            waited = False
+
+            while True:
+                with self._idempotency_lock:
+                    result = cache.get(key)
+
+                    if result is not None:
+                        break
+
+                    pending = self._idempotency_pending.get(key, None)
+
+                    if pending is None:  # We are going to process the request
+                        self._idempotency_pending[key] = Event()
+                        break
+
+                if waited:
+                    abort(409, 'Request with the same idempotency key is still being processed')
+
+                logger.info('Waiting for request with duplicate idempotency key "%s" (%s)', key[1], key[0])
+                pending.wait(self.idempotency_wait)
+                waited = True
+
+            if result is not None:
+                logger.info('Skipping request with duplicate idempotency key "%s" (%s)', key[1], key[0])
+                response.set_header('Idempotent-Replayed', 'true')
+
+                return result
+
+            try:
+                result = view(*args, **kwargs)
+
+                if isinstance(result, TEXT_TYPES):
+                    cache.set(key, result)
+
+                return result
+            finally:
+                with self._idempotency_lock:
+                    self._idempotency_pending.pop(key).set()
+
+        return wrap
+
     def reset_webapp(self):
+        """Replace the bottle application in a running web server (should be called after webhooks are reloaded)"""
         if self.server:
             logger.info('Reinitializing web server')
-            global WEBAPP
-            del WEBAPP
-            WEBAPP = LudolphBottle()
-            self.server.set_app(WEBAPP)
+            self.app = self.create_webapp()
+            self.server.set_app(self.app)
+
+    def publish_webhooks(self, webhooks):
+        """Replace registered webhooks (prepared during reload) together with the bottle application"""
+        self.webhooks = webhooks
+        self.reset_webapp()
 
     def display_webhooks(self):
         """Return list of available webhooks suitable for logging"""
         return ['%s [%s]: %s' % (name, hook.module, hook.path) for name, hook in self.webhooks.items()]
 
 
-def _webview(fun):
+def _webview(fun, webhooks):
     """
     Wrapper for bottle callbacks responsible for finding back the bound method. Inspired by err bot.
+    The webhooks registry is the one used for creating the bottle application.
     """
     @wraps(fun)
     def wrap(*args, **kwargs):
         from ludolph.bot import PLUGINS
 
         try:
-            obj = PLUGINS[WEBHOOKS[fun.__name__].module]
+            obj = PLUGINS[webhooks[fun.__name__].module]
             obj_fun = getattr(obj, fun.__name__)
         except (KeyError, AttributeError) as e:
             logger.error('Requested webhook "%s" is not registered (%s)', fun.__name__, e)
             abort(404, 'Webhook vanished')
         else:
-            return obj_fun(*args, **kwargs)
+            start = time.time()
+            status = 'error'
+
+            try:
+                res = obj_fun(*args, **kwargs)
+                status = 'ok'
+
+                return res
+            finally:
+                WEBHOOK_REQUESTS.labels(fun.__name__, status).inc()
+                WEBHOOK_SECONDS.labels(fun.__name__).observe(time.time() - start)
 
     return wrap
 
 
+def metrics_view():
+    """Export metrics in the Prometheus text format"""
+    response.content_type = metrics.CONTENT_TYPE
+
+    return metrics.REGISTRY.render()
+
+
+def _command_api_output(cmd, output):
+    """Stream command output - one chunk per line"""
+    try:
+        for line in output:
+            yield '%s\n' % line
+    except Exception as e:
+        if not isinstance(e, CommandError):
+            logger.exception(e)
+        yield '%s\n' % e
+    finally:
+        close = getattr(output, 'close', None)
+
+        if close:
+            close()
+
+    logger.info('Command API: Command %s finished', cmd)
+
+
+def command_api():
+    """
+    Run a bot command on behalf of an authenticated user and return its output.
+    Output of stream_output commands is sent back line by line as it is produced.
+    """
+    from ludolph.bot import get_xmpp
+    from ludolph.message import IncomingLudolphMessage
+
+    xmpp = get_xmpp()
+    user = xmpp.webserver.get_api_user()
+
+    if not user:
+        abort(401, 'Invalid or missing API token')
+
+    body = request.forms.get('cmd', '').strip()
+
+    try:
+        cmd_name = body.split()[0]
+    except IndexError:
+        abort(400, 'Missing cmd parameter')
+
+    cmd = xmpp.commands.get_command(cmd_name)
+
+    if not cmd:
+        abort(404, '%s: command not found' % cmd_name)
+
+    if not cmd.is_jid_permitted_to_run(xmpp, user):
+        logger.warning('Command API: Unauthorized command "%s" (%s) from "%s"', body, cmd, user)
+        abort(403, str(PermissionDenied()))
+
+    msg = IncomingLudolphMessage.load({
+        'type': 'chat',
+        'from': user,
+        'to': xmpp.boundjid.bare,
+        'body': body,
+        'reply_output': False,  # Do not send anything via XMPP
+    })
+    msg.raw_output = True
+    msg.context = xmpp.get_request_context(msg, jid=user)
+    logger.info('Command API: User "%s" requested command "%s" (%s)', user, body, cmd)
+
+    try:
+        output = PROFILER.call(cmd.get_fun(xmpp), msg)  # Streamed output is profiled until it is sent
+    except PermissionDenied as e:
+        abort(403, str(e))
+    except CommandError as e:
+        abort(400, str(e))
+    except Exception as e:
+        abort(500, 'ERROR: Command failed due to internal programming error: %s' % e)
+
+    response.content_type = 'text/plain; charset=utf-8'
+
+    if output is None:
+        return ''
+    elif isinstance(output, str) or not hasattr(output, '__iter__'):
+        return '%s\n' % output
+    elif isinstance(output, (list, tuple)):
+        return ''.join('%s\n' % line for line in output)
+    else:
+        return _command_api_output(cmd, output)
+
+
 def webhook(path, methods=('GET',)):
     """
     Decorator for registering HTTP request handlers. Inspired by err bot.
+    The handler is added into the bottle application when the web server starts (or is reinitialized).
     """
     def webhook_decorator(fun):
         if fun.__name__ in WEBHOOKS:
@@ -139,8 +549,7 @@ def webhook(path, methods=('GET',)):
             return None
 
         logger.debug('Registering webhook "%s" from plugin "%s" to URL "%s"', fun.__name__, fun.__module__, path)
-        WEBAPP.route(path, methods, _webview(fun), name=fun.__name__)
-        WEBHOOKS[fun.__name__] = Webhook(fun.__name__, fun.__module__, path)
+        WEBHOOKS[fun.__name__] = Webhook(fun.__name__, fun.__module__, path, methods, fun)
 
         return fun
 
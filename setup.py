@@ -62,7 +62,7 @@ setup(
     url='https://github.com/erigones/Ludolph/',
     license='BSD',
     packages=['ludolph'],
-    scripts=['bin/ludolph'],
+    scripts=['bin/ludolph', 'bin/ludolph-send'],
     install_requires=DEPS,
     platforms='any',
     classifiers=CLASSIFIERS,